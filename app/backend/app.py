@@ -4,6 +4,7 @@ import json
 import logging
 import mimetypes
 import os
+import tempfile
 import time
 from pathlib import Path
 from typing import Any, AsyncGenerator, Dict, Union, cast
@@ -78,12 +79,22 @@ from config import (
     CONFIG_SPEECH_SERVICE_LOCATION,
     CONFIG_SPEECH_SERVICE_TOKEN,
     CONFIG_SPEECH_SERVICE_VOICE,
+    CONFIG_UPLOAD_LISTING_CACHE,
+    CONFIG_UPLOAD_QUEUE,
     CONFIG_USER_BLOB_CONTAINER_CLIENT,
     CONFIG_USER_UPLOAD_ENABLED,
+    CONFIG_USER_UPLOAD_MAX_FILE_SIZE,
     CONFIG_VECTOR_SEARCH_ENABLED,
 )
 from core.authentication import AuthenticationHelper
 from core.sessionhelper import create_session_id
+from core.streamingupload import UploadTooLargeError, stream_multipart_upload
+from core.uploadlisting import (
+    LISTING_CACHE_SECONDS,
+    MAX_PAGE_SIZE,
+    UploadListingCache,
+    page_files,
+)
 from decorators import authenticated, authenticated_path
 from error import error_dict, error_response
 from prepdocs import (
@@ -93,7 +104,12 @@ from prepdocs import (
     setup_search_info,
 )
 from prepdocslib.filestrategy import UploadUserFileStrategy
-from prepdocslib.listfilestrategy import File
+from prepdocslib.uploadqueue import (
+    IndexedFileHashes,
+    SharedFileLocks,
+    UploadJobStore,
+    UploadQueue,
+)
 
 bp = Blueprint("routes", __name__, static_folder="static")
 # Fix Windows registry issue with mimetypes
@@ -350,13 +366,23 @@ async def speech():
 @bp.post("/upload")
 @authenticated
 async def upload(auth_claims: dict[str, Any]):
-    request_files = await request.files
-    if "file" not in request_files:
-        # If no files were included in the request, return an error response
+    boundary = request.mimetype_params.get("boundary")
+    if request.mimetype != "multipart/form-data" or not boundary:
         return jsonify({"message": "No file part in the request", "status": "failed"}), 400
 
     user_oid = auth_claims["oid"]
-    file = request_files.getlist("file")[0]
+    upload_queue: UploadQueue = current_app.config[CONFIG_UPLOAD_QUEUE]
+    if not await upload_queue.has_capacity(user_oid):
+        return (
+            jsonify({"message": "Too many files are still being ingested, try again later", "status": "failed"}),
+            429,
+        )
+    max_size = current_app.config[CONFIG_USER_UPLOAD_MAX_FILE_SIZE]
+    remaining_bytes = await upload_queue.remaining_bytes(user_oid)
+    if remaining_bytes is not None:
+        if remaining_bytes == 0:
+            return jsonify({"message": "The storage quota for uploaded files is used up", "status": "failed"}), 413
+        max_size = min(max_size, remaining_bytes)
     user_blob_container_client: FileSystemClient = current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT]
     user_directory_client = user_blob_container_client.get_directory_client(user_oid)
     try:
@@ -365,15 +391,54 @@ async def upload(auth_claims: dict[str, Any]):
         current_app.logger.info("Creating directory for user %s", user_oid)
         await user_directory_client.create_directory()
     await user_directory_client.set_access_control(owner=user_oid)
-    file_client = user_directory_client.get_file_client(file.filename)
-    file_io = file
-    file_io.name = file.filename
-    file_io = io.BufferedReader(file_io)
-    await file_client.upload_data(file_io, overwrite=True, metadata={"UploadedBy": user_oid})
-    file_io.seek(0)
-    ingester: UploadUserFileStrategy = current_app.config[CONFIG_INGESTER]
-    await ingester.add_file(File(content=file_io, acls={"oids": [user_oid]}, url=file_client.url))
-    return jsonify({"message": "File uploaded successfully"}), 200
+    # The file is written to the storage account and to a local copy as the request body is received,
+    # instead of buffering the whole file in memory first
+    try:
+        upload = await stream_multipart_upload(
+            request.body,
+            boundary.encode("latin-1"),
+            "file",
+            user_directory_client.get_file_client,
+            metadata={"UploadedBy": user_oid},
+            max_size=max_size,
+        )
+    except UploadTooLargeError as error:
+        return jsonify({"message": str(error), "status": "failed"}), 413
+    if upload is None:
+        # If no files were included in the request, return an error response
+        return jsonify({"message": "No file part in the request", "status": "failed"}), 400
+    await current_app.config[CONFIG_UPLOAD_LISTING_CACHE].invalidate(user_oid)
+    # The file is parsed, embedded and indexed in the background, and the client polls /upload/status for the result.
+    # Uploading the same file again while it is queued returns the same job
+    job_id = await upload_queue.enqueue(
+        user_oid,
+        upload.filename,
+        f"{user_oid}/{upload.filename}",
+        upload.url,
+        upload.local_path,
+        content_hash=upload.sha256,
+        size=upload.size,
+    )
+    return (
+        jsonify(
+            {
+                "message": "File uploaded successfully",
+                "job_id": job_id,
+                "status": "queued",
+            }
+        ),
+        202,
+    )
+
+
+@bp.get("/upload/status/<job_id>")
+@authenticated
+async def upload_status(auth_claims: dict[str, Any], job_id: str):
+    upload_queue: UploadQueue = current_app.config[CONFIG_UPLOAD_QUEUE]
+    job = await upload_queue.status(job_id, auth_claims["oid"])
+    if job is None:
+        return jsonify({"message": f"Upload job {job_id} not found"}), 404
+    return jsonify(job), 200
 
 
 @bp.post("/delete_uploaded")
@@ -386,25 +451,39 @@ async def delete_uploaded(auth_claims: dict[str, Any]):
     user_directory_client = user_blob_container_client.get_directory_client(user_oid)
     file_client = user_directory_client.get_file_client(filename)
     await file_client.delete_file()
-    ingester = current_app.config[CONFIG_INGESTER]
-    await ingester.remove_file(filename, user_oid)
+    # Also cancels the ingestion of the file if it is still queued
+    upload_queue: UploadQueue = current_app.config[CONFIG_UPLOAD_QUEUE]
+    await upload_queue.remove(user_oid, filename)
+    await current_app.config[CONFIG_UPLOAD_LISTING_CACHE].invalidate(user_oid)
     return jsonify({"message": f"File {filename} deleted successfully"}), 200
 
 
 @bp.get("/list_uploaded")
 @authenticated
 async def list_uploaded(auth_claims: dict[str, Any]):
+    """
+    Lists the files uploaded by the user, from a per-user cache. Pass page_size to get a page of files at a time,
+    as {"files": [...], "continuation_token": ...}, and the continuation_token of a page to get the next one.
+    Pass recursive=false to only list the files at the top of the user directory, which is where uploads go.
+    """
     user_oid = auth_claims["oid"]
-    user_blob_container_client: FileSystemClient = current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT]
+    listing_cache: UploadListingCache = current_app.config[CONFIG_UPLOAD_LISTING_CACHE]
+    recursive = request.args.get("recursive", "true").lower() != "false"
+    page_size = request.args.get("page_size", type=int)
+    if page_size is not None and not 0 < page_size <= MAX_PAGE_SIZE:
+        return jsonify({"error": f"page_size must be between 1 and {MAX_PAGE_SIZE}"}), 400
     files = []
     try:
-        all_paths = user_blob_container_client.get_paths(path=user_oid)
-        async for path in all_paths:
-            files.append(path.name.split("/", 1)[1])
-    except ResourceNotFoundError as error:
-        if error.status_code != 404:
-            current_app.logger.exception("Error listing uploaded files", error)
-    return jsonify(files), 200
+        files = await listing_cache.list(user_oid, recursive)
+    except ResourceNotFoundError:
+        current_app.logger.exception("Error listing uploaded files")
+    if page_size is None:
+        return jsonify(files), 200
+    try:
+        page, continuation_token = page_files(files, page_size, request.args.get("continuation_token"))
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    return jsonify({"files": page, "continuation_token": continuation_token}), 200
 
 
 @bp.before_app_serving
@@ -549,7 +628,10 @@ async def setup_clients():
             azure_credential=azure_credential,
             document_intelligence_service=os.getenv("AZURE_DOCUMENTINTELLIGENCE_SERVICE"),
             local_pdf_parser=os.getenv("USE_LOCAL_PDF_PARSER", "").lower() == "true",
+            local_pdf_parser_backend=os.getenv("LOCAL_PDF_PARSER_BACKEND") or "pypdf",
             local_html_parser=os.getenv("USE_LOCAL_HTML_PARSER", "").lower() == "true",
+            local_html_parser_engine=os.getenv("LOCAL_HTML_PARSER_ENGINE") or "beautifulsoup",
+            local_html_parser_split_on_headings=os.getenv("LOCAL_HTML_PARSER_SPLIT_ON_HEADINGS", "").lower() == "true",
             search_images=USE_GPT4V,
         )
         search_info = await setup_search_info(
@@ -568,10 +650,46 @@ async def setup_clients():
             openai_org=OPENAI_ORGANIZATION,
             disable_vectors=os.getenv("USE_VECTORS", "").lower() == "false",
         )
+        upload_queue_path = os.getenv("USER_UPLOAD_QUEUE_PATH")
+        if not upload_queue_path:
+            upload_queue_path = os.path.join(tempfile.gettempdir(), "user_upload_jobs.sqlite")
+            current_app.logger.warning(
+                "USER_UPLOAD_QUEUE_PATH is not set, so the upload jobs in %s are lost when the app restarts",
+                upload_queue_path,
+            )
+        upload_job_store = UploadJobStore(upload_queue_path)
         ingester = UploadUserFileStrategy(
-            search_info=search_info, embeddings=text_embeddings_service, file_processors=file_processors
+            search_info=search_info,
+            embeddings=text_embeddings_service,
+            file_processors=file_processors,
+            indexed_hashes=IndexedFileHashes(upload_job_store),
+            # Uploads of the same file can reach different worker processes
+            shared_lock=SharedFileLocks(upload_job_store).lock,
         )
         current_app.config[CONFIG_INGESTER] = ingester
+        # Total size of the files each user can upload, unlimited by default
+        max_user_bytes = os.getenv("USER_UPLOAD_MAX_USER_BYTES")
+        upload_queue = UploadQueue(
+            ingester=ingester,
+            file_system_client=user_blob_container_client,
+            store=upload_job_store,
+            max_concurrency=int(os.getenv("USER_UPLOAD_QUEUE_CONCURRENCY") or 2),
+            max_jobs_per_user=int(os.getenv("USER_UPLOAD_MAX_PENDING_FILES") or 5),
+            max_bytes_per_user=int(max_user_bytes) if max_user_bytes else None,
+        )
+        await upload_queue.start()
+        current_app.config[CONFIG_UPLOAD_QUEUE] = upload_queue
+        current_app.config[CONFIG_UPLOAD_LISTING_CACHE] = UploadListingCache(
+            user_blob_container_client,
+            upload_job_store,
+            max_age=float(os.getenv("USER_UPLOAD_LISTING_CACHE_SECONDS") or LISTING_CACHE_SECONDS),
+        )
+        max_file_size = int(os.getenv("USER_UPLOAD_MAX_FILE_SIZE") or 16 * 1024 * 1024)
+        current_app.config[CONFIG_USER_UPLOAD_MAX_FILE_SIZE] = max_file_size
+        # Leave room for the rest of the multipart form, so that files up to the limit get the 413 response of /upload
+        current_app.config["MAX_CONTENT_LENGTH"] = max(
+            current_app.config["MAX_CONTENT_LENGTH"], max_file_size + 64 * 1024
+        )
 
     # Used by the OpenAI SDK
     openai_client: AsyncOpenAI
@@ -731,6 +849,8 @@ async def setup_clients():
 async def close_clients():
     await current_app.config[CONFIG_SEARCH_CLIENT].close()
     await current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].close()
+    if current_app.config.get(CONFIG_UPLOAD_QUEUE):
+        await current_app.config[CONFIG_UPLOAD_QUEUE].stop()
     if current_app.config.get(CONFIG_USER_BLOB_CONTAINER_CLIENT):
         await current_app.config[CONFIG_USER_BLOB_CONTAINER_CLIENT].close()
 
@@ -0,0 +1,64 @@
+import argparse
+import asyncio
+import glob
+import logging
+import os
+import time
+from typing import List
+
+from rich.logging import RichHandler
+
+from prepdocslib.htmlparser import LocalHTMLParser
+
+logger = logging.getLogger("scripts")
+
+
+async def benchmark(paths: List[str], engine: str, split_on_headings: bool) -> None:
+    parser = LocalHTMLParser(engine=engine, split_on_headings=split_on_headings)
+    page_count = 0
+    character_count = 0
+    byte_count = 0
+    start = time.perf_counter()
+    for path in paths:
+        byte_count += os.path.getsize(path)
+        with open(path, "rb") as content:
+            async for page in parser.parse(content):
+                page_count += 1
+                character_count += len(page.text)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{engine:>13}: {len(paths)} files, {page_count} pages ({character_count} characters) in {elapsed:.2f}s, "
+        f"{len(paths) / elapsed:.1f} files/sec, {byte_count / elapsed / 1024 / 1024:.1f} MB/sec"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the speed of the local HTML parser engines, to pick one for ingestion without Azure Document Intelligence."
+    )
+    parser.add_argument("files", nargs="?", default="data/*.html", help="Glob pattern of the HTML files to parse")
+    parser.add_argument(
+        "--engine",
+        nargs="+",
+        choices=LocalHTMLParser.ENGINES,
+        default=list(LocalHTMLParser.ENGINES),
+        help="Engines to benchmark",
+    )
+    parser.add_argument(
+        "--splitonheadings",
+        action="store_true",
+        help="Split the pages on headings (only supported by the fast engine)",
+    )
+    parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(format="%(message)s", datefmt="[%X]", handlers=[RichHandler(rich_tracebacks=True)])
+        logger.setLevel(logging.INFO)
+
+    paths = sorted(glob.glob(args.files, recursive=True))
+    if not paths:
+        logger.error("No files match %s", args.files)
+        exit(1)
+    for engine in args.engine:
+        asyncio.run(benchmark(paths, engine, args.splitonheadings and engine == "fast"))
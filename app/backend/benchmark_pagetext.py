@@ -0,0 +1,157 @@
+import argparse
+import logging
+import time
+from functools import partial
+from typing import Callable, List, Tuple
+
+from azure.ai.documentintelligence.models import (
+    AnalyzeResult,
+    BoundingRegion,
+    DocumentFigure,
+    DocumentPage,
+    DocumentSpan,
+    DocumentTable,
+    DocumentTableCell,
+)
+from rich.logging import RichHandler
+
+from prepdocslib.pdfparser import DocumentAnalysisParser
+
+logger = logging.getLogger("scripts")
+
+PageObjects = List[Tuple[List[DocumentSpan], Callable[[], str]]]
+
+
+def synthetic_analyze_result(page_count: int, page_chars: int, tables: int, figures: int) -> AnalyzeResult:
+    """
+    Builds an analysis result with pages of page_chars characters, each with the given number of tables and figures.
+    Every object covers two spans of its own part of the page, and each figure also overlaps the table before it,
+    like figures detected inside tables.
+    """
+    content = "".join(f"Text of page {page_number}. ".ljust(page_chars, "x") for page_number in range(page_count))
+    pages = []
+    document_tables = []
+    document_figures = []
+    object_count = tables + figures
+    object_chars = page_chars // (2 * object_count + 1) if object_count else 0
+    for page_number in range(1, page_count + 1):
+        page_offset = (page_number - 1) * page_chars
+        pages.append(DocumentPage(page_number=page_number, spans=[DocumentSpan(offset=page_offset, length=page_chars)]))
+        regions = [BoundingRegion(page_number=page_number, polygon=[0, 0, 1, 0, 1, 1, 0, 1])]
+        for object_idx in range(object_count):
+            start = page_offset + (2 * object_idx + 1) * object_chars
+            half = object_chars // 2
+            spans = [DocumentSpan(offset=start, length=half), DocumentSpan(offset=start + half, length=half)]
+            if object_idx < tables:
+                cells = [
+                    DocumentTableCell(row_index=row, column_index=column, content=f"Cell {row}-{column}", spans=[])
+                    for row in range(2)
+                    for column in range(2)
+                ]
+                document_tables.append(
+                    DocumentTable(row_count=2, column_count=2, cells=cells, bounding_regions=regions, spans=spans)
+                )
+            else:
+                spans.insert(0, DocumentSpan(offset=start - half, length=half))
+                document_figures.append(
+                    DocumentFigure(id=f"{page_number}.{object_idx}", bounding_regions=regions, spans=spans)
+                )
+    return AnalyzeResult(
+        api_version="2024-11-30",
+        model_id="prebuilt-layout",
+        string_index_type="textElements",
+        content=content,
+        pages=pages,
+        tables=document_tables,
+        figures=document_figures,
+    )
+
+
+def page_objects(analyze_result: AnalyzeResult) -> List[PageObjects]:
+    """Returns the tables and figures of each page, the way DocumentAnalysisParser.result_to_pages lists them"""
+    objects: List[PageObjects] = []
+    for page in analyze_result.pages:
+        objects_on_page: PageObjects = [
+            (table.spans, partial(DocumentAnalysisParser.table_to_html, table))
+            for table in analyze_result.tables or []
+            if table.bounding_regions and table.bounding_regions[0].page_number == page.page_number
+        ]
+        objects_on_page.extend(
+            (figure.spans, partial(str, f"<figure><figcaption>{figure.id}</figcaption></figure>"))
+            for figure in analyze_result.figures or []
+            if figure.bounding_regions and figure.bounding_regions[0].page_number == page.page_number
+        )
+        objects.append(objects_on_page)
+    return objects
+
+
+def per_character_page_text(content: str, page_span: DocumentSpan, objects: PageObjects) -> str:
+    """The text of a page built one character at a time, the way pages were built before page_text"""
+    page_offset = page_span.offset
+    page_length = page_span.length
+    mask_chars: List[int] = [-1] * page_length
+    for object_idx, (spans, _) in enumerate(objects):
+        for span in spans:
+            for i in range(span.length):
+                idx = span.offset - page_offset + i
+                if idx >= 0 and idx < page_length:
+                    mask_chars[idx] = object_idx
+    page_text = ""
+    added_objects = set()
+    for idx, object_idx in enumerate(mask_chars):
+        if object_idx == -1:
+            page_text += content[page_offset + idx]
+        elif object_idx not in added_objects:
+            page_text += objects[object_idx][1]()
+            added_objects.add(object_idx)
+    return page_text
+
+
+def benchmark(
+    name: str,
+    build_page_text: Callable[[str, DocumentSpan, PageObjects], str],
+    analyze_result: AnalyzeResult,
+    objects: List[PageObjects],
+    repeat: int,
+) -> List[str]:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        texts = [
+            build_page_text(analyze_result.content, page.spans[0], objects_on_page)
+            for page, objects_on_page in zip(analyze_result.pages, objects)
+        ]
+    elapsed = time.perf_counter() - start
+    page_count = len(analyze_result.pages) * repeat
+    print(f"{name:>13}: {page_count} pages in {elapsed:.2f}s, {page_count / elapsed:.1f} pages/sec")
+    return texts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the interval sweep of DocumentAnalysisParser.page_text with the per-character loop it replaced, on a synthetic analysis result."
+    )
+    parser.add_argument("--pages", type=int, default=100, help="Number of pages of the synthetic document")
+    parser.add_argument("--pagechars", type=int, default=5000, help="Number of characters of each page")
+    parser.add_argument("--tables", type=int, default=4, help="Number of tables on each page")
+    parser.add_argument("--figures", type=int, default=2, help="Number of figures on each page")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of times the pages are built")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(format="%(message)s", datefmt="[%X]", handlers=[RichHandler(rich_tracebacks=True)])
+        logger.setLevel(logging.INFO)
+
+    analyze_result = synthetic_analyze_result(args.pages, args.pagechars, args.tables, args.figures)
+    objects = page_objects(analyze_result)
+    logger.info(
+        "Built %d pages with %d tables and %d figures",
+        len(analyze_result.pages),
+        len(analyze_result.tables or []),
+        len(analyze_result.figures or []),
+    )
+    per_character_texts = benchmark("per-character", per_character_page_text, analyze_result, objects, args.repeat)
+    interval_texts = benchmark("interval", DocumentAnalysisParser.page_text, analyze_result, objects, args.repeat)
+    if interval_texts != per_character_texts:
+        logger.error("The page texts built by both methods differ")
+        exit(1)
@@ -0,0 +1,63 @@
+import argparse
+import asyncio
+import glob
+import logging
+import os
+import time
+from typing import List
+
+from rich.logging import RichHandler
+
+from prepdocslib.pdfparser import LocalPdfParser
+
+logger = logging.getLogger("scripts")
+
+
+async def benchmark(paths: List[str], backend: str, max_workers: int) -> None:
+    parser = LocalPdfParser(backend=backend, max_workers=max_workers)
+    page_count = 0
+    character_count = 0
+    start = time.perf_counter()
+    for path in paths:
+        with open(path, "rb") as content:
+            async for page in parser.parse(content):
+                page_count += 1
+                character_count += len(page.text)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{backend:>8}: {page_count} pages ({character_count} characters) in {elapsed:.2f}s, "
+        f"{page_count / elapsed:.1f} pages/sec"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the speed of the local PDF parser backends, to pick one for ingestion without Azure Document Intelligence."
+    )
+    parser.add_argument("files", nargs="?", default="data/*.pdf", help="Glob pattern of the PDFs to parse")
+    parser.add_argument(
+        "--backend",
+        nargs="+",
+        choices=LocalPdfParser.BACKENDS,
+        default=list(LocalPdfParser.BACKENDS),
+        help="Backends to benchmark",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of worker processes used to extract the pages of large documents",
+    )
+    parser.add_argument("--verbose", "-v", action="store_true", help="Verbose output")
+    args = parser.parse_args()
+
+    if args.verbose:
+        logging.basicConfig(format="%(message)s", datefmt="[%X]", handlers=[RichHandler(rich_tracebacks=True)])
+        logger.setLevel(logging.INFO)
+
+    paths = sorted(glob.glob(args.files))
+    if not paths:
+        logger.error("No files match %s", args.files)
+        exit(1)
+    for backend in args.backend:
+        asyncio.run(benchmark(paths, backend, args.workers))
@@ -14,6 +14,9 @@ CONFIG_VECTOR_SEARCH_ENABLED = "vector_search_enabled"
 CONFIG_SEARCH_CLIENT = "search_client"
 CONFIG_OPENAI_CLIENT = "openai_client"
 CONFIG_INGESTER = "ingester"
+CONFIG_UPLOAD_QUEUE = "upload_queue"
+CONFIG_UPLOAD_LISTING_CACHE = "upload_listing_cache"
+CONFIG_USER_UPLOAD_MAX_FILE_SIZE = "user_upload_max_file_size"
 CONFIG_LANGUAGE_PICKER_ENABLED = "language_picker_enabled"
 CONFIG_SPEECH_INPUT_ENABLED = "speech_input_enabled"
 CONFIG_SPEECH_OUTPUT_BROWSER_ENABLED = "speech_output_browser_enabled"
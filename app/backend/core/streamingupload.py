@@ -0,0 +1,109 @@
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+from dataclasses import dataclass
+from typing import AsyncIterable, Callable, Dict, Optional
+
+from azure.storage.filedatalake.aio import DataLakeFileClient
+from werkzeug.sansio.multipart import Data, Epilogue, File, MultipartDecoder, NeedData
+
+# Bytes of the file sent to the storage account in each append request, which bounds the memory used by an upload
+UPLOAD_APPEND_SIZE = 4 * 1024 * 1024
+# Form fields other than files are small, and don't need more memory than that
+MAX_FORM_FIELD_SIZE = 64 * 1024
+
+
+class UploadTooLargeError(ValueError):
+    pass
+
+
+@dataclass
+class StreamedUpload:
+    """A file streamed from a multipart request to a data lake storage account, with a local copy for ingestion"""
+
+    filename: str
+    url: str
+    local_path: str
+    size: int
+    sha256: str
+
+
+async def stream_multipart_upload(
+    body: AsyncIterable[bytes],
+    boundary: bytes,
+    field_name: str,
+    get_file_client: Callable[[str], DataLakeFileClient],
+    metadata: Dict[str, str],
+    max_size: Optional[int] = None,
+) -> Optional[StreamedUpload]:
+    """
+    Streams the first file of a multipart/form-data request body to a data lake storage account as the body is received,
+    using append and flush requests of up to UPLOAD_APPEND_SIZE bytes, while hashing the file and writing it to
+    a temporary file named like the uploaded file, in its own temporary directory.
+    Returns None if the body has no file in the field_name field. Otherwise, the caller owns the temporary directory.
+    Raises UploadTooLargeError, after deleting what was written, if the file is larger than max_size bytes.
+    """
+    decoder = MultipartDecoder(boundary, max_form_memory_size=MAX_FORM_FIELD_SIZE)
+    file_client: Optional[DataLakeFileClient] = None
+    filename: Optional[str] = None
+    temp_dir: Optional[str] = None
+    local_file = None
+    hasher = hashlib.sha256()
+    pending = bytearray()
+    offset = 0
+    in_file = False
+    upload: Optional[StreamedUpload] = None
+
+    async def append(data: bytes):
+        nonlocal offset
+        assert file_client is not None
+        await file_client.append_data(data, offset=offset, length=len(data))
+        offset += len(data)
+
+    try:
+        async for chunk in body:
+            decoder.receive_data(chunk)
+            while not isinstance(event := decoder.next_event(), NeedData):
+                if isinstance(event, File) and event.name == field_name and filename is None:
+                    filename = event.filename
+                    file_client = get_file_client(filename)
+                    # Creating the file replaces any file with the same name
+                    await file_client.create_file(metadata=metadata)
+                    temp_dir = tempfile.mkdtemp(prefix="upload-")
+                    local_file = open(os.path.join(temp_dir, os.path.basename(filename)), "wb")
+                    in_file = True
+                elif isinstance(event, Data) and in_file:
+                    assert local_file is not None and file_client is not None and filename is not None
+                    if max_size is not None and offset + len(pending) + len(event.data) > max_size:
+                        raise UploadTooLargeError(f"{filename} is larger than the limit of {max_size} bytes")
+                    hasher.update(event.data)
+                    local_file.write(event.data)
+                    pending += event.data
+                    if len(pending) >= UPLOAD_APPEND_SIZE or not event.more_data:
+                        if pending:
+                            await append(bytes(pending))
+                            pending.clear()
+                    if not event.more_data:
+                        in_file = False
+                        await file_client.flush_data(offset)
+                        local_file.close()
+                        upload = StreamedUpload(filename, file_client.url, local_file.name, offset, hasher.hexdigest())
+                elif isinstance(event, Epilogue):
+                    break
+        if upload is None and file_client is not None:
+            raise ValueError(f"The request body ended before the end of {filename}")
+        return upload
+    except BaseException:
+        if local_file is not None:
+            local_file.close()
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        if file_client is not None and upload is None:
+            # Don't leave a partial file behind
+            try:
+                await file_client.delete_file()
+            except Exception:
+                logging.exception("Unable to delete the partial upload of %s", filename)
+        raise
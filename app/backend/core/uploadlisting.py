@@ -0,0 +1,106 @@
+import base64
+import bisect
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.filedatalake.aio import FileSystemClient
+
+from prepdocslib.uploadqueue import UploadJobStore
+
+# Listings are also refreshed after this long, in case files were changed outside of the app
+LISTING_CACHE_SECONDS = 5 * 60
+MAX_CACHED_LISTINGS = 1000
+MAX_PAGE_SIZE = 1000
+
+
+@dataclass
+class CachedListing:
+    files: List[str]
+    version: int
+    expires: float
+
+
+async def list_user_files(file_system_client: FileSystemClient, user_oid: str, recursive: bool = True) -> List[str]:
+    """Returns the sorted paths of the files in the directory of a user, relative to that directory"""
+    files = []
+    try:
+        async for path in file_system_client.get_paths(path=user_oid, recursive=recursive):
+            if not path.is_directory:
+                files.append(path.name.split("/", 1)[1])
+    except ResourceNotFoundError as error:
+        # The directory is only created by the first upload of the user
+        if error.status_code != 404:
+            raise
+    return sorted(files)
+
+
+def encode_continuation_token(last_file: str) -> str:
+    return base64.urlsafe_b64encode(last_file.encode("utf-8")).decode("ascii")
+
+
+def decode_continuation_token(token: str) -> str:
+    try:
+        return base64.b64decode(token.encode("ascii"), altchars=b"-_", validate=True).decode("utf-8")
+    except ValueError:
+        raise ValueError("Invalid continuation token")
+
+
+def page_files(
+    files: List[str], page_size: int, continuation_token: Optional[str] = None
+) -> Tuple[List[str], Optional[str]]:
+    """
+    Returns a page of a sorted list of files, and the continuation token for the next page, if any.
+    Tokens hold the last file of the page, so pages stay consistent when files are added or removed meanwhile.
+    """
+    start = 0
+    if continuation_token:
+        start = bisect.bisect_right(files, decode_continuation_token(continuation_token))
+    page = files[start : start + page_size]
+    if start + page_size >= len(files):
+        return page, None
+    return page, encode_continuation_token(page[-1])
+
+
+class UploadListingCache:
+    """
+    Per-user cache of the files uploaded to the data lake storage account, so that showing the uploaded files
+    doesn't list the directory of the user every time. Uploads and deletes invalidate the listing of their user,
+    in every process that shares the UploadJobStore, and listings expire after LISTING_CACHE_SECONDS anyway.
+    """
+
+    def __init__(
+        self,
+        file_system_client: FileSystemClient,
+        store: UploadJobStore,
+        max_age: float = LISTING_CACHE_SECONDS,
+        max_listings: int = MAX_CACHED_LISTINGS,
+    ):
+        self.file_system_client = file_system_client
+        self.store = store
+        self.max_age = max_age
+        self.max_listings = max_listings
+        # Least recently used first
+        self.listings: OrderedDict[Tuple[str, bool], CachedListing] = OrderedDict()
+
+    async def list(self, user_oid: str, recursive: bool = True) -> List[str]:
+        key = (user_oid, recursive)
+        # Read before listing, so that a change made while listing invalidates the listing
+        version = await self.store.run(self.store.listing_version, user_oid)
+        listing = self.listings.get(key)
+        if listing is not None and listing.version == version and time.monotonic() < listing.expires:
+            self.listings.move_to_end(key)
+            return listing.files
+        files = await list_user_files(self.file_system_client, user_oid, recursive)
+        self.listings[key] = CachedListing(files, version, time.monotonic() + self.max_age)
+        self.listings.move_to_end(key)
+        while len(self.listings) > self.max_listings:
+            self.listings.popitem(last=False)
+        return files
+
+    async def invalidate(self, user_oid: str):
+        await self.store.run(self.store.change_listing_version, user_oid)
+        for recursive in (True, False):
+            self.listings.pop((user_oid, recursive), None)
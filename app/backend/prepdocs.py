@@ -12,28 +12,36 @@ from rich.logging import RichHandler
 from load_azd_env import load_azd_env
 from prepdocslib.blobmanager import BlobManager
 from prepdocslib.csvparser import CsvParser
+from prepdocslib.embeddingcache import EmbeddingCache
 from prepdocslib.embeddings import (
     AzureOpenAIEmbeddingService,
     ImageEmbeddings,
     OpenAIEmbeddingService,
 )
+from prepdocslib.figuredescriptioncache import FigureDescriptionCache
 from prepdocslib.fileprocessor import FileProcessor
 from prepdocslib.filestrategy import FileStrategy
 from prepdocslib.htmlparser import LocalHTMLParser
+from prepdocslib.ingestionmanifest import IngestionManifest
 from prepdocslib.integratedvectorizerstrategy import (
     IntegratedVectorizerStrategy,
 )
-from prepdocslib.jsonparser import JsonParser
+from prepdocslib.jsonparser import JsonLinesParser, JsonParser
 from prepdocslib.listfilestrategy import (
     ADLSGen2ListFileStrategy,
     ListFileStrategy,
     LocalListFileStrategy,
 )
+from prepdocslib.parsecache import ParseCache
 from prepdocslib.parser import Parser
 from prepdocslib.pdfparser import DocumentAnalysisParser, LocalPdfParser
 from prepdocslib.strategy import DocumentAction, SearchInfo, Strategy
 from prepdocslib.textparser import TextParser
-from prepdocslib.textsplitter import SentenceTextSplitter, SimpleTextSplitter
+from prepdocslib.textsplitter import (
+    RowTextSplitter,
+    SentenceTextSplitter,
+    SimpleTextSplitter,
+)
 
 logger = logging.getLogger("scripts")
 
@@ -87,6 +95,7 @@ def setup_list_file_strategy(
     datalake_filesystem: Union[str, None],
     datalake_path: Union[str, None],
     datalake_key: Union[str, None],
+    ingestion_manifest: Optional[IngestionManifest] = None,
 ):
     list_file_strategy: ListFileStrategy
     if datalake_storage_account:
@@ -102,7 +111,7 @@ def setup_list_file_strategy(
         )
     elif local_files:
         logger.info("Using local files: %s", local_files)
-        list_file_strategy = LocalListFileStrategy(path_pattern=local_files)
+        list_file_strategy = LocalListFileStrategy(path_pattern=local_files, manifest=ingestion_manifest)
     else:
         raise ValueError("Either local_files or datalake_storage_account must be provided.")
     return list_file_strategy
@@ -121,11 +130,23 @@ def setup_embeddings_service(
     openai_org: Union[str, None],
     disable_vectors: bool = False,
     disable_batch_vectors: bool = False,
+    max_concurrency: int = 4,
+    deployment_capacity: Optional[int] = None,
+    batch_max_size: Optional[int] = None,
+    batch_token_limit: Optional[int] = None,
 ):
     if disable_vectors:
         logger.info("Not setting up embeddings service")
         return None
 
+    # Azure OpenAI deployment capacity is expressed in units of 1000 tokens per minute,
+    # and each unit also allows 6 requests per minute
+    tokens_per_minute: Optional[int] = None
+    requests_per_minute: Optional[int] = None
+    if deployment_capacity:
+        tokens_per_minute = deployment_capacity * 1000
+        requests_per_minute = deployment_capacity * 6
+
     if openai_host != "openai":
         azure_open_ai_credential: Union[AsyncTokenCredential, AzureKeyCredential] = (
             azure_credential if openai_key is None else AzureKeyCredential(openai_key)
@@ -139,6 +160,11 @@ def setup_embeddings_service(
             open_ai_api_version=openai_api_version,
             credential=azure_open_ai_credential,
             disable_batch=disable_batch_vectors,
+            max_concurrency=max_concurrency,
+            tokens_per_minute=tokens_per_minute,
+            requests_per_minute=requests_per_minute,
+            batch_max_size=batch_max_size,
+            batch_token_limit=batch_token_limit,
         )
     else:
         if openai_key is None:
@@ -149,6 +175,11 @@ def setup_embeddings_service(
             credential=openai_key,
             organization=openai_org,
             disable_batch=disable_batch_vectors,
+            max_concurrency=max_concurrency,
+            tokens_per_minute=tokens_per_minute,
+            requests_per_minute=requests_per_minute,
+            batch_max_size=batch_max_size,
+            batch_token_limit=batch_token_limit,
         )
 
 
@@ -157,10 +188,17 @@ def setup_file_processors(
     document_intelligence_service: Union[str, None],
     document_intelligence_key: Union[str, None] = None,
     local_pdf_parser: bool = False,
+    local_pdf_parser_backend: str = "pypdf",
     local_html_parser: bool = False,
+    local_html_parser_engine: str = "beautifulsoup",
+    local_html_parser_split_on_headings: bool = False,
     search_images: bool = False,
     use_content_understanding: bool = False,
     content_understanding_endpoint: Union[str, None] = None,
+    document_intelligence_pages_per_shard: Optional[int] = None,
+    document_intelligence_concurrency: int = 4,
+    parse_cache: Optional[ParseCache] = None,
+    figure_description_cache: Optional[FigureDescriptionCache] = None,
 ):
     sentence_text_splitter = SentenceTextSplitter()
 
@@ -175,11 +213,15 @@ def setup_file_processors(
             credential=documentintelligence_creds,
             use_content_understanding=use_content_understanding,
             content_understanding_endpoint=content_understanding_endpoint,
+            pages_per_shard=document_intelligence_pages_per_shard,
+            max_concurrency=document_intelligence_concurrency,
+            parse_cache=parse_cache,
+            figure_description_cache=figure_description_cache,
         )
 
     pdf_parser: Optional[Parser] = None
     if local_pdf_parser or document_intelligence_service is None:
-        pdf_parser = LocalPdfParser()
+        pdf_parser = LocalPdfParser(backend=local_pdf_parser_backend)
     elif document_intelligence_service is not None:
         pdf_parser = doc_int_parser
     else:
@@ -187,7 +229,9 @@ def setup_file_processors(
 
     html_parser: Optional[Parser] = None
     if local_html_parser or document_intelligence_service is None:
-        html_parser = LocalHTMLParser()
+        html_parser = LocalHTMLParser(
+            engine=local_html_parser_engine, split_on_headings=local_html_parser_split_on_headings
+        )
     elif document_intelligence_service is not None:
         html_parser = doc_int_parser
     else:
@@ -196,9 +240,10 @@ def setup_file_processors(
     # These file formats can always be parsed:
     file_processors = {
         ".json": FileProcessor(JsonParser(), SimpleTextSplitter()),
+        ".jsonl": FileProcessor(JsonLinesParser(), SimpleTextSplitter()),
         ".md": FileProcessor(TextParser(), sentence_text_splitter),
         ".txt": FileProcessor(TextParser(), sentence_text_splitter),
-        ".csv": FileProcessor(CsvParser(), sentence_text_splitter),
+        ".csv": FileProcessor(CsvParser(max_rows_per_page=1000), RowTextSplitter()),
     }
     # These require either a Python package or Document Intelligence
     if pdf_parser is not None:
@@ -224,7 +269,10 @@ def setup_file_processors(
 
 
 def setup_image_embeddings_service(
-    azure_credential: AsyncTokenCredential, vision_endpoint: Union[str, None], search_images: bool
+    azure_credential: AsyncTokenCredential,
+    vision_endpoint: Union[str, None],
+    search_images: bool,
+    embedding_cache: Optional[EmbeddingCache] = None,
 ) -> Union[ImageEmbeddings, None]:
     image_embeddings_service: Optional[ImageEmbeddings] = None
     if search_images:
@@ -233,6 +281,7 @@ def setup_image_embeddings_service(
         image_embeddings_service = ImageEmbeddings(
             endpoint=vision_endpoint,
             token_provider=get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default"),
+            embedding_cache=embedding_cache,
         )
     return image_embeddings_service
 
@@ -259,6 +308,65 @@ if __name__ == "__main__":
     parser.add_argument(
         "--disablebatchvectors", action="store_true", help="Don't compute embeddings in batch for the sections"
     )
+    parser.add_argument(
+        "--embeddingconcurrency",
+        type=int,
+        default=4,
+        help="Maximum number of embedding requests sent to the OpenAI service at the same time",
+    )
+    parser.add_argument(
+        "--embeddingcache",
+        required=False,
+        help="Optional. Path of a local SQLite database used to cache embeddings, so that unchanged sections are not embedded again",
+    )
+    parser.add_argument(
+        "--embeddingcachemaxentries",
+        type=int,
+        required=False,
+        help="Optional. Evict the least recently used entries of the embedding cache beyond this number",
+    )
+    parser.add_argument(
+        "--embeddingcachemaxagedays",
+        type=float,
+        required=False,
+        help="Optional. Evict the entries of the embedding cache that were not used in this many days",
+    )
+    parser.add_argument(
+        "--vacuumembeddingcache",
+        action="store_true",
+        help="Evict entries from the embedding cache according to the eviction arguments, compact it and exit",
+    )
+    parser.add_argument(
+        "--parsecache",
+        required=False,
+        help="Optional. Path of a local SQLite database used to cache Azure Document Intelligence results, so that unchanged files are not analyzed again",
+    )
+    parser.add_argument(
+        "--parsecachemaxmb",
+        type=float,
+        required=False,
+        help="Optional. Evict the least recently used results of the parse cache at the end of the run, beyond this size in MB",
+    )
+    parser.add_argument(
+        "--refreshparsecache",
+        action="store_true",
+        help="Analyze all files again with Azure Document Intelligence, replacing their results in the parse cache",
+    )
+    parser.add_argument(
+        "--figuredescriptioncache",
+        required=False,
+        help="Optional. Path of a local SQLite database used to cache the descriptions of figures, so that figures seen in previous runs are not described again",
+    )
+    parser.add_argument(
+        "--manifest",
+        required=False,
+        help="Optional. Path of the SQLite database that records which local files were ingested. Defaults to .prepdocs/<index name>.manifest.sqlite",
+    )
+    parser.add_argument(
+        "--dryrun",
+        action="store_true",
+        help="Show which local files would be added, updated or removed from the index, without changing anything",
+    )
     parser.add_argument(
         "--remove",
         action="store_true",
@@ -284,6 +392,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "--datalakekey", required=False, help="Optional. Use this key when authenticating to Azure Data Lake Gen2"
     )
+    parser.add_argument(
+        "--documentintelligenceconcurrency",
+        type=int,
+        default=4,
+        help="Maximum number of analysis requests sent to the Azure Document Intelligence service at the same time",
+    )
     parser.add_argument(
         "--documentintelligencekey",
         required=False,
@@ -304,6 +418,31 @@ if __name__ == "__main__":
         # to avoid seeing the noisy INFO level logs from the Azure SDKs
         logger.setLevel(logging.DEBUG)
 
+    embedding_cache: Optional[EmbeddingCache] = None
+    if args.embeddingcache:
+        embedding_cache = EmbeddingCache(args.embeddingcache)
+        if args.embeddingcachemaxentries is not None or args.embeddingcachemaxagedays is not None:
+            embedding_cache.evict(max_entries=args.embeddingcachemaxentries, max_age_days=args.embeddingcachemaxagedays)
+        if args.vacuumembeddingcache:
+            embedding_cache.vacuum()
+            logger.info("Embedding cache %s has %d entries", args.embeddingcache, embedding_cache.count())
+            embedding_cache.close()
+            exit(0)
+    elif args.vacuumembeddingcache:
+        logger.error("--vacuumembeddingcache requires --embeddingcache")
+        exit(1)
+
+    parse_cache: Optional[ParseCache] = None
+    if args.parsecache:
+        parse_cache = ParseCache(args.parsecache, refresh=args.refreshparsecache)
+    elif args.refreshparsecache or args.parsecachemaxmb is not None:
+        logger.error("--refreshparsecache and --parsecachemaxmb require --parsecache")
+        exit(1)
+
+    figure_description_cache: Optional[FigureDescriptionCache] = None
+    if args.figuredescriptioncache:
+        figure_description_cache = FigureDescriptionCache(args.figuredescriptioncache)
+
     load_azd_env()
 
     if os.getenv("AZURE_PUBLIC_NETWORK_ACCESS") == "Disabled":
@@ -351,6 +490,9 @@ if __name__ == "__main__":
         search_images=use_gptvision,
         storage_key=clean_key_if_exists(args.storagekey),
     )
+    ingestion_manifest = IngestionManifest(
+        args.manifest or os.path.join(".prepdocs", f"{os.environ['AZURE_SEARCH_INDEX']}.manifest.sqlite")
+    )
     list_file_strategy = setup_list_file_strategy(
         azure_credential=azd_credential,
         local_files=args.files,
@@ -358,7 +500,20 @@ if __name__ == "__main__":
         datalake_filesystem=os.getenv("AZURE_ADLS_GEN2_FILESYSTEM"),
         datalake_path=os.getenv("AZURE_ADLS_GEN2_FILESYSTEM_PATH"),
         datalake_key=clean_key_if_exists(args.datalakekey),
+        ingestion_manifest=ingestion_manifest,
     )
+    if args.dryrun:
+        if not isinstance(list_file_strategy, LocalListFileStrategy):
+            logger.error("--dryrun is only supported for local files")
+            exit(1)
+        diff = loop.run_until_complete(list_file_strategy.diff())
+        for label, paths in (("Add", diff.added), ("Update", diff.changed), ("Remove", diff.removed)):
+            for path in paths:
+                print(f"{label}: {path}")
+        print(
+            f"{len(diff.added)} to add, {len(diff.changed)} to update, {len(diff.removed)} to remove, {len(diff.unchanged)} unchanged"
+        )
+        exit(0)
 
     openai_host = os.environ["OPENAI_HOST"]
     openai_key = None
@@ -384,6 +539,20 @@ if __name__ == "__main__":
         openai_org=os.getenv("OPENAI_ORGANIZATION"),
         disable_vectors=dont_use_vectors,
         disable_batch_vectors=args.disablebatchvectors,
+        max_concurrency=args.embeddingconcurrency,
+        deployment_capacity=(
+            int(os.environ["AZURE_OPENAI_EMB_DEPLOYMENT_CAPACITY"])
+            if os.getenv("AZURE_OPENAI_EMB_DEPLOYMENT_CAPACITY")
+            else None
+        ),
+        batch_max_size=(
+            int(os.environ["AZURE_OPENAI_EMB_BATCH_SIZE"]) if os.getenv("AZURE_OPENAI_EMB_BATCH_SIZE") else None
+        ),
+        batch_token_limit=(
+            int(os.environ["AZURE_OPENAI_EMB_BATCH_TOKEN_LIMIT"])
+            if os.getenv("AZURE_OPENAI_EMB_BATCH_TOKEN_LIMIT")
+            else None
+        ),
     )
 
     ingestion_strategy: Strategy
@@ -410,15 +579,27 @@ if __name__ == "__main__":
             document_intelligence_service=os.getenv("AZURE_DOCUMENTINTELLIGENCE_SERVICE"),
             document_intelligence_key=clean_key_if_exists(args.documentintelligencekey),
             local_pdf_parser=os.getenv("USE_LOCAL_PDF_PARSER") == "true",
+            local_pdf_parser_backend=os.getenv("LOCAL_PDF_PARSER_BACKEND") or "pypdf",
             local_html_parser=os.getenv("USE_LOCAL_HTML_PARSER") == "true",
+            local_html_parser_engine=os.getenv("LOCAL_HTML_PARSER_ENGINE") or "beautifulsoup",
+            local_html_parser_split_on_headings=os.getenv("LOCAL_HTML_PARSER_SPLIT_ON_HEADINGS") == "true",
             search_images=use_gptvision,
             use_content_understanding=use_content_understanding,
             content_understanding_endpoint=os.getenv("AZURE_CONTENTUNDERSTANDING_ENDPOINT"),
+            document_intelligence_pages_per_shard=(
+                int(os.environ["AZURE_DOCUMENTINTELLIGENCE_PAGES_PER_SHARD"])
+                if os.getenv("AZURE_DOCUMENTINTELLIGENCE_PAGES_PER_SHARD")
+                else None
+            ),
+            document_intelligence_concurrency=args.documentintelligenceconcurrency,
+            parse_cache=parse_cache,
+            figure_description_cache=figure_description_cache,
         )
         image_embeddings_service = setup_image_embeddings_service(
             azure_credential=azd_credential,
             vision_endpoint=os.getenv("AZURE_VISION_ENDPOINT"),
             search_images=use_gptvision,
+            embedding_cache=embedding_cache,
         )
 
         ingestion_strategy = FileStrategy(
@@ -434,7 +615,20 @@ if __name__ == "__main__":
             category=args.category,
             use_content_understanding=use_content_understanding,
             content_understanding_endpoint=os.getenv("AZURE_CONTENTUNDERSTANDING_ENDPOINT"),
+            embedding_cache=embedding_cache,
         )
 
     loop.run_until_complete(main(ingestion_strategy, setup_index=not args.remove and not args.removeall))
     loop.close()
+    ingestion_manifest.close()
+    if embedding_cache:
+        logger.info("Embedding cache hit rate: %.1f%%", embedding_cache.hit_rate() * 100)
+        embedding_cache.close()
+    if parse_cache:
+        logger.info("Parse cache hit rate: %.1f%%", parse_cache.hit_rate() * 100)
+        if args.parsecachemaxmb is not None:
+            parse_cache.evict(int(args.parsecachemaxmb * 1024 * 1024))
+        parse_cache.close()
+    if figure_description_cache:
+        logger.info("Figure description cache hit rate: %.1f%%", figure_description_cache.hit_rate() * 100)
+        figure_description_cache.close()
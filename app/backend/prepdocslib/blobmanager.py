@@ -1,9 +1,12 @@
+import asyncio
 import datetime
+import hashlib
 import io
 import logging
 import os
 import re
-from typing import List, Optional, Union
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple, Union
 
 import pymupdf
 from azure.core.credentials_async import AsyncTokenCredential
@@ -14,12 +17,55 @@ from azure.storage.blob import (
 )
 from azure.storage.blob.aio import BlobServiceClient, ContainerClient
 from PIL import Image, ImageDraw, ImageFont
-from pypdf import PdfReader
 
 from .listfilestrategy import File
 
 logger = logging.getLogger("scripts")
 
+PAGES_PER_RENDER_BATCH = 8
+# Refresh the user delegation key well before it expires, so the SAS URLs stay valid while the file is ingested
+USER_DELEGATION_KEY_MIN_VALIDITY = datetime.timedelta(hours=1)
+
+
+def load_label_font() -> Optional[ImageFont.FreeTypeFont]:
+    try:
+        return ImageFont.truetype("arial.ttf", 20)
+    except OSError:
+        try:
+            return ImageFont.truetype("/usr/share/fonts/truetype/freefont/FreeMono.ttf", 20)
+        except OSError:
+            logger.info("Unable to find arial.ttf or FreeMono.ttf, using default font")
+            return None
+
+
+def render_pdf_page_images(path: str, pages: List[int], blob_names: List[str]) -> List[bytes]:
+    """
+    Renders pages of a PDF as PNG images, with the blob name of each page written above it.
+    This is CPU bound, so it is meant to run in a worker process.
+    """
+    font = load_label_font()
+    images = []
+    with pymupdf.open(path) as doc:
+        for page_num, blob_name in zip(pages, blob_names):
+            pix = doc.load_page(page_num).get_pixmap()
+            original_img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)  # type: ignore
+
+            # Create a new image with additional space for text
+            text_height = 40  # Height of the text area
+            new_img = Image.new("RGB", (original_img.width, original_img.height + text_height), "white")
+
+            # Paste the original image onto the new image
+            new_img.paste(original_img, (0, text_height))
+
+            # Draw the text on the white area, 10 pixels from the top and left of the image
+            draw = ImageDraw.Draw(new_img)
+            draw.text((10, 10), f"SourceFileName:{blob_name}", font=font, fill="black")
+
+            output = io.BytesIO()
+            new_img.save(output, format="PNG")
+            images.append(output.getvalue())
+    return images
+
 
 class BlobManager:
     """
@@ -35,6 +81,8 @@ class BlobManager:
         resourceGroup: str,
         subscriptionId: str,
         store_page_images: bool = False,
+        max_image_upload_concurrency: int = 8,
+        max_render_workers: Optional[int] = None,
     ):
         self.endpoint = endpoint
         self.credential = credential
@@ -43,7 +91,10 @@ class BlobManager:
         self.store_page_images = store_page_images
         self.resourceGroup = resourceGroup
         self.subscriptionId = subscriptionId
+        self.max_image_upload_concurrency = max_image_upload_concurrency
+        self.max_render_workers = max_render_workers or os.cpu_count() or 1
         self.user_delegation_key: Optional[UserDelegationKey] = None
+        self.user_delegation_key_expiry: Optional[datetime.datetime] = None
 
     async def upload_blob(self, file: File) -> Optional[List[str]]:
         async with BlobServiceClient(
@@ -52,13 +103,14 @@ class BlobManager:
             if not await container_client.exists():
                 await container_client.create_container()
 
-            # Re-open and upload the original file
+            # Upload the original file from the content that was already opened, and possibly memory-mapped,
+            # which also hashes it if nothing read all of it before
             if file.url is None:
-                with open(file.content.name, "rb") as reopened_file:
-                    blob_name = BlobManager.blob_name_from_file_name(file.content.name)
-                    logger.info("Uploading blob for whole file -> %s", blob_name)
-                    blob_client = await container_client.upload_blob(blob_name, reopened_file, overwrite=True)
-                    file.url = blob_client.url
+                file.content.seek(0)
+                blob_name = BlobManager.blob_name_from_file_name(file.content.name)
+                logger.info("Uploading blob for whole file -> %s", blob_name)
+                blob_client = await container_client.upload_blob(blob_name, file.content, overwrite=True)
+                file.url = blob_client.url
 
             if self.store_page_images:
                 if os.path.splitext(file.content.name)[1].lower() == ".pdf":
@@ -71,72 +123,69 @@ class BlobManager:
     def get_managedidentity_connectionstring(self):
         return f"ResourceId=/subscriptions/{self.subscriptionId}/resourceGroups/{self.resourceGroup}/providers/Microsoft.Storage/storageAccounts/{self.account};"
 
+    async def get_user_delegation_key(self, service_client: BlobServiceClient) -> UserDelegationKey:
+        """Returns the cached user delegation key, or a new one if it is missing or about to expire"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if (
+            self.user_delegation_key is None
+            or self.user_delegation_key_expiry is None
+            or self.user_delegation_key_expiry - now < USER_DELEGATION_KEY_MIN_VALIDITY
+        ):
+            expiry_time = now + datetime.timedelta(days=1)
+            self.user_delegation_key = await service_client.get_user_delegation_key(now, expiry_time)
+            self.user_delegation_key_expiry = expiry_time
+        return self.user_delegation_key
+
     async def upload_pdf_blob_images(
         self, service_client: BlobServiceClient, container_client: ContainerClient, file: File
     ) -> List[str]:
-        with open(file.content.name, "rb") as reopened_file:
-            reader = PdfReader(reopened_file)
-            page_count = len(reader.pages)
-        doc = pymupdf.open(file.content.name)
-        sas_uris = []
+        with pymupdf.open(file.content.name) as doc:
+            page_count = doc.page_count
+        blob_names = [BlobManager.blob_image_name_from_file_page(file.content.name, i) for i in range(page_count)]
         start_time = datetime.datetime.now(datetime.timezone.utc)
-        expiry_time = start_time + datetime.timedelta(days=1)
-
-        font = None
-        try:
-            font = ImageFont.truetype("arial.ttf", 20)
-        except OSError:
-            try:
-                font = ImageFont.truetype("/usr/share/fonts/truetype/freefont/FreeMono.ttf", 20)
-            except OSError:
-                logger.info("Unable to find arial.ttf or FreeMono.ttf, using default font")
-
-        for i in range(page_count):
-            blob_name = BlobManager.blob_image_name_from_file_page(file.content.name, i)
-            logger.info("Converting page %s to image and uploading -> %s", i, blob_name)
-
-            doc = pymupdf.open(file.content.name)
-            page = doc.load_page(i)
-            pix = page.get_pixmap()
-            original_img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)  # type: ignore
-
-            # Create a new image with additional space for text
-            text_height = 40  # Height of the text area
-            new_img = Image.new("RGB", (original_img.width, original_img.height + text_height), "white")
-
-            # Paste the original image onto the new image
-            new_img.paste(original_img, (0, text_height))
-
-            # Draw the text on the white area
-            draw = ImageDraw.Draw(new_img)
-            text = f"SourceFileName:{blob_name}"
-
-            # 10 pixels from the top and left of the image
-            x = 10
-            y = 10
-            draw.text((x, y), text, font=font, fill="black")
-
-            output = io.BytesIO()
-            new_img.save(output, format="PNG")
-            output.seek(0)
-
-            blob_client = await container_client.upload_blob(blob_name, output, overwrite=True)
-            if not self.user_delegation_key:
-                self.user_delegation_key = await service_client.get_user_delegation_key(start_time, expiry_time)
-
-            if blob_client.account_name is not None:
-                sas_token = generate_blob_sas(
-                    account_name=blob_client.account_name,
-                    container_name=blob_client.container_name,
-                    blob_name=blob_client.blob_name,
-                    user_delegation_key=self.user_delegation_key,
-                    permission=BlobSasPermissions(read=True),
-                    expiry=expiry_time,
-                    start=start_time,
+        user_delegation_key = await self.get_user_delegation_key(service_client)
+        logger.info("Converting %d pages of %s to images and uploading them", page_count, file.content.name)
+
+        upload_limit = asyncio.Semaphore(self.max_image_upload_concurrency)
+
+        async def upload_page_image(blob_name: str, image: bytes) -> Optional[Tuple[str, str]]:
+            async with upload_limit:
+                blob_client = await container_client.upload_blob(blob_name, image, overwrite=True)
+            if blob_client.account_name is None:
+                return None
+            sas_token = generate_blob_sas(
+                account_name=blob_client.account_name,
+                container_name=blob_client.container_name,
+                blob_name=blob_client.blob_name,
+                user_delegation_key=user_delegation_key,
+                permission=BlobSasPermissions(read=True),
+                expiry=self.user_delegation_key_expiry,
+                start=start_time,
+            )
+            return f"{blob_client.url}?{sas_token}", hashlib.sha256(image).hexdigest()
+
+        # Pages are rendered in batches in worker processes, so that each worker only opens the document once per
+        # batch, and so that the pages of a batch can be uploaded while the next batches are rendered
+        page_batches = [
+            list(range(i, min(i + PAGES_PER_RENDER_BATCH, page_count)))
+            for i in range(0, page_count, PAGES_PER_RENDER_BATCH)
+        ]
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(max_workers=max(1, min(self.max_render_workers, len(page_batches)))) as executor:
+
+            async def render_and_upload(pages: List[int]) -> List[Optional[Tuple[str, str]]]:
+                images = await loop.run_in_executor(
+                    executor, render_pdf_page_images, file.content.name, pages, [blob_names[i] for i in pages]
                 )
-                sas_uris.append(f"{blob_client.url}?{sas_token}")
+                return await asyncio.gather(
+                    *(upload_page_image(blob_names[i], image) for i, image in zip(pages, images))
+                )
+
+            results = await asyncio.gather(*(render_and_upload(pages) for pages in page_batches))
 
-        return sas_uris
+        uploaded = [result for batch in results for result in batch if result is not None]
+        file.page_image_hashes = [image_hash for _, image_hash in uploaded]
+        return [sas_uri for sas_uri, _ in uploaded]
 
     async def remove_blob(self, path: Optional[str] = None):
         async with BlobServiceClient(
@@ -1,31 +1,59 @@
 import csv
-from typing import IO, AsyncGenerator
+import io
+from typing import IO, AsyncGenerator, List, Optional
 
 from .page import Page
 from .parser import Parser
 
+# Separates the rows of a page, since quoted cells can contain newlines. This is the ASCII record separator.
+ROW_SEPARATOR = "\x1e"
+
 
 class CsvParser(Parser):
     """
-    Concrete parser that can parse CSV into Page objects. Each row becomes a Page object.
+    Concrete parser that can parse CSV into Page objects. By default, each row becomes a Page object.
+    The file is read incrementally, and rows can be grouped into pages of up to max_rows_per_page rows
+    and max_page_length characters, with rows separated by ROW_SEPARATOR.
     """
 
+    def __init__(self, max_rows_per_page: int = 1, max_page_length: Optional[int] = None):
+        self.max_rows_per_page = max_rows_per_page
+        self.max_page_length = max_page_length
+
     async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
-        # Check if content is in bytes (binary file) and decode to string
-        content_str: str
+        # Check if content is in bytes (binary file) and wrap it in a stream
         if isinstance(content, (bytes, bytearray)):
-            content_str = content.decode("utf-8")
-        elif hasattr(content, "read"):  # Handle BufferedReader
-            content_str = content.read().decode("utf-8")
-
-        # Create a CSV reader from the text content
-        reader = csv.reader(content_str.splitlines())
-        offset = 0
+            content = io.BytesIO(content)
+        # Decode the file as it is read, instead of decoding all of it up front
+        text_stream = io.TextIOWrapper(content, encoding="utf-8", newline="")
+        try:
+            reader = csv.reader(text_stream)
+            offset = 0
+            page_num = 0
+            rows: List[str] = []
+            rows_length = 0
 
-        # Skip the header row
-        next(reader, None)
+            # Skip the header row
+            next(reader, None)
 
-        for i, row in enumerate(reader):
-            page_text = ",".join(row)
-            yield Page(i, offset, page_text)
-            offset += len(page_text) + 1  # Account for newline character
+            for row in reader:
+                row_text = ",".join(row)
+                if rows and (
+                    len(rows) >= self.max_rows_per_page
+                    or (
+                        self.max_page_length and rows_length + len(ROW_SEPARATOR) + len(row_text) > self.max_page_length
+                    )
+                ):
+                    page_text = ROW_SEPARATOR.join(rows)
+                    yield Page(page_num, offset, page_text)
+                    offset += len(page_text) + len(ROW_SEPARATOR)
+                    page_num += 1
+                    rows = []
+                    rows_length = 0
+                rows_length += len(row_text) + (len(ROW_SEPARATOR) if rows else 0)
+                rows.append(row_text)
+            if rows:
+                yield Page(page_num, offset, ROW_SEPARATOR.join(rows))
+        finally:
+            # Don't let the wrapper close the file when it's garbage collected
+            text_stream.detach()
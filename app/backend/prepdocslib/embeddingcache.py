@@ -0,0 +1,94 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from array import array
+from typing import Dict, List, Optional, Sequence
+
+logger = logging.getLogger("scripts")
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of text embeddings stored in a local SQLite database, so that re-ingesting a document
+    only computes embeddings for the chunks whose text changed.
+    Entries are keyed by the SHA-256 of the model name, the dimensions and the chunk text.
+    Embeddings are stored as float32, which is the precision of the vector fields in the search index.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if directory := os.path.dirname(path):
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model: str, dimensions: int, text: str) -> str:
+        return hashlib.sha256(f"{model}\n{dimensions}\n{text}".encode()).hexdigest()
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, List[float]]:
+        found: Dict[str, List[float]] = {}
+        unique_keys = list(dict.fromkeys(keys))
+        # Stay well under SQLite's limit on the number of query parameters
+        for i in range(0, len(unique_keys), 500):
+            chunk = unique_keys[i : i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT key, embedding FROM embeddings WHERE key IN ({placeholders})", chunk
+            ).fetchall()
+            for key, blob in rows:
+                found[key] = array("f", blob).tolist()
+        if found:
+            now = time.time()
+            self.connection.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, key) for key in found]
+            )
+            self.connection.commit()
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def set_many(self, embeddings: Dict[str, List[float]]):
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, embedding, last_used) VALUES (?, ?, ?)",
+            [(key, array("f", embedding).tobytes(), now) for key, embedding in embeddings.items()],
+        )
+        self.connection.commit()
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def count(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def evict(self, max_entries: Optional[int] = None, max_age_days: Optional[float] = None) -> int:
+        """Removes the least recently used entries beyond max_entries, and entries unused for max_age_days"""
+        removed = 0
+        if max_age_days is not None:
+            cutoff = time.time() - max_age_days * 24 * 60 * 60
+            removed += self.connection.execute("DELETE FROM embeddings WHERE last_used < ?", (cutoff,)).rowcount
+        if max_entries is not None:
+            removed += self.connection.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (max_entries,),
+            ).rowcount
+        self.connection.commit()
+        logger.info("Evicted %d entries from embedding cache %s", removed, self.path)
+        return removed
+
+    def vacuum(self):
+        self.connection.execute("VACUUM")
+
+    def close(self):
+        self.connection.close()
@@ -1,6 +1,7 @@
+import asyncio
 import logging
 from abc import ABC
-from typing import Awaitable, Callable, List, Optional, Union
+from typing import Awaitable, Callable, Dict, List, Mapping, Optional, Tuple, Union
 from urllib.parse import urljoin
 
 import aiohttp
@@ -8,7 +9,8 @@ import tiktoken
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.identity.aio import get_bearer_token_provider
-from openai import AsyncAzureOpenAI, AsyncOpenAI, RateLimitError
+from openai import AsyncAzureOpenAI, AsyncOpenAI, BadRequestError, RateLimitError
+from openai.types import CreateEmbeddingResponse
 from tenacity import (
     AsyncRetrying,
     retry_if_exception_type,
@@ -17,8 +19,23 @@ from tenacity import (
 )
 from typing_extensions import TypedDict
 
+from .embeddingcache import EmbeddingCache
+from .ratelimiter import AdaptiveRateLimiter, parse_retry_after
+
 logger = logging.getLogger("scripts")
 
+# Codes and messages of the 400 errors returned for batches with more inputs or tokens than the deployment accepts
+BATCH_LIMIT_ERROR_CODES = {"max_tokens_per_request"}
+BATCH_LIMIT_ERROR_MESSAGES = ("too many inputs", "tokens per request")
+
+
+def is_batch_limit_error(error: BadRequestError) -> bool:
+    """Returns whether a request was rejected for the size of its batch, so that smaller batches may succeed"""
+    if error.code in BATCH_LIMIT_ERROR_CODES:
+        return True
+    message = error.message.lower()
+    return any(limit_message in message for limit_message in BATCH_LIMIT_ERROR_MESSAGES)
+
 
 class EmbeddingBatch:
     """
@@ -37,7 +54,11 @@ class ExtraArgs(TypedDict, total=False):
 class OpenAIEmbeddings(ABC):
     """
     Contains common logic across both OpenAI and Azure OpenAI embedding services
-    Can split source text into batches for more efficient embedding calls
+    Can split source text into batches for more efficient embedding calls, and sends up to max_concurrency
+    batches at once while staying under the deployment's tokens and requests per minute quota
+    Batch limits default to SUPPORTED_BATCH_AOAI_MODEL, but can be set per deployment with batch_max_size and
+    batch_token_limit, which also enables batching for custom or local OpenAI-compatible models.
+    If the service rejects a batch, the batch size is halved until requests are accepted.
     """
 
     SUPPORTED_BATCH_AOAI_MODEL = {
@@ -50,31 +71,79 @@ class OpenAIEmbeddings(ABC):
         "text-embedding-3-small": True,
         "text-embedding-3-large": True,
     }
+    DEFAULT_BATCH_TOKEN_LIMIT = 8100
+    # Used to count tokens for models that tiktoken doesn't know about, like custom or local models
+    DEFAULT_ENCODING = "cl100k_base"
 
-    def __init__(self, open_ai_model_name: str, open_ai_dimensions: int, disable_batch: bool = False):
+    def __init__(
+        self,
+        open_ai_model_name: str,
+        open_ai_dimensions: int,
+        disable_batch: bool = False,
+        max_concurrency: int = 4,
+        tokens_per_minute: Optional[int] = None,
+        requests_per_minute: Optional[int] = None,
+        batch_max_size: Optional[int] = None,
+        batch_token_limit: Optional[int] = None,
+    ):
         self.open_ai_model_name = open_ai_model_name
         self.open_ai_dimensions = open_ai_dimensions
         self.disable_batch = disable_batch
+        batch_info = OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL.get(open_ai_model_name, {})
+        self.batch_max_size = batch_max_size or batch_info.get("max_batch_size")
+        self.batch_token_limit = (
+            batch_token_limit or batch_info.get("token_limit") or OpenAIEmbeddings.DEFAULT_BATCH_TOKEN_LIMIT
+        )
+        self.rate_limiter = AdaptiveRateLimiter(
+            max_concurrency=max_concurrency,
+            tokens_per_minute=tokens_per_minute,
+            requests_per_minute=requests_per_minute,
+        )
+        self.client: Optional[AsyncOpenAI] = None
 
     async def create_client(self) -> AsyncOpenAI:
         raise NotImplementedError
 
+    async def get_client(self) -> AsyncOpenAI:
+        # The client holds a connection pool, so it is created once and reused across calls
+        if self.client is None:
+            self.client = await self.create_client()
+        return self.client
+
     def before_retry_sleep(self, retry_state):
         logger.info("Rate limited on the OpenAI embeddings API, sleeping before retrying...")
 
     def calculate_token_length(self, text: str):
-        encoding = tiktoken.encoding_for_model(self.open_ai_model_name)
+        try:
+            encoding = tiktoken.encoding_for_model(self.open_ai_model_name)
+        except KeyError:
+            encoding = tiktoken.get_encoding(OpenAIEmbeddings.DEFAULT_ENCODING)
         return len(encoding.encode(text))
 
+    def supports_batch(self) -> bool:
+        return self.batch_max_size is not None
+
+    def reduce_batch_max_size(self, rejected_batch_size: int):
+        if self.batch_max_size is None or rejected_batch_size <= 1:
+            return
+        new_batch_max_size = max(1, min(self.batch_max_size, rejected_batch_size // 2))
+        if new_batch_max_size < self.batch_max_size:
+            logger.warning(
+                "Embedding batch of %d texts was rejected, reducing max batch size from %d to %d",
+                rejected_batch_size,
+                self.batch_max_size,
+                new_batch_max_size,
+            )
+            self.batch_max_size = new_batch_max_size
+
     def split_text_into_batches(self, texts: List[str]) -> List[EmbeddingBatch]:
-        batch_info = OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL.get(self.open_ai_model_name)
-        if not batch_info:
+        if not self.supports_batch():
             raise NotImplementedError(
                 f"Model {self.open_ai_model_name} is not supported with batch embedding operations"
             )
 
-        batch_token_limit = batch_info["token_limit"]
-        batch_max_size = batch_info["max_batch_size"]
+        batch_token_limit = self.batch_token_limit
+        batch_max_size = self.batch_max_size
         batches: List[EmbeddingBatch] = []
         batch: List[str] = []
         batch_token_length = 0
@@ -97,44 +166,69 @@ class OpenAIEmbeddings(ABC):
 
         return batches
 
-    async def create_embedding_batch(self, texts: List[str], dimensions_args: ExtraArgs) -> List[List[float]]:
-        batches = self.split_text_into_batches(texts)
-        embeddings = []
-        client = await self.create_client()
-        for batch in batches:
-            async for attempt in AsyncRetrying(
-                retry=retry_if_exception_type(RateLimitError),
-                wait=wait_random_exponential(min=15, max=60),
-                stop=stop_after_attempt(15),
-                before_sleep=self.before_retry_sleep,
-            ):
-                with attempt:
-                    emb_response = await client.embeddings.create(
-                        model=self.open_ai_model_name, input=batch.texts, **dimensions_args
-                    )
-                    embeddings.extend([data.embedding for data in emb_response.data])
-                    logger.info(
-                        "Computed embeddings in batch. Batch size: %d, Token count: %d",
-                        len(batch.texts),
-                        batch.token_length,
-                    )
-
-        return embeddings
+    async def send_embedding_request(
+        self, client: AsyncOpenAI, input: Union[str, List[str]], dimensions_args: ExtraArgs
+    ) -> Tuple[CreateEmbeddingResponse, Mapping[str, str]]:
+        # The raw response exposes the x-ratelimit-* headers used by the rate limiter
+        raw_response = await client.embeddings.with_raw_response.create(
+            model=self.open_ai_model_name, input=input, **dimensions_args
+        )
+        return raw_response.parse(), raw_response.headers
 
-    async def create_embedding_single(self, text: str, dimensions_args: ExtraArgs) -> List[float]:
-        client = await self.create_client()
+    async def create_embedding_with_retry(
+        self, client: AsyncOpenAI, input: Union[str, List[str]], token_length: int, dimensions_args: ExtraArgs
+    ) -> CreateEmbeddingResponse:
         async for attempt in AsyncRetrying(
             retry=retry_if_exception_type(RateLimitError),
-            wait=wait_random_exponential(min=15, max=60),
+            wait=wait_random_exponential(min=1, max=60),
             stop=stop_after_attempt(15),
             before_sleep=self.before_retry_sleep,
         ):
             with attempt:
-                emb_response = await client.embeddings.create(
-                    model=self.open_ai_model_name, input=text, **dimensions_args
+                async with self.rate_limiter.limit(token_length):
+                    try:
+                        emb_response, headers = await self.send_embedding_request(client, input, dimensions_args)
+                    except RateLimitError as error:
+                        self.rate_limiter.on_rate_limited(error.response.headers)
+                        raise
+                    self.rate_limiter.on_success(headers)
+        return emb_response
+
+    async def create_embedding_batch(self, texts: List[str], dimensions_args: ExtraArgs) -> List[List[float]]:
+        batches = self.split_text_into_batches(texts)
+        client = await self.get_client()
+
+        async def embed_batch(batch: EmbeddingBatch) -> List[List[float]]:
+            try:
+                emb_response = await self.create_embedding_with_retry(
+                    client, batch.texts, batch.token_length, dimensions_args
                 )
-                logger.info("Computed embedding for text section. Character count: %d", len(text))
+            except BadRequestError as error:
+                # The batch may be larger than the deployment accepts, so retry it in smaller batches
+                if len(batch.texts) <= 1 or not is_batch_limit_error(error):
+                    raise
+                # After this, the max batch size is at most half of the rejected batch
+                self.reduce_batch_max_size(len(batch.texts))
+                smaller_batches = self.split_text_into_batches(batch.texts)
+                smaller_embeddings = await asyncio.gather(*(embed_batch(b) for b in smaller_batches))
+                return [embedding for embeddings in smaller_embeddings for embedding in embeddings]
+            logger.info(
+                "Computed embeddings in batch. Batch size: %d, Token count: %d",
+                len(batch.texts),
+                batch.token_length,
+            )
+            return [data.embedding for data in emb_response.data]
 
+        # gather() returns results in the order of the batches, regardless of which request finishes first
+        batch_embeddings = await asyncio.gather(*(embed_batch(batch) for batch in batches))
+        return [embedding for embeddings in batch_embeddings for embedding in embeddings]
+
+    async def create_embedding_single(self, text: str, dimensions_args: ExtraArgs) -> List[float]:
+        client = await self.get_client()
+        # Only count tokens when a TPM quota is configured, as tiktoken may not know custom models
+        token_length = self.calculate_token_length(text) if self.rate_limiter.token_bucket else 0
+        emb_response = await self.create_embedding_with_retry(client, text, token_length, dimensions_args)
+        logger.info("Computed embedding for text section. Character count: %d", len(text))
         return emb_response.data[0].embedding
 
     async def create_embeddings(self, texts: List[str]) -> List[List[float]]:
@@ -145,10 +239,10 @@ class OpenAIEmbeddings(ABC):
             else {}
         )
 
-        if not self.disable_batch and self.open_ai_model_name in OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL:
+        if not self.disable_batch and self.supports_batch():
             return await self.create_embedding_batch(texts, dimensions_args)
 
-        return [await self.create_embedding_single(text, dimensions_args) for text in texts]
+        return list(await asyncio.gather(*(self.create_embedding_single(text, dimensions_args) for text in texts)))
 
 
 class AzureOpenAIEmbeddingService(OpenAIEmbeddings):
@@ -167,8 +261,22 @@ class AzureOpenAIEmbeddingService(OpenAIEmbeddings):
         credential: Union[AsyncTokenCredential, AzureKeyCredential],
         open_ai_custom_url: Union[str, None] = None,
         disable_batch: bool = False,
+        max_concurrency: int = 4,
+        tokens_per_minute: Optional[int] = None,
+        requests_per_minute: Optional[int] = None,
+        batch_max_size: Optional[int] = None,
+        batch_token_limit: Optional[int] = None,
     ):
-        super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch)
+        super().__init__(
+            open_ai_model_name,
+            open_ai_dimensions,
+            disable_batch,
+            max_concurrency=max_concurrency,
+            tokens_per_minute=tokens_per_minute,
+            requests_per_minute=requests_per_minute,
+            batch_max_size=batch_max_size,
+            batch_token_limit=batch_token_limit,
+        )
         self.open_ai_service = open_ai_service
         if open_ai_service:
             self.open_ai_endpoint = f"https://{open_ai_service}.openai.azure.com"
@@ -216,8 +324,22 @@ class OpenAIEmbeddingService(OpenAIEmbeddings):
         credential: str,
         organization: Optional[str] = None,
         disable_batch: bool = False,
+        max_concurrency: int = 4,
+        tokens_per_minute: Optional[int] = None,
+        requests_per_minute: Optional[int] = None,
+        batch_max_size: Optional[int] = None,
+        batch_token_limit: Optional[int] = None,
     ):
-        super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch)
+        super().__init__(
+            open_ai_model_name,
+            open_ai_dimensions,
+            disable_batch,
+            max_concurrency=max_concurrency,
+            tokens_per_minute=tokens_per_minute,
+            requests_per_minute=requests_per_minute,
+            batch_max_size=batch_max_size,
+            batch_token_limit=batch_token_limit,
+        )
         self.credential = credential
         self.organization = organization
 
@@ -225,38 +347,101 @@ class OpenAIEmbeddingService(OpenAIEmbeddings):
         return AsyncOpenAI(api_key=self.credential, organization=self.organization)
 
 
+class ImageEmbeddingsRetryableError(Exception):
+    """
+    Raised when the Vision embeddings API returns a status code that is worth retrying
+    """
+
+    def __init__(self, status: int, retry_after: Optional[float] = None):
+        super().__init__(f"Vision embeddings API returned status {status}")
+        self.status = status
+        self.retry_after = retry_after
+
+
 class ImageEmbeddings:
     """
     Class for using image embeddings from Azure AI Vision
     To learn more, please visit https://learn.microsoft.com/azure/ai-services/computer-vision/how-to/image-retrieval#call-the-vectorize-image-api
+    Images are vectorized concurrently, and when a cache is given, images are looked up by the hash of their content
+    so that unchanged page images are not vectorized again.
     """
 
-    def __init__(self, endpoint: str, token_provider: Callable[[], Awaitable[str]]):
+    MODEL_NAME = "azure-ai-vision-latest"
+    DIMENSIONS = 1024
+    RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+    def __init__(
+        self,
+        endpoint: str,
+        token_provider: Callable[[], Awaitable[str]],
+        max_concurrency: int = 8,
+        embedding_cache: Optional[EmbeddingCache] = None,
+    ):
         self.token_provider = token_provider
         self.endpoint = endpoint
+        self.max_concurrency = max_concurrency
+        self.embedding_cache = embedding_cache
+
+    async def create_embeddings(
+        self, blob_urls: List[str], image_hashes: Optional[List[str]] = None
+    ) -> List[List[float]]:
+        """Returns the embedding of each image, in the same order as the URLs"""
+        embeddings: Dict[int, List[float]] = {}
+        keys: Dict[int, str] = {}
+        if self.embedding_cache and image_hashes:
+            keys = {
+                i: EmbeddingCache.key(self.MODEL_NAME, self.DIMENSIONS, image_hash)
+                for i, image_hash in enumerate(image_hashes)
+            }
+            cached = self.embedding_cache.get_many(list(keys.values()))
+            embeddings = {i: cached[key] for i, key in keys.items() if key in cached}
+        missing = [i for i in range(len(blob_urls)) if i not in embeddings]
+        if missing:
+            endpoint = urljoin(self.endpoint, "computervision/retrieval:vectorizeImage")
+            headers = {"Content-Type": "application/json", "Authorization": "Bearer " + await self.token_provider()}
+            limit = asyncio.Semaphore(self.max_concurrency)
+
+            async def vectorize(i: int):
+                async with limit:
+                    embeddings[i] = await self.vectorize_image_with_retry(session, endpoint, blob_urls[i])
+
+            # A single session is shared by all the requests, so that connections are reused
+            async with aiohttp.ClientSession(headers=headers) as session:
+                await asyncio.gather(*(vectorize(i) for i in missing))
+            if self.embedding_cache and keys:
+                self.embedding_cache.set_many({keys[i]: embeddings[i] for i in missing})
+        return [embeddings[i] for i in range(len(blob_urls))]
+
+    async def vectorize_image_with_retry(
+        self, session: aiohttp.ClientSession, endpoint: str, blob_url: str
+    ) -> List[float]:
+        async for attempt in AsyncRetrying(
+            retry=retry_if_exception_type((ImageEmbeddingsRetryableError, aiohttp.ClientConnectionError)),
+            wait=self.retry_wait,
+            stop=stop_after_attempt(15),
+            before_sleep=self.before_retry_sleep,
+        ):
+            with attempt:
+                return await self.vectorize_image(session, endpoint, blob_url)
+        raise RuntimeError("Unreachable")  # pragma: no cover
 
-    async def create_embeddings(self, blob_urls: List[str]) -> List[List[float]]:
-        endpoint = urljoin(self.endpoint, "computervision/retrieval:vectorizeImage")
-        headers = {"Content-Type": "application/json"}
+    async def vectorize_image(self, session: aiohttp.ClientSession, endpoint: str, blob_url: str) -> List[float]:
         params = {"api-version": "2023-02-01-preview", "modelVersion": "latest"}
-        headers["Authorization"] = "Bearer " + await self.token_provider()
-
-        embeddings: List[List[float]] = []
-        async with aiohttp.ClientSession(headers=headers) as session:
-            for blob_url in blob_urls:
-                async for attempt in AsyncRetrying(
-                    retry=retry_if_exception_type(Exception),
-                    wait=wait_random_exponential(min=15, max=60),
-                    stop=stop_after_attempt(15),
-                    before_sleep=self.before_retry_sleep,
-                ):
-                    with attempt:
-                        body = {"url": blob_url}
-                        async with session.post(url=endpoint, params=params, json=body) as resp:
-                            resp_json = await resp.json()
-                            embeddings.append(resp_json["vector"])
-
-        return embeddings
+        async with session.post(url=endpoint, params=params, json={"url": blob_url}) as resp:
+            if resp.status in self.RETRYABLE_STATUSES:
+                raise ImageEmbeddingsRetryableError(resp.status, parse_retry_after(resp.headers))
+            if resp.status != 200:
+                raise ValueError(f"Vision embeddings API returned status {resp.status}: {await resp.text()}")
+            resp_json = await resp.json()
+            return resp_json["vector"]
+
+    @staticmethod
+    def retry_wait(retry_state) -> float:
+        # Honor the Retry-After header when the service sends one
+        exception = retry_state.outcome.exception() if retry_state.outcome else None
+        if isinstance(exception, ImageEmbeddingsRetryableError) and exception.retry_after is not None:
+            return exception.retry_after
+        return wait_random_exponential(min=1, max=60)(retry_state)
 
     def before_retry_sleep(self, retry_state):
         logger.info("Rate limited on the Vision embeddings API, sleeping before retrying...")
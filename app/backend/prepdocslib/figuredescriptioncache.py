@@ -0,0 +1,79 @@
+import logging
+import os
+import sqlite3
+import time
+from typing import Dict, Sequence
+
+logger = logging.getLogger("scripts")
+
+# Descriptions are a few hundred bytes each, so this keeps the cache in the tens of MB
+MAX_FIGURE_DESCRIPTIONS = 100000
+
+
+class FigureDescriptionCache:
+    """
+    Cache of figure descriptions stored in a SQLite database, so that logos and diagrams repeated across pages,
+    documents and runs are only described once. Entries are keyed by the SHA-256 of the cropped image.
+    Without a path, the database is kept in memory for the current run.
+    Once the cache holds more than max_entries descriptions, the least recently used ones are evicted.
+    """
+
+    def __init__(self, path: str = ":memory:", max_entries: int = MAX_FIGURE_DESCRIPTIONS):
+        self.path = path
+        self.max_entries = max_entries
+        if path != ":memory:" and (directory := os.path.dirname(path)):
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS descriptions "
+            "(image_hash TEXT PRIMARY KEY, description TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS descriptions_last_used ON descriptions (last_used)")
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, image_hashes: Sequence[str]) -> Dict[str, str]:
+        found: Dict[str, str] = {}
+        unique_hashes = list(dict.fromkeys(image_hashes))
+        # Stay well under SQLite's limit on the number of query parameters
+        for i in range(0, len(unique_hashes), 500):
+            chunk = unique_hashes[i : i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.connection.execute(
+                f"SELECT image_hash, description FROM descriptions WHERE image_hash IN ({placeholders})", chunk
+            ).fetchall()
+            found.update(rows)
+        if found:
+            now = time.time()
+            self.connection.executemany(
+                "UPDATE descriptions SET last_used = ? WHERE image_hash = ?", [(now, key) for key in found]
+            )
+            self.connection.commit()
+        self.hits += len(found)
+        self.misses += len(unique_hashes) - len(found)
+        return found
+
+    def set_many(self, descriptions: Dict[str, str]):
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO descriptions (image_hash, description, last_used) VALUES (?, ?, ?)",
+            [(image_hash, description, now) for image_hash, description in descriptions.items()],
+        )
+        if self.count() > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM descriptions WHERE image_hash NOT IN "
+                "(SELECT image_hash FROM descriptions ORDER BY last_used DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+        self.connection.commit()
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def count(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM descriptions").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
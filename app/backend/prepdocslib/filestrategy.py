@@ -1,18 +1,47 @@
+import asyncio
+import hashlib
 import logging
-from typing import List, Optional
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import (
+    AsyncContextManager,
+    AsyncIterator,
+    Callable,
+    Dict,
+    List,
+    MutableMapping,
+    Optional,
+    Tuple,
+)
 
 from azure.core.credentials import AzureKeyCredential
 
 from .blobmanager import BlobManager
+from .embeddingcache import EmbeddingCache
 from .embeddings import ImageEmbeddings, OpenAIEmbeddings
 from .fileprocessor import FileProcessor
 from .listfilestrategy import File, ListFileStrategy
+from .mappedfile import MappedFile
 from .mediadescriber import ContentUnderstandingDescriber
 from .searchmanager import SearchManager, Section
 from .strategy import DocumentAction, SearchInfo, Strategy
 
 logger = logging.getLogger("scripts")
 
+HASH_READ_SIZE = 1024 * 1024
+
+
+def content_sha256(file: File) -> str:
+    """Returns the SHA-256 of the content of a file, leaving its position unchanged"""
+    if isinstance(file.content, MappedFile):
+        return file.content.sha256()
+    hasher = hashlib.sha256()
+    position = file.content.tell()
+    file.content.seek(0)
+    while chunk := file.content.read(HASH_READ_SIZE):
+        hasher.update(chunk)
+    file.content.seek(position)
+    return hasher.hexdigest()
+
 
 async def parse_file(
     file: File,
@@ -55,6 +84,7 @@ class FileStrategy(Strategy):
         category: Optional[str] = None,
         use_content_understanding: bool = False,
         content_understanding_endpoint: Optional[str] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
     ):
         self.list_file_strategy = list_file_strategy
         self.blob_manager = blob_manager
@@ -68,6 +98,7 @@ class FileStrategy(Strategy):
         self.category = category
         self.use_content_understanding = use_content_understanding
         self.content_understanding_endpoint = content_understanding_endpoint
+        self.embedding_cache = embedding_cache
 
     async def setup(self):
         search_manager = SearchManager(
@@ -92,35 +123,65 @@ class FileStrategy(Strategy):
 
     async def run(self):
         search_manager = SearchManager(
-            self.search_info, self.search_analyzer_name, self.use_acls, False, self.embeddings
+            self.search_info,
+            self.search_analyzer_name,
+            self.use_acls,
+            False,
+            self.embeddings,
+            embedding_cache=self.embedding_cache,
         )
         if self.document_action == DocumentAction.Add:
             files = self.list_file_strategy.list()
             async for file in files:
                 try:
                     sections = await parse_file(file, self.file_processors, self.category, self.image_embeddings)
+                    document_ids: List[str] = []
                     if sections:
                         blob_sas_uris = await self.blob_manager.upload_blob(file)
                         blob_image_embeddings: Optional[List[List[float]]] = None
                         if self.image_embeddings and blob_sas_uris:
-                            blob_image_embeddings = await self.image_embeddings.create_embeddings(blob_sas_uris)
-                        await search_manager.update_content(sections, blob_image_embeddings, url=file.url)
+                            blob_image_embeddings = await self.image_embeddings.create_embeddings(
+                                blob_sas_uris, image_hashes=file.page_image_hashes
+                            )
+                        document_ids = await search_manager.update_content(
+                            sections, blob_image_embeddings, url=file.url
+                        )
+                    self.list_file_strategy.mark_ingested(file, document_ids)
                 finally:
                     if file:
                         file.close()
+            async for path in self.list_file_strategy.list_removed_paths():
+                logger.info("'%s' no longer exists, removing it from the index", path)
+                # The index and the blobs only know the file name, which files in other directories can share,
+                # so only the documents recorded for this file are removed, and shared blobs are kept
+                removed_ids = self.list_file_strategy.removed_document_ids(path)
+                if removed_ids is None:
+                    await search_manager.remove_content(path)
+                else:
+                    await search_manager.remove_documents(removed_ids)
+                if not self.list_file_strategy.has_other_file_named(path):
+                    await self.blob_manager.remove_blob(path)
+                self.list_file_strategy.mark_removed(path)
         elif self.document_action == DocumentAction.Remove:
             paths = self.list_file_strategy.list_paths()
             async for path in paths:
                 await self.blob_manager.remove_blob(path)
                 await search_manager.remove_content(path)
+                self.list_file_strategy.mark_removed(path)
         elif self.document_action == DocumentAction.RemoveAll:
             await self.blob_manager.remove_blob()
             await search_manager.remove_content()
+            self.list_file_strategy.mark_removed()
 
 
 class UploadUserFileStrategy:
     """
-    Strategy for ingesting a file that has already been uploaded to a ADLS2 storage account
+    Strategy for ingesting a file that has already been uploaded to a ADLS2 storage account.
+    Files are added and removed one at a time per user and filename, and a file is only parsed and embedded
+    if its content changed since it was last indexed for that user, according to indexed_hashes,
+    which maps (user oid, filename) to the SHA-256 of the indexed content.
+    Files are locked within the process, and also with shared_lock, if given, which takes a user oid and a filename
+    and returns a lock held by one process at a time, for apps that run several worker processes.
     """
 
     def __init__(
@@ -129,22 +190,67 @@ class UploadUserFileStrategy:
         file_processors: dict[str, FileProcessor],
         embeddings: Optional[OpenAIEmbeddings] = None,
         image_embeddings: Optional[ImageEmbeddings] = None,
+        indexed_hashes: Optional[MutableMapping[Tuple[str, str], str]] = None,
+        shared_lock: Optional[Callable[[str, str], AsyncContextManager[None]]] = None,
     ):
         self.file_processors = file_processors
         self.embeddings = embeddings
         self.image_embeddings = image_embeddings
         self.search_info = search_info
         self.search_manager = SearchManager(self.search_info, None, True, False, self.embeddings)
+        self.indexed_hashes: MutableMapping[Tuple[str, str], str] = indexed_hashes if indexed_hashes is not None else {}
+        self.file_locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+        self.file_lock_holders: Dict[Tuple[str, str], int] = {}
+        self.shared_lock = shared_lock
 
-    async def add_file(self, file: File):
+    @asynccontextmanager
+    async def lock_file(self, filename: str, oid: str) -> AsyncIterator[None]:
+        """Waits until no other add or remove of the same file for the same user is running"""
+        key = (oid, filename)
+        lock = self.file_locks.setdefault(key, asyncio.Lock())
+        self.file_lock_holders[key] = self.file_lock_holders.get(key, 0) + 1
+        try:
+            # The shared lock is only requested once no other task of this process holds the file
+            async with lock, AsyncExitStack() as stack:
+                if self.shared_lock is not None:
+                    await stack.enter_async_context(self.shared_lock(oid, filename))
+                yield
+        finally:
+            self.file_lock_holders[key] -= 1
+            if not self.file_lock_holders[key]:
+                del self.file_lock_holders[key]
+                del self.file_locks[key]
+
+    async def add_file(self, file: File) -> bool:
+        """Indexes a file, and returns False if the same content was already indexed for this user"""
         if self.image_embeddings:
             logging.warning("Image embeddings are not currently supported for the user upload feature")
-        sections = await parse_file(file, self.file_processors)
-        if sections:
-            await self.search_manager.update_content(sections, url=file.url)
+        oid = (file.acls.get("oids") or [""])[0]
+        key = (oid, file.filename())
+        async with self.lock_file(file.filename(), oid):
+            content_hash = content_sha256(file)
+            # indexed_hashes can be stored in a database, which is read and written in a thread
+            loop = asyncio.get_running_loop()
+            indexed_hash = await loop.run_in_executor(None, self.indexed_hashes.get, key)
+            if indexed_hash == content_hash and await self.is_indexed(file):
+                logger.info("Skipping '%s', its content is already indexed", file.filename())
+                return False
+            sections = await parse_file(file, self.file_processors)
+            if sections:
+                await self.search_manager.update_content(sections, url=file.url)
+            await loop.run_in_executor(None, self.indexed_hashes.update, {key: content_hash})
+            return True
+
+    async def is_indexed(self, file: File) -> bool:
+        async with self.search_info.create_search_client() as search_client:
+            return bool(
+                await self.search_manager.get_existing_ids(search_client, file.filename(), file.filename_to_id())
+            )
 
     async def remove_file(self, filename: str, oid: str):
         if filename is None or filename == "":
             logging.warning("Filename is required to remove a file")
             return
-        await self.search_manager.remove_content(filename, oid)
+        async with self.lock_file(filename, oid):
+            await asyncio.get_running_loop().run_in_executor(None, self.indexed_hashes.pop, (oid, filename), None)
+            await self.search_manager.remove_content(filename, oid)
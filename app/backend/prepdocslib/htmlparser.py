@@ -1,6 +1,8 @@
+import codecs
 import logging
 import re
-from typing import IO, AsyncGenerator
+from html.parser import HTMLParser
+from typing import IO, AsyncGenerator, List
 
 from bs4 import BeautifulSoup
 
@@ -9,6 +11,21 @@ from .parser import Parser
 
 logger = logging.getLogger("scripts")
 
+READ_SIZE = 64 * 1024
+# Elements whose content isn't text of the page
+SKIPPED_TAGS = {"script", "style", "template"}
+HEADING_TAGS = {"h1", "h2", "h3", "h4", "h5", "h6"}
+PRESERVE_WHITESPACE_TAGS = {"pre", "textarea"}
+
+# Two or more newlines, two or more spaces that are not newlines, or two or more hyphens.
+# The three are disjoint, so a single pass gives the same result as one pass per pattern.
+CLEANUP_PATTERN = re.compile(r"(\n{2,})|([^\S\n]{2,})|(-{2,})")
+CLEANUP_REPLACEMENTS = {1: "\n", 2: " ", 3: "--"}
+
+
+def cleanup_replacement(match: re.Match) -> str:
+    return CLEANUP_REPLACEMENTS[match.lastindex or 0]
+
 
 def cleanup_data(data: str) -> str:
     """Cleans up the given content using regexes
@@ -17,18 +34,97 @@ def cleanup_data(data: str) -> str:
     Returns:
         str: The cleaned up data.
     """
-    # match two or more newlines and replace them with one new line
-    output = re.sub(r"\n{2,}", "\n", data)
-    # match two or more spaces that are not newlines and replace them with one space
-    output = re.sub(r"[^\S\n]{2,}", " ", output)
-    # match two or more hyphens and replace them with two hyphens
-    output = re.sub(r"-{2,}", "--", output)
+    # Replace newlines with one new line, spaces with one space and hyphens with two hyphens
+    return CLEANUP_PATTERN.sub(cleanup_replacement, data).strip()
+
+
+class HTMLTextExtractor(HTMLParser):
+    """
+    Collects the text of an HTML document as it is fed, skipping scripts and styles.
+    Like BeautifulSoup, text between two tags that is only whitespace is collapsed to a single newline or space.
+    When split_on_headings is set, each heading starts a new section of text.
+    """
+
+    def __init__(self, split_on_headings: bool = False):
+        super().__init__(convert_charrefs=True)
+        self.split_on_headings = split_on_headings
+        self.skip_depth = 0
+        self.preserve_depth = 0
+        self.text_run: List[str] = []
+        self.parts: List[str] = []
+        self.sections: List[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        self.end_text_run()
+        if tag in SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag in PRESERVE_WHITESPACE_TAGS:
+            self.preserve_depth += 1
+        elif self.split_on_headings and tag in HEADING_TAGS:
+            self.end_section()
+
+    def handle_endtag(self, tag):
+        self.end_text_run()
+        if tag in SKIPPED_TAGS and self.skip_depth:
+            self.skip_depth -= 1
+        elif tag in PRESERVE_WHITESPACE_TAGS and self.preserve_depth:
+            self.preserve_depth -= 1
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.text_run.append(data)
+
+    def handle_comment(self, data):
+        self.end_text_run()
 
-    return output.strip()
+    def handle_decl(self, decl):
+        self.end_text_run()
+
+    def handle_pi(self, data):
+        self.end_text_run()
+
+    def unknown_decl(self, data):
+        self.end_text_run()
+        if data.startswith("CDATA[") and not self.skip_depth:
+            self.parts.append(data[len("CDATA[") :])
+
+    def end_text_run(self):
+        if self.text_run:
+            text = "".join(self.text_run)
+            self.text_run = []
+            if not self.preserve_depth and text.isspace():
+                text = "\n" if "\n" in text else " "
+            self.parts.append(text)
+
+    def end_section(self):
+        self.end_text_run()
+        if self.parts:
+            self.sections.append("".join(self.parts))
+            self.parts = []
+
+    def pop_sections(self) -> List[str]:
+        sections = self.sections
+        self.sections = []
+        return sections
 
 
 class LocalHTMLParser(Parser):
-    """Parses HTML text into Page objects."""
+    """
+    Parses HTML text into Page objects.
+    The "beautifulsoup" engine builds a full document tree, while the "fast" engine reads the file in chunks
+    and extracts the text in a single pass, without building a tree.
+    When split_on_headings is set (only supported by the "fast" engine), each heading starts a new Page.
+    """
+
+    ENGINES = ("beautifulsoup", "fast")
+
+    def __init__(self, engine: str = "beautifulsoup", split_on_headings: bool = False):
+        if engine not in self.ENGINES:
+            raise ValueError(f"Unknown HTML parser engine '{engine}', expected one of {', '.join(self.ENGINES)}")
+        if split_on_headings and engine != "fast":
+            raise ValueError("Splitting on headings requires the 'fast' HTML parser engine")
+        self.engine = engine
+        self.split_on_headings = split_on_headings
 
     async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
         """Parses the given content.
@@ -38,6 +134,11 @@ class LocalHTMLParser(Parser):
         Returns:
             Page: The parsed html Page.
         """
+        if self.engine == "fast":
+            async for page in self.parse_fast(content):
+                yield page
+            return
+
         logger.info("Extracting text from '%s' using local HTML parser (BeautifulSoup)", content.name)
 
         data = content.read()
@@ -47,3 +148,28 @@ class LocalHTMLParser(Parser):
         result = soup.get_text()
 
         yield Page(0, 0, text=cleanup_data(result))
+
+    async def parse_fast(self, content: IO) -> AsyncGenerator[Page, None]:
+        logger.info("Extracting text from '%s' using local HTML parser (fast)", content.name)
+
+        extractor = HTMLTextExtractor(split_on_headings=self.split_on_headings)
+        decode = codecs.getincrementaldecoder("utf-8-sig")(errors="replace").decode
+        page_num = 0
+        offset = 0
+        at_end = False
+        while not at_end:
+            chunk = content.read(READ_SIZE)
+            at_end = not chunk
+            if isinstance(chunk, (bytes, bytearray)):
+                chunk = decode(chunk, final=at_end)
+            extractor.feed(chunk)
+            if at_end:
+                extractor.close()
+                extractor.end_section()
+            for section in extractor.pop_sections():
+                page_text = cleanup_data(section)
+                if not page_text:
+                    continue
+                yield Page(page_num, offset, text=page_text)
+                offset += len(page_text) + 1  # Account for newline character
+                page_num += 1
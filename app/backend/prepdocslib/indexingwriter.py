@@ -0,0 +1,172 @@
+import asyncio
+import json
+import logging
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents.aio import SearchClient
+
+logger = logging.getLogger("scripts")
+
+# Azure AI Search accepts at most 1000 documents and 16 MB per indexing request, keep some room for the envelope
+MAX_BATCH_DOCUMENTS = 1000
+MAX_BATCH_BYTES = 14 * 1024 * 1024
+# Status codes worth retrying, for individual documents in a 207 response or for the whole request, see
+# https://learn.microsoft.com/rest/api/searchservice/addupdate-or-delete-documents#response
+RETRYABLE_STATUS_CODES = {409, 422, 429, 503}
+
+
+class IndexingError(Exception):
+    """
+    Raised when documents could not be written to the search index and no error callback was given
+    """
+
+
+class IndexingWriter:
+    """
+    Buffers writes to a search index and sends them in batches, similar to the SDK's SearchIndexingBufferedSender.
+    A batch is sent as soon as it reaches the maximum number of documents or the maximum request size,
+    and up to max_concurrency batches are sent at the same time.
+    Documents that the service fails to index temporarily are retried on their own with exponential backoff.
+    Documents that still fail are passed to on_error, or raised as an IndexingError when the writer is closed.
+
+    Writes are buffered per action, so don't write the same document with different actions before flushing.
+    """
+
+    ACTIONS = ("merge_or_upload", "merge", "delete")
+
+    def __init__(
+        self,
+        search_client: SearchClient,
+        max_batch_documents: int = MAX_BATCH_DOCUMENTS,
+        max_batch_bytes: int = MAX_BATCH_BYTES,
+        max_concurrency: int = 4,
+        max_attempts: int = 5,
+        retry_delay: float = 1.0,
+        on_error: Optional[Callable[[Dict[str, Any], str], None]] = None,
+    ):
+        self.search_client = search_client
+        self.max_batch_documents = max_batch_documents
+        self.max_batch_bytes = max_batch_bytes
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.on_error = on_error
+        self.buffers: Dict[str, List[Tuple[Dict[str, Any], int]]] = {action: [] for action in self.ACTIONS}
+        self.buffer_bytes: Dict[str, int] = {action: 0 for action in self.ACTIONS}
+        self.tasks: Set[asyncio.Task] = set()
+        self.succeeded = 0
+        self.failed: List[Tuple[Dict[str, Any], str]] = []
+        self.errors: List[Exception] = []
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # Created lazily so that the semaphore is bound to the event loop that actually uses it
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def __aenter__(self) -> "IndexingWriter":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.close()
+        else:
+            # Don't hide the original error, but don't leave requests running either
+            for task in self.tasks:
+                task.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def merge_or_upload_documents(self, documents: List[Dict[str, Any]]):
+        await self.add("merge_or_upload", documents)
+
+    async def merge_documents(self, documents: List[Dict[str, Any]]):
+        await self.add("merge", documents)
+
+    async def delete_documents(self, documents: List[Dict[str, Any]]):
+        await self.add("delete", documents)
+
+    async def add(self, action: str, documents: List[Dict[str, Any]]):
+        for document in documents:
+            size = len(json.dumps(document).encode())
+            buffer = self.buffers[action]
+            if buffer and (
+                len(buffer) >= self.max_batch_documents or self.buffer_bytes[action] + size > self.max_batch_bytes
+            ):
+                await self.send(action)
+            self.buffers[action].append((document, size))
+            self.buffer_bytes[action] += size
+
+    async def send(self, action: str):
+        """Sends the buffered documents of an action in the background, waiting if too many batches are in flight"""
+        batch = [document for document, _ in self.buffers[action]]
+        self.buffers[action] = []
+        self.buffer_bytes[action] = 0
+        if not batch:
+            return
+        await self.semaphore.acquire()
+        task = asyncio.create_task(self.send_batch(action, batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send_batch(self, action: str, documents: List[Dict[str, Any]]):
+        try:
+            pending = documents
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    results = await getattr(self.search_client, f"{action}_documents")(documents=pending)
+                except HttpResponseError as error:
+                    if error.status_code not in RETRYABLE_STATUS_CODES or attempt == self.max_attempts:
+                        raise
+                    retry = pending
+                    message = str(error.message)
+                else:
+                    failed = {result.key: result for result in results if not result.succeeded}
+                    self.succeeded += len(pending) - len(failed)
+                    retry = []
+                    for document in pending:
+                        if (result := failed.get(document["id"])) is None:
+                            continue
+                        if result.status_code in RETRYABLE_STATUS_CODES and attempt < self.max_attempts:
+                            retry.append(document)
+                        else:
+                            self.fail(document, result.error_message or f"Status code {result.status_code}")
+                    if not retry:
+                        return
+                    message = f"{len(retry)} documents were not indexed"
+                delay = self.retry_delay * 2 ** (attempt - 1)
+                logger.info("%s, retrying %s in %.1f seconds", message, action, delay)
+                await asyncio.sleep(delay)
+                pending = retry
+        except Exception as error:
+            # Finished tasks are forgotten, so keep the error around until the next flush
+            self.errors.append(error)
+        finally:
+            self.semaphore.release()
+
+    def fail(self, document: Dict[str, Any], error_message: str):
+        if self.on_error:
+            self.on_error(document, error_message)
+        else:
+            self.failed.append((document, error_message))
+
+    async def flush(self):
+        """Sends all buffered documents and waits until every batch has been indexed"""
+        for action in self.ACTIONS:
+            await self.send(action)
+        while self.tasks:
+            await asyncio.gather(*self.tasks)
+        if self.errors:
+            errors, self.errors = self.errors, []
+            raise errors[0]
+        if self.failed:
+            failed, self.failed = self.failed, []
+            document, error_message = failed[0]
+            raise IndexingError(
+                f"Failed to index {len(failed)} documents, for example {document.get('id')}: {error_message}"
+            )
+
+    async def close(self):
+        await self.flush()
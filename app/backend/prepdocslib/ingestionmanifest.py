@@ -0,0 +1,112 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger("scripts")
+
+
+class ManifestEntry:
+    """
+    The state of a local file the last time it was ingested
+    """
+
+    def __init__(
+        self,
+        path: str,
+        size: int,
+        mtime_ns: int,
+        content_hash: str,
+        document_ids: List[str],
+        chunk_count: int,
+    ):
+        self.path = path
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self.content_hash = content_hash
+        self.document_ids = document_ids
+        self.chunk_count = chunk_count
+
+
+class ManifestDiff:
+    """
+    The changes between the files on disk and the files recorded in the manifest
+    """
+
+    def __init__(self):
+        self.added: List[str] = []
+        self.changed: List[str] = []
+        self.unchanged: List[str] = []
+        self.removed: List[str] = []
+
+    def has_changes(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+
+class IngestionManifest:
+    """
+    Records which local files have been ingested, stored in a single SQLite database.
+    For each file, it keeps the size, modification time and SHA-256 hash of the content,
+    along with the ids of the search documents created for it and the number of ingested chunks.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if directory := os.path.dirname(path):
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, content_hash TEXT NOT NULL, "
+            "document_ids TEXT NOT NULL, chunk_count INTEGER NOT NULL, ingested_at REAL NOT NULL)"
+        )
+        self.connection.commit()
+
+    def get(self, path: str) -> Optional[ManifestEntry]:
+        row = self.connection.execute(
+            "SELECT path, size, mtime_ns, content_hash, document_ids, chunk_count FROM files WHERE path = ?",
+            (path,),
+        ).fetchone()
+        if row is None:
+            return None
+        return ManifestEntry(row[0], row[1], row[2], row[3], json.loads(row[4]), row[5])
+
+    def paths(self) -> List[str]:
+        return [row[0] for row in self.connection.execute("SELECT path FROM files ORDER BY path")]
+
+    def record(self, entry: ManifestEntry):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO files (path, size, mtime_ns, content_hash, document_ids, chunk_count, ingested_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                entry.path,
+                entry.size,
+                entry.mtime_ns,
+                entry.content_hash,
+                json.dumps(entry.document_ids),
+                entry.chunk_count,
+                time.time(),
+            ),
+        )
+        self.connection.commit()
+
+    def update_stat(self, path: str, size: int, mtime_ns: int):
+        self.connection.execute("UPDATE files SET size = ?, mtime_ns = ? WHERE path = ?", (size, mtime_ns, path))
+        self.connection.commit()
+
+    def remove(self, path: Optional[str] = None):
+        """Forgets about a file, or about all files if no path is given"""
+        if path is None:
+            self.connection.execute("DELETE FROM files")
+        else:
+            self.connection.execute("DELETE FROM files WHERE path = ?", (path,))
+        self.connection.commit()
+
+    def stats(self) -> Dict[str, int]:
+        row = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(chunk_count), 0) FROM files").fetchone()
+        return {"files": row[0], "chunks": row[1]}
+
+    def close(self):
+        self.connection.close()
@@ -1,23 +1,127 @@
+import codecs
 import json
-from typing import IO, AsyncGenerator
+from typing import IO, AsyncGenerator, Callable, Iterator
 
 from .page import Page
 from .parser import Parser
 
+READ_SIZE = 64 * 1024
+ARRAY_DELIMITERS = ",] \t\r\n"
+
+
+def read_text(content: IO, size: int, decode: Callable[..., str]) -> str:
+    """Reads up to size characters or bytes from a text or binary file, returning "" only at the end of the file"""
+    while True:
+        chunk = content.read(size)
+        if not isinstance(chunk, (bytes, bytearray)):
+            return chunk
+        # Bytes are decoded as they are read, and a partial character is completed by the next read
+        if (text := decode(chunk, final=not chunk)) or not chunk:
+            return text
+
+
+def iter_json_array(content: IO, read_size: int = READ_SIZE) -> Iterator[object]:
+    """
+    Yields the elements of a top-level JSON array one at a time, reading the file incrementally,
+    so that only the element being decoded and a chunk of the file are held in memory.
+    Raises a ValueError if the file doesn't contain a JSON array.
+    """
+    decoder = json.JSONDecoder()
+    decode = codecs.getincrementaldecoder("utf-8-sig")().decode
+    buffer = ""
+    index = 0
+    at_end = False
+
+    def fill(size: int):
+        nonlocal buffer, index, at_end
+        chunk = read_text(content, size, decode)
+        at_end = not chunk
+        buffer = buffer[index:] + chunk
+        index = 0
+
+    def skip_whitespace():
+        nonlocal index
+        while True:
+            while index < len(buffer) and buffer[index].isspace():
+                index += 1
+            if index < len(buffer) or at_end:
+                return
+            fill(read_size)
+
+    skip_whitespace()
+    if index >= len(buffer) or buffer[index] != "[":
+        raise ValueError("Expected a JSON array")
+    index += 1
+    expect_element = True
+    while True:
+        skip_whitespace()
+        if index >= len(buffer):
+            raise ValueError("Unterminated JSON array")
+        if buffer[index] == "]":
+            return
+        if not expect_element:
+            if buffer[index] != ",":
+                raise ValueError(f"Expected ',' or ']' in JSON array, got {buffer[index]!r}")
+            index += 1
+            skip_whitespace()
+        size = read_size
+        while True:
+            try:
+                element, end = decoder.raw_decode(buffer, index)
+                # A number cut by the end of the buffer (like "12" of "12.5") might continue in the next chunk,
+                # but in a valid array, a complete element is always followed by a delimiter
+                if at_end or (end < len(buffer) and buffer[end] in ARRAY_DELIMITERS):
+                    break
+            except json.JSONDecodeError:
+                if at_end:
+                    raise
+            # The element doesn't fit in the buffer yet, read more, and more each time to stay linear
+            fill(size)
+            size *= 2
+        index = end
+        expect_element = False
+        yield element
+
 
 class JsonParser(Parser):
     """
     Concrete parser that can parse JSON into Page objects. A top-level object becomes a single Page, while a top-level array becomes multiple Page objects.
+    Arrays are read incrementally, so each element is parsed and turned into a Page before the next one is read.
     """
 
     async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
-        offset = 0
-        data = json.loads(content.read())
-        if isinstance(data, list):
-            for i, obj in enumerate(data):
+        decode = codecs.getincrementaldecoder("utf-8-sig")().decode
+        first_char = read_text(content, 1, decode)
+        while first_char.isspace():
+            first_char = read_text(content, 1, decode)
+        content.seek(0)
+        if first_char == "[":
+            offset = 0
+            for i, obj in enumerate(iter_json_array(content)):
                 offset += 1  # For opening bracket or comma before object
                 page_text = json.dumps(obj)
                 yield Page(i, offset, page_text)
                 offset += len(page_text)
-        elif isinstance(data, dict):
+            return
+        data = json.loads(content.read())
+        if isinstance(data, dict):
             yield Page(0, 0, json.dumps(data))
+
+
+class JsonLinesParser(Parser):
+    """
+    Concrete parser that can parse JSON Lines (.jsonl) into Page objects. Each non-empty line becomes a Page object.
+    """
+
+    async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
+        offset = 0
+        page_num = 0
+        for line in content:
+            if isinstance(line, (bytes, bytearray)):
+                line = line.decode("utf-8-sig")
+            if not line.strip():
+                continue
+            page_text = json.dumps(json.loads(line))
+            yield Page(page_num, offset, page_text)
+            offset += len(page_text) + 1  # Account for newline character
+            page_num += 1
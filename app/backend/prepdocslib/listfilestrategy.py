@@ -1,18 +1,37 @@
+import asyncio
 import base64
 import hashlib
 import logging
 import os
 import re
+import shutil
 import tempfile
 from abc import ABC
+from collections import deque
 from glob import glob
-from typing import IO, AsyncGenerator, Dict, List, Optional, Union
+from typing import (
+    IO,
+    AsyncGenerator,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 from azure.core.credentials_async import AsyncTokenCredential
+from azure.storage.filedatalake import PathProperties
 from azure.storage.filedatalake.aio import (
     DataLakeServiceClient,
+    FileSystemClient,
 )
 
+from .ingestionmanifest import IngestionManifest, ManifestDiff, ManifestEntry
+from .mappedfile import MappedFile
+
 logger = logging.getLogger("scripts")
 
 
@@ -20,12 +39,23 @@ class File:
     """
     Represents a file stored either locally or in a data lake storage account
     This file might contain access control information about which users or groups can access it
+    Listed files are memory-mapped, so that parsing, hashing and uploading them all read the same bytes
     """
 
-    def __init__(self, content: IO, acls: Optional[dict[str, list]] = None, url: Optional[str] = None):
+    def __init__(
+        self,
+        content: IO,
+        acls: Optional[dict[str, list]] = None,
+        url: Optional[str] = None,
+        on_close: Optional[Callable[[], None]] = None,
+    ):
         self.content = content
         self.acls = acls or {}
         self.url = url
+        # Called once when the file is closed, for example to delete a temporary copy of the file
+        self.on_close = on_close
+        # SHA-256 of the page images uploaded for this file, set by the BlobManager
+        self.page_image_hashes: Optional[List[str]] = None
 
     def filename(self):
         return os.path.basename(self.content.name)
@@ -44,6 +74,9 @@ class File:
     def close(self):
         if self.content:
             self.content.close()
+        if self.on_close:
+            on_close, self.on_close = self.on_close, None
+            on_close()
 
 
 class ListFileStrategy(ABC):
@@ -59,14 +92,44 @@ class ListFileStrategy(ABC):
         if False:  # pragma: no cover - this is necessary for mypy to type check
             yield
 
+    async def list_removed_paths(self) -> AsyncGenerator[str, None]:
+        """Lists the paths of previously ingested files that no longer exist"""
+        if False:  # pragma: no cover - this is necessary for mypy to type check
+            yield
+
+    def removed_document_ids(self, path: str) -> Optional[List[str]]:
+        """
+        Returns the ids of the search documents of a file listed by list_removed_paths, leaving out the ids that other
+        files also have, or None if they weren't recorded
+        """
+        return None
+
+    def has_other_file_named(self, path: str) -> bool:
+        """Returns whether another file has the same name as a removed file, and so the same blobs"""
+        return False
+
+    def mark_ingested(self, file: File, document_ids: List[str]):
+        """Called once a file listed by this strategy has been ingested"""
+        pass
+
+    def mark_removed(self, path: Optional[str] = None):
+        """Called once a file, or all files if no path is given, have been removed from the index"""
+        pass
+
 
 class LocalListFileStrategy(ListFileStrategy):
     """
     Concrete strategy for listing files that are located in a local filesystem
+    If an ingestion manifest is provided, only files that are new or changed since they were last ingested are listed,
+    and files that were ingested but no longer exist are reported by list_removed_paths.
+    Otherwise, a .md5 file with the hash of each file is written next to it.
     """
 
-    def __init__(self, path_pattern: str):
+    def __init__(self, path_pattern: str, manifest: Optional[IngestionManifest] = None):
         self.path_pattern = path_pattern
+        self.manifest = manifest
+        # Files listed but not yet ingested, by absolute path: (size, mtime_ns, content_hash)
+        self.pending: Dict[str, Tuple[int, int, str]] = {}
 
     async def list_paths(self) -> AsyncGenerator[str, None]:
         async for p in self._list_paths(self.path_pattern):
@@ -83,8 +146,110 @@ class LocalListFileStrategy(ListFileStrategy):
 
     async def list(self) -> AsyncGenerator[File, None]:
         async for path in self.list_paths():
-            if not self.check_md5(path):
-                yield File(content=open(path, mode="rb"))
+            if self.manifest is None:
+                if not self.check_md5(path):
+                    yield File(content=MappedFile(path))
+            elif self.check_manifest(path):
+                yield File(content=MappedFile(path))
+
+    async def list_removed_paths(self) -> AsyncGenerator[str, None]:
+        if self.manifest is None:
+            return
+        base_path = self.base_path()
+        for path in self.manifest.paths():
+            # Only consider files that the path pattern could have listed
+            in_scope = path == base_path or path.startswith(base_path.rstrip(os.sep) + os.sep)
+            if in_scope and not os.path.exists(path):
+                yield path
+
+    def removed_document_ids(self, path: str) -> Optional[List[str]]:
+        if self.manifest is None or (entry := self.manifest.get(path)) is None:
+            return None
+        # Files with the same name in other directories can have documents with the same ids
+        other_ids: Set[str] = set()
+        for other_path in self.other_paths_named(path):
+            if (other_entry := self.manifest.get(other_path)) is not None:
+                other_ids.update(other_entry.document_ids)
+        return [document_id for document_id in entry.document_ids if document_id not in other_ids]
+
+    def has_other_file_named(self, path: str) -> bool:
+        return bool(self.other_paths_named(path))
+
+    def other_paths_named(self, path: str) -> List[str]:
+        if self.manifest is None:
+            return []
+        name = os.path.basename(path)
+        return [other for other in self.manifest.paths() if other != path and os.path.basename(other) == name]
+
+    def base_path(self) -> str:
+        """Returns the absolute path of the deepest directory (or file) that contains every match of the pattern"""
+        prefix = re.split(r"[*?[]", self.path_pattern, maxsplit=1)[0]
+        if prefix != self.path_pattern:
+            prefix = os.path.dirname(prefix)
+        return os.path.abspath(prefix)
+
+    def classify(self, path: str) -> Tuple[str, os.stat_result, Optional[str]]:
+        """
+        Compares a file with the manifest, and returns whether it was "added", "changed" or is "unchanged",
+        along with its stat and content hash. The size and modification time are compared first,
+        so unchanged files are not read, in which case the returned hash is None.
+        """
+        if self.manifest is None:
+            raise ValueError("An ingestion manifest is required to classify files")
+        stat = os.stat(path)
+        entry = self.manifest.get(os.path.abspath(path))
+        if entry and entry.size == stat.st_size and entry.mtime_ns == stat.st_mtime_ns:
+            return "unchanged", stat, None
+        content_hash = LocalListFileStrategy.hash_file(path)
+        if entry is None:
+            return "added", stat, content_hash
+        if entry.content_hash == content_hash:
+            return "unchanged", stat, content_hash
+        return "changed", stat, content_hash
+
+    def check_manifest(self, path: str) -> bool:
+        """Returns True if the file needs to be ingested"""
+        # Ignore .md5 files left behind by previous versions of this script
+        if path.endswith(".md5") or self.manifest is None:
+            return False
+        status, stat, content_hash = self.classify(path)
+        if status == "unchanged":
+            logger.info("Skipping %s, no changes detected.", path)
+            if content_hash is not None:
+                # The file was touched without changing, so remember its new modification time
+                self.manifest.update_stat(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+            return False
+        if content_hash is not None:
+            self.pending[os.path.abspath(path)] = (stat.st_size, stat.st_mtime_ns, content_hash)
+        return True
+
+    async def diff(self) -> ManifestDiff:
+        """Computes what the next ingestion would do, without changing the manifest"""
+        diff = ManifestDiff()
+        async for path in self.list_paths():
+            if path.endswith(".md5"):
+                continue
+            status, _, _ = self.classify(path)
+            getattr(diff, status).append(path)
+        diff.removed = [path async for path in self.list_removed_paths()]
+        return diff
+
+    def mark_ingested(self, file: File, document_ids: List[str]):
+        if self.manifest is None:
+            return
+        path = os.path.abspath(file.content.name)
+        if pending := self.pending.pop(path, None):
+            size, mtime_ns, content_hash = pending
+            self.manifest.record(ManifestEntry(path, size, mtime_ns, content_hash, document_ids, len(document_ids)))
+
+    def mark_removed(self, path: Optional[str] = None):
+        if self.manifest is not None:
+            self.manifest.remove(os.path.abspath(path) if path is not None else None)
+
+    @staticmethod
+    def hash_file(path: str) -> str:
+        with MappedFile(path) as file:
+            return file.sha256()
 
     def check_md5(self, path: str) -> bool:
         # if filename ends in .md5 skip
@@ -93,8 +258,8 @@ class LocalListFileStrategy(ListFileStrategy):
 
         # if there is a file called .md5 in this directory, see if its updated
         stored_hash = None
-        with open(path, "rb") as file:
-            existing_hash = hashlib.md5(file.read()).hexdigest()
+        with MappedFile(path) as file:
+            existing_hash = hashlib.md5(file.getbuffer()).hexdigest()
         hash_path = f"{path}.md5"
         if os.path.exists(hash_path):
             with open(hash_path, encoding="utf-8") as md5_f:
@@ -114,6 +279,9 @@ class LocalListFileStrategy(ListFileStrategy):
 class ADLSGen2ListFileStrategy(ListFileStrategy):
     """
     Concrete strategy for listing files that are located in a data lake storage account
+    Files are downloaded ahead of time, up to max_prefetch files at once, into their own temporary directories,
+    which are deleted when the files are closed. Files are not downloaded ahead while the files downloaded
+    and not yet closed take more than max_prefetch_bytes on disk.
     """
 
     def __init__(
@@ -122,56 +290,104 @@ class ADLSGen2ListFileStrategy(ListFileStrategy):
         data_lake_filesystem: str,
         data_lake_path: str,
         credential: Union[AsyncTokenCredential, str],
+        max_prefetch: int = 4,
+        max_prefetch_bytes: int = 2 * 1024 * 1024 * 1024,
     ):
         self.data_lake_storage_account = data_lake_storage_account
         self.data_lake_filesystem = data_lake_filesystem
         self.data_lake_path = data_lake_path
         self.credential = credential
+        self.max_prefetch = max(1, max_prefetch)
+        self.max_prefetch_bytes = max_prefetch_bytes
+        # Size of the files downloaded, or being downloaded, that were not closed yet
+        self.bytes_on_disk = 0
 
     async def list_paths(self) -> AsyncGenerator[str, None]:
         async with DataLakeServiceClient(
             account_url=f"https://{self.data_lake_storage_account}.dfs.core.windows.net", credential=self.credential
         ) as service_client, service_client.get_file_system_client(self.data_lake_filesystem) as filesystem_client:
-            async for path in filesystem_client.get_paths(path=self.data_lake_path, recursive=True):
-                if path.is_directory:
-                    continue
-
+            async for path in self.list_path_properties(filesystem_client):
                 yield path.name
 
+    async def list_path_properties(self, filesystem_client: FileSystemClient) -> AsyncGenerator[PathProperties, None]:
+        async for path in filesystem_client.get_paths(path=self.data_lake_path, recursive=True):
+            if path.is_directory:
+                continue
+
+            yield path
+
     async def list(self) -> AsyncGenerator[File, None]:
         async with DataLakeServiceClient(
             account_url=f"https://{self.data_lake_storage_account}.dfs.core.windows.net", credential=self.credential
         ) as service_client, service_client.get_file_system_client(self.data_lake_filesystem) as filesystem_client:
-            async for path in self.list_paths():
-                temp_file_path = os.path.join(tempfile.gettempdir(), os.path.basename(path))
-                try:
-                    async with filesystem_client.get_file_client(path) as file_client:
-                        with open(temp_file_path, "wb") as temp_file:
-                            downloader = await file_client.download_file()
-                            await downloader.readinto(temp_file)
-                    # Parse out user ids and group ids
-                    acls: Dict[str, List[str]] = {"oids": [], "groups": []}
-                    # https://learn.microsoft.com/python/api/azure-storage-file-datalake/azure.storage.filedatalake.datalakefileclient?view=azure-python#azure-storage-filedatalake-datalakefileclient-get-access-control
-                    # Request ACLs as GUIDs
-                    access_control = await file_client.get_access_control(upn=False)
-                    acl_list = access_control["acl"]
-                    # https://learn.microsoft.com/azure/storage/blobs/data-lake-storage-access-control
-                    # ACL Format: user::rwx,group::r-x,other::r--,user:xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx:r--
-                    acl_list = acl_list.split(",")
-                    for acl in acl_list:
-                        acl_parts: list = acl.split(":")
-                        if len(acl_parts) != 3:
-                            continue
-                        if len(acl_parts[1]) == 0:
-                            continue
-                        if acl_parts[0] == "user" and "r" in acl_parts[2]:
-                            acls["oids"].append(acl_parts[1])
-                        if acl_parts[0] == "group" and "r" in acl_parts[2]:
-                            acls["groups"].append(acl_parts[1])
-                    yield File(content=open(temp_file_path, "rb"), acls=acls, url=file_client.url)
-                except Exception as data_lake_exception:
-                    logger.error(f"\tGot an error while reading {path} -> {data_lake_exception} --> skipping file")
-                    try:
-                        os.remove(temp_file_path)
-                    except Exception as file_delete_exception:
-                        logger.error(f"\tGot an error while deleting {temp_file_path} -> {file_delete_exception}")
+            # Downloads in the order of the listing, so that files are yielded in that order
+            pending: Deque[asyncio.Task] = deque()
+            try:
+                async for path in self.list_path_properties(filesystem_client):
+                    size = path.content_length or 0
+                    while pending and (
+                        len(pending) >= self.max_prefetch or self.bytes_on_disk + size > self.max_prefetch_bytes
+                    ):
+                        if file := await pending.popleft():
+                            yield file
+                    self.bytes_on_disk += size
+                    pending.append(asyncio.create_task(self.download_file(filesystem_client, path.name, size)))
+                while pending:
+                    if file := await pending.popleft():
+                        yield file
+            finally:
+                # The caller stopped early or something failed, so discard the files it will never see
+                for task in pending:
+                    task.cancel()
+                for result in await asyncio.gather(*pending, return_exceptions=True):
+                    if isinstance(result, File):
+                        result.close()
+
+    async def download_file(self, filesystem_client: FileSystemClient, path: str, size: int) -> Optional[File]:
+        """Downloads a file and its ACLs, returning None if the file could not be read"""
+        temp_dir = tempfile.mkdtemp(prefix="prepdocs-")
+
+        def cleanup():
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            self.bytes_on_disk -= size
+
+        # Files with the same name in different folders get different directories
+        temp_file_path = os.path.join(temp_dir, os.path.basename(path))
+        try:
+            async with filesystem_client.get_file_client(path) as file_client:
+
+                async def download():
+                    with open(temp_file_path, "wb") as temp_file:
+                        downloader = await file_client.download_file()
+                        await downloader.readinto(temp_file)
+
+                # https://learn.microsoft.com/python/api/azure-storage-file-datalake/azure.storage.filedatalake.datalakefileclient?view=azure-python#azure-storage-filedatalake-datalakefileclient-get-access-control
+                # Request ACLs as GUIDs
+                _, access_control = await asyncio.gather(download(), file_client.get_access_control(upn=False))
+                url = file_client.url
+            acls = ADLSGen2ListFileStrategy.parse_acls(access_control["acl"])
+            return File(content=MappedFile(temp_file_path), acls=acls, url=url, on_close=cleanup)
+        except BaseException as data_lake_exception:
+            cleanup()
+            if not isinstance(data_lake_exception, Exception):
+                raise
+            logger.error(f"\tGot an error while reading {path} -> {data_lake_exception} --> skipping file")
+            return None
+
+    @staticmethod
+    def parse_acls(acl_list: str) -> Dict[str, List[str]]:
+        """Parses out the user ids and group ids that can read a file"""
+        acls: Dict[str, List[str]] = {"oids": [], "groups": []}
+        # https://learn.microsoft.com/azure/storage/blobs/data-lake-storage-access-control
+        # ACL Format: user::rwx,group::r-x,other::r--,user:xxxxxxxx-xxxx-xxxx-xxxx-xxxxxxxxxxxx:r--
+        for acl in acl_list.split(","):
+            acl_parts: list = acl.split(":")
+            if len(acl_parts) != 3:
+                continue
+            if len(acl_parts[1]) == 0:
+                continue
+            if acl_parts[0] == "user" and "r" in acl_parts[2]:
+                acls["oids"].append(acl_parts[1])
+            if acl_parts[0] == "group" and "r" in acl_parts[2]:
+                acls["groups"].append(acl_parts[1])
+        return acls
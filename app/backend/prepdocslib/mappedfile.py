@@ -0,0 +1,119 @@
+import hashlib
+import io
+import mmap
+import os
+from typing import BinaryIO, Optional
+
+
+class MappedFile(io.RawIOBase, BinaryIO):
+    """
+    Read-only file whose bytes are memory-mapped, so that every stage of the ingestion (hashing, parsing, uploading)
+    reads the same pages of memory, instead of reopening the file or copying all of its bytes.
+    It is a BinaryIO, so it can be used wherever a file opened in binary mode is expected,
+    and getbuffer() returns the bytes without copying them, like io.BytesIO.getbuffer().
+    The SHA-256 of the file is computed from the bytes read in order, so reading the whole file once,
+    for example to upload it, also hashes it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file:
+            # An empty file can't be mapped
+            if os.fstat(file.fileno()).st_size:
+                self.mmap: Optional[mmap.mmap] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.mmap = None
+        self.view = memoryview(self.mmap if self.mmap is not None else b"")
+        self.position = 0
+        self.hasher = hashlib.sha256()
+        self.hashed = 0
+
+    @property
+    def name(self) -> str:
+        return self.path
+
+    def __enter__(self) -> "MappedFile":
+        self.check_open()
+        return self
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        self.check_open()
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self.check_open()
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        elif whence != io.SEEK_SET:
+            raise ValueError(f"Invalid whence ({whence})")
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self.position = offset
+        return self.position
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        return self.next_bytes(size).tobytes()
+
+    def readall(self) -> bytes:
+        return self.read()
+
+    def readinto(self, buffer) -> int:
+        with memoryview(buffer) as target, target.cast("B") as target_bytes:
+            data = self.next_bytes(len(target_bytes))
+            target_bytes[: len(data)] = data
+            return len(data)
+
+    def readline(self, size: Optional[int] = -1) -> bytes:
+        self.check_open()
+        end = len(self.view)
+        if self.mmap is not None and (newline := self.mmap.find(b"\n", self.position)) != -1:
+            end = newline + 1
+        if size is not None and size >= 0:
+            end = min(end, self.position + size)
+        return self.next_bytes(max(0, end - self.position)).tobytes()
+
+    def getbuffer(self) -> memoryview:
+        self.check_open()
+        return self.view
+
+    def sha256(self) -> str:
+        """Returns the SHA-256 of the file, hashing only the bytes that weren't already read in order"""
+        self.check_open()
+        if self.hashed < len(self.view):
+            self.hasher.update(self.view[self.hashed :])
+            self.hashed = len(self.view)
+        return self.hasher.hexdigest()
+
+    def next_bytes(self, size: Optional[int]) -> memoryview:
+        self.check_open()
+        start = min(self.position, len(self.view))
+        end = len(self.view) if size is None or size < 0 else min(start + size, len(self.view))
+        data = self.view[start:end]
+        if start <= self.hashed < end:
+            self.hasher.update(data[self.hashed - start :])
+            self.hashed = end
+        self.position = end
+        return data
+
+    def check_open(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.view.release()
+                if self.mmap is not None:
+                    self.mmap.close()
+            except BufferError:
+                # Something still holds a view of the bytes, so the mapping is closed when it is garbage collected
+                pass
+        super().close()
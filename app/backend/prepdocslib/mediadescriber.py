@@ -1,11 +1,14 @@
 import logging
+import time
 from abc import ABC
+from typing import Optional
 
 import aiohttp
+from azure.core.credentials import AccessToken
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.identity.aio import get_bearer_token_provider
 from rich.progress import Progress
-from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_fixed
+from tenacity import retry, retry_if_exception_type, stop_after_delay, wait_exponential
 
 logger = logging.getLogger("scripts")
 
@@ -41,10 +44,33 @@ class ContentUnderstandingDescriber:
     def __init__(self, endpoint: str, credential: AsyncTokenCredential):
         self.endpoint = endpoint
         self.credential = credential
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.token: Optional[AccessToken] = None
+
+    async def __aenter__(self) -> "ContentUnderstandingDescriber":
+        # Share one session between all the images described within this context
+        self.session = aiohttp.ClientSession()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    async def get_token(self) -> str:
+        # Reuse the token until shortly before it expires, rather than fetching one per image
+        if self.token is None or self.token.expires_on - time.time() < 300:
+            self.token = await self.credential.get_token("https://cognitiveservices.azure.com/.default")
+        return self.token.token
 
     async def poll_api(self, session, poll_url, headers):
 
-        @retry(stop=stop_after_attempt(60), wait=wait_fixed(2), retry=retry_if_exception_type(ValueError))
+        # Most images are analyzed in a few seconds, so start polling quickly and back off up to 2 seconds
+        @retry(
+            stop=stop_after_delay(120),
+            wait=wait_exponential(multiplier=0.25, max=2),
+            retry=retry_if_exception_type(ValueError),
+        )
         async def poll():
             async with session.get(poll_url, headers=headers) as response:
                 response.raise_for_status()
@@ -85,23 +111,27 @@ class ContentUnderstandingDescriber:
 
     async def describe_image(self, image_bytes: bytes) -> str:
         logger.info("Sending image to Azure Content Understanding service...")
+        if self.session:
+            return await self.analyze_image(self.session, image_bytes)
         async with aiohttp.ClientSession() as session:
-            token = await self.credential.get_token("https://cognitiveservices.azure.com/.default")
-            headers = {"Authorization": "Bearer " + token.token}
-            params = {"api-version": self.CU_API_VERSION}
-            analyzer_name = self.analyzer_schema["analyzerId"]
-            async with session.post(
-                url=f"{self.endpoint}/contentunderstanding/analyzers/{analyzer_name}:analyze",
-                params=params,
-                headers=headers,
-                data=image_bytes,
-            ) as response:
-                response.raise_for_status()
-                poll_url = response.headers["Operation-Location"]
-
-                with Progress() as progress:
-                    progress.add_task("Processing...", total=None, start=False)
-                    results = await self.poll_api(session, poll_url, headers)
+            return await self.analyze_image(session, image_bytes)
 
-                fields = results["result"]["contents"][0]["fields"]
-                return fields["Description"]["valueString"]
+    async def analyze_image(self, session: aiohttp.ClientSession, image_bytes: bytes) -> str:
+        headers = {"Authorization": "Bearer " + await self.get_token()}
+        params = {"api-version": self.CU_API_VERSION}
+        analyzer_name = self.analyzer_schema["analyzerId"]
+        async with session.post(
+            url=f"{self.endpoint}/contentunderstanding/analyzers/{analyzer_name}:analyze",
+            params=params,
+            headers=headers,
+            data=image_bytes,
+        ) as response:
+            response.raise_for_status()
+            poll_url = response.headers["Operation-Location"]
+
+            # Images are analyzed concurrently, and rich only allows one live progress display at a time
+            logger.info("Waiting for the image analysis to complete...")
+            results = await self.poll_api(session, poll_url, headers)
+
+            fields = results["result"]["contents"][0]["fields"]
+            return fields["Description"]["valueString"]
@@ -0,0 +1,85 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger("scripts")
+
+
+class ParseCache:
+    """
+    Persistent cache of document analysis results stored in a local SQLite database, so that re-ingesting a file
+    whose bytes didn't change doesn't send it to Azure Document Intelligence again.
+    Entries are keyed by the SHA-256 of the file, the model, the analysis features and the analyzed page range,
+    and results are stored as zlib-compressed JSON.
+    When refresh is set, cached results are ignored and replaced by fresh ones.
+    """
+
+    def __init__(self, path: str, refresh: bool = False):
+        self.path = path
+        self.refresh = refresh
+        if directory := os.path.dirname(path):
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results "
+            "(key TEXT PRIMARY KEY, result BLOB NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        self.connection.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(content_hash: str, model_id: str, features: str, page_range: str = "") -> str:
+        return hashlib.sha256(f"{content_hash}\n{model_id}\n{features}\n{page_range}".encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        row = None
+        if not self.refresh:
+            row = self.connection.execute("SELECT result FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.connection.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.connection.commit()
+        return json.loads(zlib.decompress(row[0]))
+
+    def set(self, key: str, result: Dict[str, Any]):
+        blob = zlib.compress(json.dumps(result).encode())
+        self.connection.execute(
+            "INSERT OR REPLACE INTO results (key, result, size, last_used) VALUES (?, ?, ?, ?)",
+            (key, blob, len(blob), time.time()),
+        )
+        self.connection.commit()
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def size(self) -> int:
+        return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+
+    def evict(self, max_bytes: int) -> int:
+        """Removes the least recently used results until the cached results take at most max_bytes"""
+        rows = self.connection.execute("SELECT key, size FROM results ORDER BY last_used DESC").fetchall()
+        total = 0
+        evicted = []
+        for key, size in rows:
+            total += size
+            if total > max_bytes:
+                evicted.append((key,))
+        self.connection.executemany("DELETE FROM results WHERE key = ?", evicted)
+        self.connection.commit()
+        if evicted:
+            self.connection.execute("VACUUM")
+        logger.info("Evicted %d results from parse cache %s", len(evicted), self.path)
+        return len(evicted)
+
+    def close(self):
+        self.connection.close()
@@ -1,8 +1,14 @@
+import asyncio
+import hashlib
+import heapq
 import html
 import io
 import logging
-from enum import Enum
-from typing import IO, AsyncGenerator, Union
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import IO, AsyncGenerator, Callable, Dict, List, Optional, Tuple, Union
 
 import pymupdf
 from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
@@ -10,6 +16,7 @@ from azure.ai.documentintelligence.models import (
     AnalyzeDocumentRequest,
     AnalyzeResult,
     DocumentFigure,
+    DocumentSpan,
     DocumentTable,
 )
 from azure.core.credentials import AzureKeyCredential
@@ -18,29 +25,88 @@ from azure.core.exceptions import HttpResponseError
 from PIL import Image
 from pypdf import PdfReader
 
+from .figuredescriptioncache import FigureDescriptionCache
+from .mappedfile import MappedFile
 from .mediadescriber import ContentUnderstandingDescriber
 from .page import Page
+from .parsecache import ParseCache
 from .parser import Parser
 
 logger = logging.getLogger("scripts")
 
+FIGURES_PER_CROP_BATCH = 8
+PAGES_PER_EXTRACT_BATCH = 16
+
 
 class LocalPdfParser(Parser):
     """
-    Concrete parser backed by PyPDF that can parse PDFs into pages
-    To learn more, please visit https://pypi.org/project/pypdf/
+    Concrete parser backed by PyPDF or PyMuPDF that can parse PDFs into pages
+    To learn more, please visit https://pypi.org/project/pypdf/ and https://pypi.org/project/PyMuPDF/
+    Pages of large documents are extracted in worker processes, each opening the document once for a range of pages.
     """
 
+    BACKENDS = ("pypdf", "pymupdf")
+
+    def __init__(self, backend: str = "pypdf", max_workers: Optional[int] = None):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown local PDF parser backend '{backend}', expected one of {self.BACKENDS}")
+        self.backend = backend
+        self.max_workers = max_workers or os.cpu_count() or 1
+
     async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
-        logger.info("Extracting text from '%s' using local PDF parser (pypdf)", content.name)
+        logger.info("Extracting text from '%s' using local PDF parser (%s)", content.name, self.backend)
+
+        # A memory-mapped PDF is opened from its path, also by the worker processes, instead of copying its bytes
+        pdf_source: Union[bytes, str] = content.name if isinstance(content, MappedFile) else content.read()
+        page_count = count_pdf_pages(self.backend, pdf_source)
+        page_ranges = [
+            (first_page, min(first_page + PAGES_PER_EXTRACT_BATCH, page_count))
+            for first_page in range(0, page_count, PAGES_PER_EXTRACT_BATCH)
+        ]
+        if len(page_ranges) > 1 and self.max_workers > 1:
+            loop = asyncio.get_running_loop()
+            with ProcessPoolExecutor(max_workers=min(self.max_workers, len(page_ranges))) as executor:
+                extracted_ranges = await asyncio.gather(
+                    *(
+                        loop.run_in_executor(
+                            executor, extract_pdf_page_texts, self.backend, pdf_source, first_page, last_page
+                        )
+                        for first_page, last_page in page_ranges
+                    )
+                )
+        else:
+            extracted_ranges = [extract_pdf_page_texts(self.backend, pdf_source, 0, page_count)]
 
-        reader = PdfReader(content)
-        pages = reader.pages
         offset = 0
-        for page_num, p in enumerate(pages):
-            page_text = p.extract_text()
-            yield Page(page_num=page_num, offset=offset, text=page_text)
-            offset += len(page_text)
+        page_num = 0
+        for page_texts in extracted_ranges:
+            for page_text in page_texts:
+                yield Page(page_num=page_num, offset=offset, text=page_text)
+                offset += len(page_text)
+                page_num += 1
+
+
+def open_pdf(pdf_source: Union[bytes, str]) -> pymupdf.Document:
+    """Opens a PDF with PyMuPDF, from its path or from its bytes"""
+    if isinstance(pdf_source, str):
+        return pymupdf.open(pdf_source, filetype="pdf")
+    return pymupdf.open(stream=pdf_source, filetype="pdf")
+
+
+def count_pdf_pages(backend: str, pdf_source: Union[bytes, str]) -> int:
+    if backend == "pymupdf":
+        with open_pdf(pdf_source) as doc:
+            return doc.page_count
+    return len(PdfReader(pdf_source if isinstance(pdf_source, str) else io.BytesIO(pdf_source)).pages)
+
+
+def extract_pdf_page_texts(backend: str, pdf_source: Union[bytes, str], first_page: int, last_page: int) -> List[str]:
+    """Extracts the text of a range of pages of a PDF, opening it only once. This is meant to run in a worker process."""
+    if backend == "pymupdf":
+        with open_pdf(pdf_source) as doc:
+            return [doc[page_number].get_text() for page_number in range(first_page, last_page)]
+    reader = PdfReader(pdf_source if isinstance(pdf_source, str) else io.BytesIO(pdf_source))
+    return [reader.pages[page_number].extract_text() for page_number in range(first_page, last_page)]
 
 
 class DocumentAnalysisParser(Parser):
@@ -56,136 +122,350 @@ class DocumentAnalysisParser(Parser):
         model_id="prebuilt-layout",
         use_content_understanding=True,
         content_understanding_endpoint: Union[str, None] = None,
+        max_figure_concurrency: int = 8,
+        pages_per_shard: Optional[int] = None,
+        max_concurrency: int = 4,
+        parse_cache: Optional[ParseCache] = None,
+        figure_description_cache: Optional[FigureDescriptionCache] = None,
     ):
         self.model_id = model_id
         self.endpoint = endpoint
         self.credential = credential
         self.use_content_understanding = use_content_understanding
         self.content_understanding_endpoint = content_understanding_endpoint
+        self.max_figure_concurrency = max_figure_concurrency
+        # Descriptions of the figures described so far, by the SHA-256 of the cropped image,
+        # so that logos and diagrams repeated across pages and documents are only described once
+        self.figure_descriptions = (
+            figure_description_cache if figure_description_cache is not None else FigureDescriptionCache()
+        )
+        # PDFs with more pages than this are split into page ranges that are analyzed concurrently
+        self.pages_per_shard = pages_per_shard
+        self.max_concurrency = max_concurrency
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.parse_cache = parse_cache
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # Shared by all the documents analyzed by this parser, to cap the requests in flight to the resource.
+        # Created lazily so that the semaphore is bound to the event loop that actually uses it
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
 
     async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
         logger.info("Extracting text from '%s' using Azure Document Intelligence", content.name)
+        if self.use_content_understanding:
+            if self.content_understanding_endpoint is None:
+                raise ValueError("Content Understanding is enabled but no endpoint was provided")
+            if isinstance(self.credential, AzureKeyCredential):
+                raise ValueError(
+                    "AzureKeyCredential is not supported for Content Understanding, use keyless auth instead"
+                )
 
         async with DocumentIntelligenceClient(
             endpoint=self.endpoint, credential=self.credential
         ) as document_intelligence_client:
-            file_analyzed = False
-            if self.use_content_understanding:
-                if self.content_understanding_endpoint is None:
-                    raise ValueError("Content Understanding is enabled but no endpoint was provided")
-                if isinstance(self.credential, AzureKeyCredential):
-                    raise ValueError(
-                        "AzureKeyCredential is not supported for Content Understanding, use keyless auth instead"
+            content_hash: Optional[str] = None
+            if self.parse_cache is not None:
+                if isinstance(content, MappedFile):
+                    content_hash = content.sha256()
+                else:
+                    content_hash = hashlib.sha256(content.read()).hexdigest()
+                    content.seek(0)
+
+            page_ranges: List[Tuple[int, int]] = []
+            if self.pages_per_shard and content.name.lower().endswith(".pdf"):
+                if isinstance(content, MappedFile):
+                    doc = open_pdf(content.name)
+                else:
+                    doc = open_pdf(content.read())
+                    content.seek(0)
+                page_ranges = [
+                    (first_page, min(first_page + self.pages_per_shard, doc.page_count))
+                    for first_page in range(0, doc.page_count, self.pages_per_shard)
+                ]
+                if len(page_ranges) > 1:
+                    logger.info("Analyzing '%s' in %d page ranges", content.name, len(page_ranges))
+                else:
+                    doc.close()
+                    page_ranges = []
+
+            if not page_ranges:
+                async with self.semaphore:
+                    analyze_result, content_bytes = await self.analyze(
+                        document_intelligence_client, content, self.cache_key(content_hash)
                     )
-                cu_describer = ContentUnderstandingDescriber(self.content_understanding_endpoint, self.credential)
-                content_bytes = content.read()
-                try:
-                    poller = await document_intelligence_client.begin_analyze_document(
-                        model_id="prebuilt-layout",
-                        analyze_request=AnalyzeDocumentRequest(bytes_source=content_bytes),
-                        output=["figures"],
-                        features=["ocrHighResolution"],
-                        output_content_format="markdown",
+                # Figures of a memory-mapped PDF are cropped from its path, instead of copying its bytes to the workers
+                pdf_path = content.name if isinstance(content, MappedFile) else None
+                figure_htmls = await self.describe_result_figures(analyze_result, content_bytes, pdf_path)
+                offset = 0
+                for page in self.result_to_pages(analyze_result, figure_htmls):
+                    page.offset = offset
+                    offset += len(page.text)
+                    yield page
+                return
+
+            # Pages of a range are yielded as soon as that range and all the ones before it are analyzed
+            tasks = [
+                asyncio.create_task(
+                    self.analyze_page_range(
+                        document_intelligence_client,
+                        doc,
+                        content.name,
+                        first_page,
+                        last_page,
+                        self.cache_key(content_hash, f"{first_page + 1}-{last_page}"),
                     )
-                    doc_for_pymupdf = pymupdf.open(stream=io.BytesIO(content_bytes))
-                    file_analyzed = True
-                except HttpResponseError as e:
-                    content.seek(0)
-                    if e.error and e.error.code == "InvalidArgument":
-                        logger.error(
-                            "This document type does not support media description. Proceeding with standard analysis."
-                        )
-                    else:
-                        logger.error(
-                            "Unexpected error analyzing document for media description: %s. Proceeding with standard analysis.",
-                            e,
-                        )
+                )
+                for first_page, last_page in page_ranges
+            ]
+            try:
+                offset = 0
+                for (first_page, _), task in zip(page_ranges, tasks):
+                    analyze_result, figure_htmls = await task
+                    for page in self.result_to_pages(analyze_result, figure_htmls):
+                        page.page_num += first_page
+                        page.offset = offset
+                        offset += len(page.text)
+                        yield page
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                doc.close()
 
-            if file_analyzed is False:
+    async def analyze_page_range(
+        self,
+        document_intelligence_client: DocumentIntelligenceClient,
+        doc: pymupdf.Document,
+        name: str,
+        first_page: int,
+        last_page: int,
+        cache_key: Optional[str] = None,
+    ) -> Tuple[AnalyzeResult, List[str]]:
+        """
+        Analyzes the pages from first_page (included) to last_page (excluded) of a PDF.
+        The pages are copied into their own PDF, so that each request only uploads its pages,
+        and the page numbers in the result are relative to the first page of the range.
+        """
+        async with self.semaphore:
+            with pymupdf.open() as shard_doc:
+                shard_doc.insert_pdf(doc, from_page=first_page, to_page=last_page - 1)
+                # Without a new random id, the same pages always make the same PDF
+                shard_bytes = shard_doc.tobytes(no_new_id=True)
+            shard = io.BytesIO(shard_bytes)
+            shard.name = f"{name} (pages {first_page + 1}-{last_page})"
+            analyze_result, content_bytes = await self.analyze(document_intelligence_client, shard, cache_key)
+        return analyze_result, await self.describe_result_figures(analyze_result, content_bytes)
+
+    def cache_key(self, content_hash: Optional[str], page_range: str = "") -> Optional[str]:
+        """Returns the key of the analysis result in the parse cache, or None if results aren't cached"""
+        if content_hash is None:
+            return None
+        if self.use_content_understanding:
+            return ParseCache.key(content_hash, "prebuilt-layout", "figures,ocrHighResolution,markdown", page_range)
+        return ParseCache.key(content_hash, self.model_id, "", page_range)
+
+    async def analyze(
+        self, document_intelligence_client: DocumentIntelligenceClient, content: IO, cache_key: Optional[str] = None
+    ) -> Tuple[AnalyzeResult, Optional[bytes]]:
+        """Analyzes a document, returning the result and the document bytes if they were read for media description"""
+        if self.parse_cache is not None and cache_key is not None:
+            if (cached_result := self.parse_cache.get(cache_key)) is not None:
+                logger.info("Using cached analysis of '%s'", content.name)
+                return AnalyzeResult(cached_result), content.read() if self.use_content_understanding else None
+        analyze_result, content_bytes = await self.analyze_with_service(document_intelligence_client, content)
+        if self.parse_cache is not None and cache_key is not None:
+            self.parse_cache.set(cache_key, analyze_result.as_dict())
+        return analyze_result, content_bytes
+
+    async def analyze_with_service(
+        self, document_intelligence_client: DocumentIntelligenceClient, content: IO
+    ) -> Tuple[AnalyzeResult, Optional[bytes]]:
+        content_bytes = None
+        if self.use_content_understanding:
+            content_bytes = content.read()
+            try:
                 poller = await document_intelligence_client.begin_analyze_document(
-                    model_id=self.model_id, analyze_request=content, content_type="application/octet-stream"
+                    model_id="prebuilt-layout",
+                    analyze_request=AnalyzeDocumentRequest(bytes_source=content_bytes),
+                    output=["figures"],
+                    features=["ocrHighResolution"],
+                    output_content_format="markdown",
                 )
-            analyze_result: AnalyzeResult = await poller.result()
-
-            offset = 0
-            for page in analyze_result.pages:
-                tables_on_page = [
-                    table
-                    for table in (analyze_result.tables or [])
-                    if table.bounding_regions and table.bounding_regions[0].page_number == page.page_number
-                ]
-                figures_on_page = []
-                if self.use_content_understanding:
-                    figures_on_page = [
-                        figure
-                        for figure in (analyze_result.figures or [])
-                        if figure.bounding_regions and figure.bounding_regions[0].page_number == page.page_number
-                    ]
-
-                class ObjectType(Enum):
-                    NONE = -1
-                    TABLE = 0
-                    FIGURE = 1
-
-                page_offset = page.spans[0].offset
-                page_length = page.spans[0].length
-                mask_chars: list[tuple[ObjectType, Union[int, None]]] = [(ObjectType.NONE, None)] * page_length
-                # mark all positions of the table spans in the page
-                for table_idx, table in enumerate(tables_on_page):
-                    for span in table.spans:
-                        # replace all table spans with "table_id" in table_chars array
-                        for i in range(span.length):
-                            idx = span.offset - page_offset + i
-                            if idx >= 0 and idx < page_length:
-                                mask_chars[idx] = (ObjectType.TABLE, table_idx)
-                # mark all positions of the figure spans in the page
-                for figure_idx, figure in enumerate(figures_on_page):
-                    for span in figure.spans:
-                        # replace all figure spans with "figure_id" in figure_chars array
-                        for i in range(span.length):
-                            idx = span.offset - page_offset + i
-                            if idx >= 0 and idx < page_length:
-                                mask_chars[idx] = (ObjectType.FIGURE, figure_idx)
-
-                # build page text by replacing characters in table spans with table html
-                page_text = ""
-                added_objects = set()  # set of object types todo mypy
-                for idx, mask_char in enumerate(mask_chars):
-                    object_type, object_idx = mask_char
-                    if object_type == ObjectType.NONE:
-                        page_text += analyze_result.content[page_offset + idx]
-                    elif object_type == ObjectType.TABLE:
-                        if object_idx is None:
-                            raise ValueError("Expected object_idx to be set")
-                        if mask_char not in added_objects:
-                            page_text += DocumentAnalysisParser.table_to_html(tables_on_page[object_idx])
-                            added_objects.add(mask_char)
-                    elif object_type == ObjectType.FIGURE:
-                        if cu_describer is None:
-                            raise ValueError("cu_describer should not be None, unable to describe figure")
-                        if object_idx is None:
-                            raise ValueError("Expected object_idx to be set")
-                        if mask_char not in added_objects:
-                            figure_html = await DocumentAnalysisParser.figure_to_html(
-                                doc_for_pymupdf, figures_on_page[object_idx], cu_describer
-                            )
-                            page_text += figure_html
-                            added_objects.add(mask_char)
-                # We remove these comments since they are not needed and skew the page numbers
-                page_text = page_text.replace("<!-- PageBreak -->", "")
-                # We remove excess newlines at the beginning and end of the page
-                page_text = page_text.strip()
-                yield Page(page_num=page.page_number - 1, offset=offset, text=page_text)
-                offset += len(page_text)
+                return await poller.result(), content_bytes
+            except HttpResponseError as e:
+                content.seek(0)
+                if e.error and e.error.code == "InvalidArgument":
+                    logger.error(
+                        "This document type does not support media description. Proceeding with standard analysis."
+                    )
+                else:
+                    logger.error(
+                        "Unexpected error analyzing document for media description: %s. Proceeding with standard analysis.",
+                        e,
+                    )
+
+        poller = await document_intelligence_client.begin_analyze_document(
+            model_id=self.model_id, analyze_request=content, content_type="application/octet-stream"
+        )
+        return await poller.result(), content_bytes
+
+    async def describe_result_figures(
+        self, analyze_result: AnalyzeResult, content_bytes: Optional[bytes], pdf_path: Optional[str] = None
+    ) -> List[str]:
+        if not self.use_content_understanding or not analyze_result.figures or content_bytes is None:
+            return []
+        if self.content_understanding_endpoint is None or isinstance(self.credential, AzureKeyCredential):
+            raise ValueError("Content Understanding requires an endpoint and keyless auth")
+        # Each document gets its own describer, since a describer's session is closed once its figures are described
+        cu_describer = ContentUnderstandingDescriber(self.content_understanding_endpoint, self.credential)
+        return await self.describe_figures(pdf_path or content_bytes, analyze_result.figures, cu_describer)
+
+    def result_to_pages(self, analyze_result: AnalyzeResult, figure_htmls: List[str]) -> List[Page]:
+        """Builds the pages of an analysis result, with page numbers relative to the analyzed document"""
+        # Bucket tables and figures by page once, instead of scanning all of them for every page
+        tables_by_page: Dict[int, List[DocumentTable]] = defaultdict(list)
+        for table in analyze_result.tables or []:
+            if table.bounding_regions:
+                tables_by_page[table.bounding_regions[0].page_number].append(table)
+        figures_by_page: Dict[int, List[Tuple[DocumentFigure, str]]] = defaultdict(list)
+        for figure, figure_html in zip(analyze_result.figures or [], figure_htmls):
+            if figure.bounding_regions:
+                figures_by_page[figure.bounding_regions[0].page_number].append((figure, figure_html))
+
+        pages = []
+        for page in analyze_result.pages:
+            objects_on_page: List[Tuple[List[DocumentSpan], Callable[[], str]]] = [
+                (table.spans, partial(DocumentAnalysisParser.table_to_html, table))
+                for table in tables_by_page[page.page_number]
+            ]
+            objects_on_page.extend(
+                (figure.spans, partial(str, figure_html)) for figure, figure_html in figures_by_page[page.page_number]
+            )
+            page_text = DocumentAnalysisParser.page_text(analyze_result.content, page.spans[0], objects_on_page)
+            # We remove these comments since they are not needed and skew the page numbers
+            page_text = page_text.replace("<!-- PageBreak -->", "")
+            # We remove excess newlines at the beginning and end of the page
+            page_text = page_text.strip()
+            pages.append(Page(page_num=page.page_number - 1, offset=0, text=page_text))
+        return pages
 
     @staticmethod
-    async def figure_to_html(
-        doc: pymupdf.Document, figure: DocumentFigure, cu_describer: ContentUnderstandingDescriber
+    def page_text(
+        content: str, page_span: DocumentSpan, objects: List[Tuple[List[DocumentSpan], Callable[[], str]]]
     ) -> str:
-        figure_title = (figure.caption and figure.caption.content) or ""
-        logger.info("Describing figure %s with title '%s'", figure.id, figure_title)
+        """
+        Builds the text of a page, replacing the spans of each table or figure with its HTML.
+        Text covered by several objects belongs to the object listed last, so figures take precedence over tables.
+        The HTML of an object is inserted where the first text belonging to it starts.
+        """
+        page_start = page_span.offset
+        page_end = page_span.offset + page_span.length
+        intervals = []
+        for object_idx, (spans, _) in enumerate(objects):
+            for span in spans:
+                start = max(span.offset, page_start)
+                end = min(span.offset + span.length, page_end)
+                if start < end:
+                    intervals.append((start, end, object_idx))
+        intervals.sort()
+        boundaries = sorted({page_start, page_end}.union(*((start, end) for start, end, _ in intervals)))
+
+        parts = []
+        added_objects = set()
+        # Max-heap of the objects covering the current position, by object index
+        covering: List[Tuple[int, int]] = []
+        next_interval = 0
+        for segment_start, segment_end in zip(boundaries, boundaries[1:]):
+            while next_interval < len(intervals) and intervals[next_interval][0] <= segment_start:
+                _, end, object_idx = intervals[next_interval]
+                heapq.heappush(covering, (-object_idx, end))
+                next_interval += 1
+            while covering and covering[0][1] <= segment_start:
+                heapq.heappop(covering)
+            if not covering:
+                parts.append(content[segment_start:segment_end])
+                continue
+            owner = -covering[0][0]
+            if owner not in added_objects:
+                parts.append(objects[owner][1]())
+                added_objects.add(owner)
+        return "".join(parts)
+
+    async def describe_figures(
+        self,
+        pdf_source: Union[bytes, str],
+        figures: List[DocumentFigure],
+        cu_describer: ContentUnderstandingDescriber,
+    ) -> List[str]:
+        """
+        Describes all the figures of a document concurrently, and returns the HTML of each figure in order.
+        Figures are cropped from the PDF, given by its path or its bytes, in worker processes,
+        since rendering at 300 DPI is CPU bound. Each worker opens the PDF once, for all the batches it crops.
+        """
+        regions = [
+            (index, DocumentAnalysisParser.figure_page_and_bounding_box(figure))
+            for index, figure in enumerate(figures)
+            if figure.bounding_regions
+        ]
+        images: Dict[int, bytes] = {}
+        if regions:
+            region_batches = [
+                regions[i : i + FIGURES_PER_CROP_BATCH] for i in range(0, len(regions), FIGURES_PER_CROP_BATCH)
+            ]
+            loop = asyncio.get_running_loop()
+            with ProcessPoolExecutor(
+                max_workers=min(os.cpu_count() or 1, len(region_batches)),
+                initializer=open_worker_pdf,
+                initargs=(pdf_source,),
+            ) as executor:
+                cropped_batches = await asyncio.gather(
+                    *(
+                        loop.run_in_executor(executor, crop_images_from_worker_pdf, [region for _, region in batch])
+                        for batch in region_batches
+                    )
+                )
+            for batch, cropped in zip(region_batches, cropped_batches):
+                images.update((index, image) for (index, _), image in zip(batch, cropped))
+
+        hashes = {index: hashlib.sha256(image).hexdigest() for index, image in images.items()}
+        descriptions = self.figure_descriptions.get_many(list(hashes.values()))
+        # Identical figures within the document are only described once
+        images_to_describe = {
+            image_hash: images[index] for index, image_hash in hashes.items() if image_hash not in descriptions
+        }
+        if images_to_describe:
+            logger.info(
+                "Describing %d figures (%d unique, %d already described)",
+                len(images),
+                len(set(hashes.values())),
+                len(set(hashes.values())) - len(images_to_describe),
+            )
+            limit = asyncio.Semaphore(self.max_figure_concurrency)
+
+            new_descriptions: Dict[str, str] = {}
+
+            async def describe(image_hash: str, image: bytes):
+                async with limit:
+                    new_descriptions[image_hash] = await cu_describer.describe_image(image)
+
+            async with cu_describer:
+                await asyncio.gather(*(describe(image_hash, image) for image_hash, image in images_to_describe.items()))
+            self.figure_descriptions.set_many(new_descriptions)
+            descriptions.update(new_descriptions)
+
+        return [
+            DocumentAnalysisParser.figure_html(figure, descriptions[hashes[index]] if index in hashes else None)
+            for index, figure in enumerate(figures)
+        ]
+
+    @staticmethod
+    def figure_page_and_bounding_box(figure: DocumentFigure) -> Tuple[int, Tuple[float, float, float, float]]:
+        """Returns the 0-indexed page number and the bounding box in inches of the first region of a figure"""
         if not figure.bounding_regions:
-            return f"<figure><figcaption>{figure_title}</figcaption></figure>"
+            raise ValueError(f"Figure {figure.id} has no bounding region")
         if len(figure.bounding_regions) > 1:
             logger.warning("Figure %s has more than one bounding region, using the first one", figure.id)
         first_region = figure.bounding_regions[0]
@@ -197,8 +477,13 @@ class DocumentAnalysisParser(Parser):
             first_region.polygon[5],  # y1 (bottom)
         )
         page_number = first_region["pageNumber"]  # 1-indexed
-        cropped_img = DocumentAnalysisParser.crop_image_from_pdf_page(doc, page_number - 1, bounding_box)
-        figure_description = await cu_describer.describe_image(cropped_img)
+        return page_number - 1, bounding_box
+
+    @staticmethod
+    def figure_html(figure: DocumentFigure, figure_description: Optional[str]) -> str:
+        figure_title = (figure.caption and figure.caption.content) or ""
+        if figure_description is None:
+            return f"<figure><figcaption>{figure_title}</figcaption></figure>"
         return f"<figure><figcaption>{figure_title}<br>{figure_description}</figcaption></figure>"
 
     @staticmethod
@@ -248,3 +533,34 @@ class DocumentAnalysisParser(Parser):
         bytes_io = io.BytesIO()
         img.save(bytes_io, format="PNG")
         return bytes_io.getvalue()
+
+
+def crop_images_from_pdf(
+    pdf_source: Union[bytes, str], regions: List[Tuple[int, Tuple[float, float, float, float]]]
+) -> List[bytes]:
+    """Crops regions from the pages of a PDF, given by its path or its bytes, opening it only once"""
+    with open_pdf(pdf_source) as doc:
+        return [
+            DocumentAnalysisParser.crop_image_from_pdf_page(doc, page_number, bounding_box)
+            for page_number, bounding_box in regions
+        ]
+
+
+# The PDF that the figures are cropped from, in each worker process of DocumentAnalysisParser.describe_figures
+worker_pdf: Optional[pymupdf.Document] = None
+
+
+def open_worker_pdf(pdf_source: Union[bytes, str]):
+    """Opens the PDF of a worker process once, when the process starts, for all the batches of figures it crops"""
+    global worker_pdf
+    worker_pdf = open_pdf(pdf_source)
+
+
+def crop_images_from_worker_pdf(regions: List[Tuple[int, Tuple[float, float, float, float]]]) -> List[bytes]:
+    """Crops regions from the pages of the PDF opened by open_worker_pdf. This is meant to run in a worker process."""
+    if worker_pdf is None:
+        raise ValueError("The PDF of the worker process wasn't opened")
+    return [
+        DocumentAnalysisParser.crop_image_from_pdf_page(worker_pdf, page_number, bounding_box)
+        for page_number, bounding_box in regions
+    ]
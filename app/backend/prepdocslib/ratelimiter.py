@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, Mapping, Optional
+
+logger = logging.getLogger("scripts")
+
+
+class TokenBucket:
+    """
+    Bucket that refills continuously up to a per-minute capacity, used to model TPM and RPM quotas
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.level = float(per_minute)
+        self.refill_rate = per_minute / 60.0
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.refill_rate)
+        self.updated_at = now
+
+    def delay_for(self, amount: float) -> float:
+        self.refill()
+        # A single request larger than the whole bucket would otherwise never be admitted
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.refill_rate
+
+    def consume(self, amount: float):
+        self.level -= min(amount, self.capacity)
+
+    def sync(self, remaining: float):
+        # The service's view of the remaining quota wins if it is lower than ours
+        self.refill()
+        self.level = min(self.level, remaining)
+
+
+def parse_retry_after(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """Returns the number of seconds the service asked us to wait, if any"""
+    if not headers:
+        return None
+    try:
+        if retry_after_ms := headers.get("retry-after-ms"):
+            return float(retry_after_ms) / 1000
+        if retry_after := headers.get("retry-after"):
+            return float(retry_after)
+    except ValueError:
+        # Retry-After may also be an HTTP date, which we don't bother with
+        pass
+    return None
+
+
+class AdaptiveRateLimiter:
+    """
+    Limits concurrent requests to an API, and optionally the tokens and requests sent per minute.
+    The number of requests in flight adapts with additive-increase/multiplicative-decrease (AIMD):
+    it grows by one slot per window of successful requests and is halved whenever we are throttled.
+    The x-ratelimit-remaining-* and Retry-After headers returned by the service are used to keep the local
+    quota in sync with the service.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 4,
+        tokens_per_minute: Optional[int] = None,
+        requests_per_minute: Optional[int] = None,
+    ):
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = float(self.max_concurrency)
+        self.in_flight = 0
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.paused_until = 0.0
+        self._condition: Optional[asyncio.Condition] = None
+
+    @property
+    def condition(self) -> asyncio.Condition:
+        # Created lazily so that the condition is bound to the event loop that actually uses it
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    def quota_delay(self, tokens: int) -> float:
+        delay = self.paused_until - time.monotonic()
+        if self.token_bucket:
+            delay = max(delay, self.token_bucket.delay_for(tokens))
+        if self.request_bucket:
+            delay = max(delay, self.request_bucket.delay_for(1))
+        return delay
+
+    async def acquire(self, tokens: int = 0):
+        async with self.condition:
+            while True:
+                if self.in_flight >= int(self.concurrency):
+                    await self.condition.wait()
+                    continue
+                delay = self.quota_delay(tokens)
+                if delay <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self.condition.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+            if self.token_bucket:
+                self.token_bucket.consume(tokens)
+            if self.request_bucket:
+                self.request_bucket.consume(1)
+            self.in_flight += 1
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    @asynccontextmanager
+    async def limit(self, tokens: int = 0) -> AsyncGenerator[None, None]:
+        await self.acquire(tokens)
+        try:
+            yield
+        finally:
+            await self.release()
+
+    def sync_with_headers(self, headers: Optional[Mapping[str, str]]) -> bool:
+        """Updates the local buckets from the service headers, returns True if the service quota is exhausted"""
+        if not headers:
+            return False
+        exhausted = False
+        for header, bucket in (
+            ("x-ratelimit-remaining-tokens", self.token_bucket),
+            ("x-ratelimit-remaining-requests", self.request_bucket),
+        ):
+            value = headers.get(header)
+            if value is None:
+                continue
+            try:
+                remaining = float(value)
+            except ValueError:
+                continue
+            if bucket:
+                bucket.sync(remaining)
+            exhausted = exhausted or remaining <= 0
+        return exhausted
+
+    def on_success(self, headers: Optional[Mapping[str, str]] = None):
+        if self.sync_with_headers(headers):
+            self.decrease()
+        elif self.concurrency < self.max_concurrency:
+            self.concurrency = min(float(self.max_concurrency), self.concurrency + 1 / self.concurrency)
+
+    def on_rate_limited(self, headers: Optional[Mapping[str, str]] = None):
+        self.sync_with_headers(headers)
+        self.decrease()
+        if retry_after := parse_retry_after(headers):
+            logger.info("Service asked us to retry after %.1f seconds", retry_after)
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def decrease(self):
+        self.concurrency = max(1.0, self.concurrency / 2)
@@ -1,8 +1,11 @@
 import asyncio
+import hashlib
 import logging
 import os
-from typing import List, Optional
+from typing import Dict, List, Optional, Set
 
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.models import (
     AzureOpenAIVectorizer,
     AzureOpenAIVectorizerParameters,
@@ -23,13 +26,20 @@ from azure.search.documents.indexes.models import (
 )
 
 from .blobmanager import BlobManager
+from .embeddingcache import EmbeddingCache
 from .embeddings import AzureOpenAIEmbeddingService, OpenAIEmbeddings
+from .indexingwriter import MAX_BATCH_DOCUMENTS, IndexingWriter
 from .listfilestrategy import File
 from .strategy import SearchInfo
 from .textsplitter import SplitPage
 
 logger = logging.getLogger("scripts")
 
+# Upper bound on the number of sections we look up when diffing a file against the index
+MAX_FILE_SECTIONS = 100000
+REMOVE_PAGE_SIZE = 1000
+IMAGE_EMBEDDING_DIMENSIONS = 1024
+
 
 class Section:
     """
@@ -56,6 +66,8 @@ class SearchManager:
         use_int_vectorization: bool = False,
         embeddings: Optional[OpenAIEmbeddings] = None,
         search_images: bool = False,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        upload_concurrency: int = 4,
     ):
         self.search_info = search_info
         self.search_analyzer_name = search_analyzer_name
@@ -65,6 +77,8 @@ class SearchManager:
         # Integrated vectorization uses the ada-002 model with 1536 dimensions
         self.embedding_dimensions = self.embeddings.open_ai_dimensions if self.embeddings else 1536
         self.search_images = search_images
+        self.embedding_cache = embedding_cache
+        self.upload_concurrency = upload_concurrency
 
     async def create_index(self, vectorizers: Optional[List[VectorSearchVectorizer]] = None):
         logger.info("Checking whether search index %s exists...", self.search_info.index_name)
@@ -75,7 +89,8 @@ class SearchManager:
                 logger.info("Creating new search index %s", self.search_info.index_name)
                 fields = [
                     (
-                        SimpleField(name="id", type="Edm.String", key=True)
+                        # Sortable and filterable so that documents can be paged through by id
+                        SimpleField(name="id", type="Edm.String", key=True, sortable=True, filterable=True)
                         if not self.use_int_vectorization
                         else SearchField(
                             name="id",
@@ -152,7 +167,7 @@ class SearchManager:
                             filterable=False,
                             sortable=False,
                             facetable=False,
-                            vector_search_dimensions=1024,
+                            vector_search_dimensions=IMAGE_EMBEDDING_DIMENSIONS,
                             vector_search_profile_name="embedding_config",
                         ),
                     )
@@ -252,80 +267,248 @@ class SearchManager:
                             self.search_info,
                         )
 
+    @staticmethod
+    def section_id(file_id: str, document: dict) -> str:
+        """
+        Builds a document id from the content of a section rather than its position in the file,
+        so that editing one part of a file doesn't change the ids of all the sections after it
+        """
+        content_hash = hashlib.sha256(
+            "\n".join(
+                [
+                    document["sourcepage"],
+                    document["category"] or "",
+                    document.get("storageUrl") or "",
+                    document["content"],
+                ]
+            ).encode()
+        ).hexdigest()[:32]
+        return f"{file_id}-{content_hash}"
+
+    async def get_existing_ids(self, search_client: SearchClient, sourcefile: str, file_id: str) -> Set[str]:
+        """Returns the ids of the documents already in the index for a file"""
+        # Replace ' with '' to escape the single quote for the filter
+        sourcefile_for_filter = sourcefile.replace("'", "''")
+        results = await search_client.search(
+            search_text="", filter=f"sourcefile eq '{sourcefile_for_filter}'", select=["id"], top=MAX_FILE_SECTIONS
+        )
+        # Files with the same name but different access control have different id prefixes, leave them alone
+        return {document["id"] async for document in results if document["id"].startswith(f"{file_id}-")}
+
     async def update_content(
         self, sections: List[Section], image_embeddings: Optional[List[List[float]]] = None, url: Optional[str] = None
-    ):
-        MAX_BATCH_SIZE = 1000
-        section_batches = [sections[i : i + MAX_BATCH_SIZE] for i in range(0, len(sections), MAX_BATCH_SIZE)]
+    ) -> List[str]:
+        """
+        Indexes the sections of a file, and returns the ids of all its documents.
+        Only sections that are new or changed since the last ingestion are embedded and uploaded,
+        and sections that are no longer in the file are deleted from the index.
+        """
+        documents = []
+        for section in sections:
+            document = {
+                "content": section.split_page.text,
+                "category": section.category,
+                "sourcepage": (
+                    BlobManager.blob_image_name_from_file_page(
+                        filename=section.content.filename(),
+                        page=section.split_page.page_num,
+                    )
+                    if image_embeddings
+                    else BlobManager.sourcepage_from_file_page(
+                        filename=section.content.filename(),
+                        page=section.split_page.page_num,
+                    )
+                ),
+                "sourcefile": section.content.filename(),
+                **section.content.acls,
+            }
+            if url:
+                document["storageUrl"] = url
+            documents.append(document)
+
+        occurrences: Dict[str, int] = {}
+        for section, document in zip(sections, documents):
+            section_id = SearchManager.section_id(section.content.filename_to_id(), document)
+            occurrence = occurrences.get(section_id, 0)
+            occurrences[section_id] = occurrence + 1
+            # Repeated identical sections (like boilerplate on every page) still need distinct ids
+            document["id"] = f"{section_id}-{occurrence}" if occurrence else section_id
+        document_ids = [document["id"] for document in documents]
 
         async with self.search_info.create_search_client() as search_client:
-            for batch_index, batch in enumerate(section_batches):
-                documents = [
-                    {
-                        "id": f"{section.content.filename_to_id()}-page-{section_index + batch_index * MAX_BATCH_SIZE}",
-                        "content": section.split_page.text,
-                        "category": section.category,
-                        "sourcepage": (
-                            BlobManager.blob_image_name_from_file_page(
-                                filename=section.content.filename(),
-                                page=section.split_page.page_num,
-                            )
-                            if image_embeddings
-                            else BlobManager.sourcepage_from_file_page(
-                                filename=section.content.filename(),
-                                page=section.split_page.page_num,
-                            )
-                        ),
-                        "sourcefile": section.content.filename(),
-                        **section.content.acls,
-                    }
-                    for section_index, section in enumerate(batch)
-                ]
-                if url:
-                    for document in documents:
-                        document["storageUrl"] = url
-                if self.embeddings:
-                    embeddings = await self.embeddings.create_embeddings(
-                        texts=[section.split_page.text for section in batch]
-                    )
-                    for i, document in enumerate(documents):
-                        document["embedding"] = embeddings[i]
-                if image_embeddings:
-                    for i, (document, section) in enumerate(zip(documents, batch)):
-                        document["imageEmbedding"] = image_embeddings[section.split_page.page_num]
+            existing_ids: Set[str] = set()
+            files = {section.content.filename_to_id(): section.content.filename() for section in sections}
+            for file_id, sourcefile in files.items():
+                existing_ids |= await self.get_existing_ids(search_client, sourcefile, file_id)
+
+            changed = [
+                (section, document)
+                for section, document in zip(sections, documents)
+                if document["id"] not in existing_ids
+            ]
+            orphan_ids = sorted(existing_ids - set(document_ids))
+            async with IndexingWriter(search_client, max_concurrency=self.upload_concurrency) as writer:
+                # Embeddings are computed one batch at a time, while the writer uploads the previous batches
+                for i in range(0, len(changed), MAX_BATCH_DOCUMENTS):
+                    batch = changed[i : i + MAX_BATCH_DOCUMENTS]
+                    batch_documents = [document for _, document in batch]
+                    if self.embeddings:
+                        embeddings = await self.create_embeddings(
+                            texts=[section.split_page.text for section, _ in batch]
+                        )
+                        for document, embedding in zip(batch_documents, embeddings):
+                            document["embedding"] = embedding
+                    if image_embeddings:
+                        for section, document in batch:
+                            document["imageEmbedding"] = image_embeddings[section.split_page.page_num]
+                    await writer.merge_or_upload_documents(batch_documents)
+                await writer.delete_documents([{"id": orphan_id} for orphan_id in orphan_ids])
+
+        logger.info(
+            "Uploaded %d new or changed sections, kept %d unchanged sections, deleted %d stale sections",
+            len(changed),
+            len(documents) - len(changed),
+            len(orphan_ids),
+        )
+        return document_ids
+
+    async def create_embeddings(self, texts: List[str]) -> List[List[float]]:
+        if self.embeddings is None:
+            raise ValueError("An embeddings service is required to compute embeddings")
+        if self.embedding_cache is None:
+            return await self.embeddings.create_embeddings(texts=texts)
 
-                await search_client.upload_documents(documents)
+        keys = [
+            EmbeddingCache.key(self.embeddings.open_ai_model_name, self.embeddings.open_ai_dimensions, text)
+            for text in texts
+        ]
+        cached = self.embedding_cache.get_many(keys)
+        # Identical chunks (like repeated headers) only need to be embedded once
+        missing = {key: text for key, text in zip(keys, texts) if key not in cached}
+        if missing:
+            new_embeddings = await self.embeddings.create_embeddings(texts=list(missing.values()))
+            computed = dict(zip(missing.keys(), new_embeddings))
+            self.embedding_cache.set_many(computed)
+            cached.update(computed)
+        logger.info(
+            "Embedding cache: %d of %d sections found, cumulative hit rate %.1f%%",
+            len(texts) - sum(1 for key in keys if key in missing),
+            len(texts),
+            self.embedding_cache.hit_rate() * 100,
+        )
+        return [cached[key] for key in keys]
 
     async def remove_content(self, path: Optional[str] = None, only_oid: Optional[str] = None):
         logger.info(
             "Removing sections from '{%s or '<all>'}' from search index '%s'", path, self.search_info.index_name
         )
+        filter = None
+        if path is not None:
+            # Replace ' with '' to escape the single quote for the filter
+            # https://learn.microsoft.com/azure/search/query-odata-filter-orderby-syntax#escaping-special-characters-in-string-constants
+            path_for_filter = os.path.basename(path).replace("'", "''")
+            filter = f"sourcefile eq '{path_for_filter}'"
+        # Only retrieve the keys, and the oids if we need to check them
+        select = ["id", "oids"] if only_oid else ["id"]
         async with self.search_info.create_search_client() as search_client:
-            while True:
-                filter = None
-                if path is not None:
-                    # Replace ' with '' to escape the single quote for the filter
-                    # https://learn.microsoft.com/azure/search/query-odata-filter-orderby-syntax#escaping-special-characters-in-string-constants
-                    path_for_filter = os.path.basename(path).replace("'", "''")
-                    filter = f"sourcefile eq '{path_for_filter}'"
-                max_results = 1000
+            async with IndexingWriter(search_client, max_concurrency=self.upload_concurrency) as writer:
+                try:
+                    removed = await self.remove_by_id_order(search_client, writer, filter, select, only_oid)
+                except HttpResponseError as error:
+                    # Indexes created by older versions don't have a sortable and filterable id field
+                    logger.info("Can't page through search index by id (%s), removing sections in pages", error.message)
+                    removed = await self.remove_by_pages(search_client, writer, filter, select, only_oid)
+        logger.info("Removed %d sections from index", removed)
+
+    async def remove_documents(self, document_ids: List[str]):
+        """Removes documents from the search index by id"""
+        async with self.search_info.create_search_client() as search_client:
+            async with IndexingWriter(search_client, max_concurrency=self.upload_concurrency) as writer:
+                await writer.delete_documents([{"id": document_id} for document_id in document_ids])
+        logger.info("Removed %d sections from index", len(document_ids))
+
+    async def remove_by_id_order(
+        self,
+        search_client: SearchClient,
+        writer: IndexingWriter,
+        filter: Optional[str],
+        select: List[str],
+        only_oid: Optional[str],
+    ) -> int:
+        """
+        Removes matching documents in a single pass, paging through them in id order.
+        Deletes are sent in the background while the next page is retrieved.
+        """
+        removed = 0
+        last_id: Optional[str] = None
+        while True:
+            page_filter = filter
+            if last_id is not None:
+                id_filter = "id gt '{}'".format(last_id.replace("'", "''"))
+                page_filter = f"({filter}) and {id_filter}" if filter else id_filter
+            result = await search_client.search(
+                search_text="", filter=page_filter, select=select, order_by=["id asc"], top=REMOVE_PAGE_SIZE
+            )
+            documents = [document async for document in result]
+            documents_to_remove = [
+                # If only_oid is set, only remove documents that have only this oid
+                {"id": document["id"]}
+                for document in documents
+                if not only_oid or document.get("oids") == [only_oid]
+            ]
+            await writer.delete_documents(documents_to_remove)
+            removed += len(documents_to_remove)
+            if len(documents) < REMOVE_PAGE_SIZE:
+                return removed
+            last_id = documents[-1]["id"]
+
+    async def remove_by_pages(
+        self,
+        search_client: SearchClient,
+        writer: IndexingWriter,
+        filter: Optional[str],
+        select: List[str],
+        only_oid: Optional[str],
+    ) -> int:
+        """
+        Removes matching documents without ordering them, by deleting snapshots of up to MAX_FILE_SECTIONS documents.
+        Documents that were already deleted may still be returned until the index catches up, those are skipped.
+        """
+        seen_ids: Set[str] = set()
+        removed = 0
+        delay = 0.5
+        last_round_deleted = False
+        while True:
+            documents_to_remove = []
+            complete = False
+            found_new = False
+            for skip in range(0, MAX_FILE_SECTIONS, REMOVE_PAGE_SIZE):
                 result = await search_client.search(
-                    search_text="", filter=filter, top=max_results, include_total_count=True
+                    search_text="", filter=filter, select=select, top=REMOVE_PAGE_SIZE, skip=skip
                 )
-                result_count = await result.get_count()
-                if result_count == 0:
-                    break
-                documents_to_remove = []
-                async for document in result:
+                documents = [document async for document in result]
+                for document in documents:
+                    if document["id"] in seen_ids:
+                        continue
+                    seen_ids.add(document["id"])
+                    found_new = True
                     # If only_oid is set, only remove documents that have only this oid
                     if not only_oid or document.get("oids") == [only_oid]:
                         documents_to_remove.append({"id": document["id"]})
-                if len(documents_to_remove) == 0:
-                    if result_count < max_results:
-                        break
-                    else:
-                        continue
-                removed_docs = await search_client.delete_documents(documents_to_remove)
-                logger.info("Removed %d sections from index", len(removed_docs))
-                # It can take a few seconds for search results to reflect changes, so wait a bit
-                await asyncio.sleep(2)
+                if len(documents) < REMOVE_PAGE_SIZE:
+                    complete = True
+                    break
+            await writer.delete_documents(documents_to_remove)
+            await writer.flush()
+            removed += len(documents_to_remove)
+            if complete:
+                return removed
+            if not found_new:
+                if not last_round_deleted:
+                    # None of the documents we keep getting back are ones we want to remove
+                    return removed
+                # Every document we got back is already deleted, give the index time to catch up
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+            else:
+                last_round_deleted = bool(documents_to_remove)
@@ -1,9 +1,10 @@
 import logging
 from abc import ABC
-from typing import Generator, List
+from typing import Generator, Iterable, List, Optional
 
 import tiktoken
 
+from .csvparser import ROW_SEPARATOR
 from .page import Page, SplitPage
 
 logger = logging.getLogger("scripts")
@@ -216,17 +217,80 @@ class SimpleTextSplitter(TextSplitter):
     def __init__(self, max_object_length: int = 1000):
         self.max_object_length = max_object_length
 
-    def split_pages(self, pages: List[Page]) -> Generator[SplitPage, None, None]:
-        all_text = "".join(page.text for page in pages)
-        if len(all_text.strip()) == 0:
-            return
-
-        length = len(all_text)
-        if length <= self.max_object_length:
-            yield SplitPage(page_num=0, text=all_text)
-            return
+    def split_pages(self, pages: Iterable[Page]) -> Generator[SplitPage, None, None]:
+        # Cut the text of the pages into objects as it goes, instead of joining the text of all the pages.
+        # Nothing is yielded if all the text is whitespace, so objects are held back until one has some text
+        held_back: Optional[List[SplitPage]] = []
+        parts: List[str] = []
+        parts_length = 0
+        page_num = 0
+
+        def flush() -> List[SplitPage]:
+            nonlocal held_back
+            split_page = SplitPage(page_num=page_num, text="".join(parts))
+            if held_back is None:
+                return [split_page]
+            held_back.append(split_page)
+            if not split_page.text.strip():
+                return []
+            split_pages, held_back = held_back, None
+            return split_pages
+
+        for page in pages:
+            text = page.text
+            while text:
+                piece = text[: self.max_object_length - parts_length]
+                text = text[len(piece) :]
+                parts.append(piece)
+                parts_length += len(piece)
+                if parts_length == self.max_object_length:
+                    yield from flush()
+                    page_num += 1
+                    parts = []
+                    parts_length = 0
+        if parts:
+            yield from flush()
+
+
+class RowTextSplitter(TextSplitter):
+    """
+    Class that splits pages of rows, like the pages of the CsvParser, into chunks of whole rows.
+    Rows are separated by the ROW_SEPARATOR of the CsvParser, so that rows with multiline cells stay whole,
+    and are packed, one per line, into sections of up to max_section_length characters
+    and max_tokens_per_section tokens, without ever joining the text of all the pages.
+    Rows that are too long on their own are split with the SentenceTextSplitter.
+    """
 
-        # its too big, so we need to split it
-        for i in range(0, length, self.max_object_length):
-            yield SplitPage(page_num=i // self.max_object_length, text=all_text[i : i + self.max_object_length])
-        return
+    def __init__(self, max_section_length: int = DEFAULT_SECTION_LENGTH, max_tokens_per_section: int = 500):
+        self.max_section_length = max_section_length
+        self.max_tokens_per_section = max_tokens_per_section
+        self.sentence_text_splitter = SentenceTextSplitter(max_tokens_per_section=max_tokens_per_section)
+
+    def split_pages(self, pages: Iterable[Page]) -> Generator[SplitPage, None, None]:
+        rows: List[str] = []
+        rows_length = 0
+        rows_tokens = 0
+        section_page_num = 0
+        for page in pages:
+            for row in page.text.split(ROW_SEPARATOR):
+                if not row.strip():
+                    continue
+                row_tokens = len(bpe.encode(row))
+                if rows and (
+                    rows_length + 1 + len(row) > self.max_section_length
+                    or rows_tokens + row_tokens > self.max_tokens_per_section
+                ):
+                    yield SplitPage(page_num=section_page_num, text="\n".join(rows))
+                    rows = []
+                    rows_length = 0
+                    rows_tokens = 0
+                if len(row) > self.max_section_length or row_tokens > self.max_tokens_per_section:
+                    yield from self.sentence_text_splitter.split_page_by_max_tokens(page_num=page.page_num, text=row)
+                    continue
+                if not rows:
+                    section_page_num = page.page_num
+                rows_length += len(row) + (1 if rows else 0)
+                rows_tokens += row_tokens
+                rows.append(row)
+        if rows:
+            yield SplitPage(page_num=section_page_num, text="\n".join(rows))
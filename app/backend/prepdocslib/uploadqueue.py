@@ -0,0 +1,538 @@
+import asyncio
+import functools
+import io
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import (
+    Any,
+    AsyncIterator,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    MutableMapping,
+    Optional,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+from azure.storage.filedatalake.aio import FileSystemClient
+
+from .filestrategy import UploadUserFileStrategy
+from .listfilestrategy import File
+from .mappedfile import MappedFile
+
+logger = logging.getLogger("scripts")
+
+JOB_QUEUED = "queued"
+JOB_PROCESSING = "processing"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+# A process renews the lease of its unfinished jobs while it runs,
+# so the jobs of a process that stopped are picked up by another process once their lease expires
+JOB_LEASE_SECONDS = 60
+# Finished jobs are kept this long, for their status to be polled
+FINISHED_JOB_RETENTION_SECONDS = 24 * 60 * 60
+# Processes waiting for a file locked by another process check whether it was released this often
+FILE_LOCK_POLL_SECONDS = 0.5
+
+T = TypeVar("T")
+Method = TypeVar("Method", bound=Callable[..., Any])
+
+
+def synchronized(method: Method) -> Method:
+    """Holds the lock of the store while a method uses its connection, which is shared by threads"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper  # type: ignore[return-value]
+
+
+class UploadJobStore:
+    """
+    Durable record of the ingestion jobs of uploaded files, stored in a local SQLite database that can be shared
+    by the worker processes of the app. Each unfinished job is leased by the process that will process it.
+    The methods block while SQLite waits for other processes, so async code calls them with run.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if directory := os.path.dirname(path):
+            os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        # Transactions are explicit, so that claiming jobs is atomic across processes,
+        # and the connection is used by the threads that run the methods of the store
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs "
+            "(id TEXT PRIMARY KEY, user_oid TEXT NOT NULL, filename TEXT NOT NULL, path TEXT NOT NULL, url TEXT, "
+            "status TEXT NOT NULL, error TEXT, created REAL NOT NULL, updated REAL NOT NULL, "
+            "owner TEXT NOT NULL, lease_until REAL NOT NULL, content_hash TEXT)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_until)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_oid, status)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS indexed_files "
+            "(user_oid TEXT NOT NULL, filename TEXT NOT NULL, content_hash TEXT NOT NULL, updated REAL NOT NULL, "
+            "PRIMARY KEY (user_oid, filename))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS listing_versions (user_oid TEXT PRIMARY KEY, version INTEGER NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS file_locks "
+            "(user_oid TEXT NOT NULL, filename TEXT NOT NULL, owner TEXT NOT NULL, lease_until REAL NOT NULL, "
+            "PRIMARY KEY (user_oid, filename))"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS user_files "
+            "(user_oid TEXT NOT NULL, filename TEXT NOT NULL, size INTEGER NOT NULL, PRIMARY KEY (user_oid, filename))"
+        )
+
+    @synchronized
+    def add(
+        self,
+        job_id: str,
+        user_oid: str,
+        filename: str,
+        path: str,
+        url: Optional[str],
+        owner: str,
+        content_hash: Optional[str] = None,
+    ):
+        now = time.time()
+        self.connection.execute(
+            "INSERT INTO jobs "
+            "(id, user_oid, filename, path, url, status, error, created, updated, owner, lease_until, content_hash) "
+            "VALUES (?, ?, ?, ?, ?, ?, NULL, ?, ?, ?, ?, ?)",
+            (job_id, user_oid, filename, path, url, JOB_QUEUED, now, now, owner, now + JOB_LEASE_SECONDS, content_hash),
+        )
+
+    @synchronized
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self.connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    @synchronized
+    def set_status(self, job_id: str, status: str, error: Optional[str] = None):
+        self.connection.execute(
+            "UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ?", (status, error, time.time(), job_id)
+        )
+
+    @synchronized
+    def find_unfinished(self, user_oid: str, filename: str, content_hash: str) -> Optional[Dict[str, Any]]:
+        """Returns an unfinished job ingesting the same content for the same user and filename, if any"""
+        row = self.connection.execute(
+            "SELECT * FROM jobs WHERE user_oid = ? AND status IN (?, ?) AND filename = ? AND content_hash = ? "
+            "ORDER BY created LIMIT 1",
+            (user_oid, JOB_QUEUED, JOB_PROCESSING, filename, content_hash),
+        ).fetchone()
+        return dict(row) if row is not None else None
+
+    @synchronized
+    def count_unfinished(self, user_oid: str) -> int:
+        row = self.connection.execute(
+            "SELECT COUNT(*) FROM jobs WHERE user_oid = ? AND status IN (?, ?)",
+            (user_oid, JOB_QUEUED, JOB_PROCESSING),
+        ).fetchone()
+        return row[0]
+
+    @synchronized
+    def fail_unfinished(self, user_oid: str, filename: str, error: str):
+        """Marks the unfinished jobs of a file as failed, so that they aren't processed"""
+        self.connection.execute(
+            "UPDATE jobs SET status = ?, error = ?, updated = ? WHERE user_oid = ? AND filename = ? AND status IN (?, ?)",
+            (JOB_FAILED, error, time.time(), user_oid, filename, JOB_QUEUED, JOB_PROCESSING),
+        )
+
+    @synchronized
+    def renew(self, owner: str):
+        """Extends the lease of the unfinished jobs of a process"""
+        self.connection.execute(
+            "UPDATE jobs SET lease_until = ? WHERE owner = ? AND status IN (?, ?)",
+            (time.time() + JOB_LEASE_SECONDS, owner, JOB_QUEUED, JOB_PROCESSING),
+        )
+
+    @synchronized
+    def claim_abandoned(self, owner: str) -> List[Dict[str, Any]]:
+        """Takes over the unfinished jobs of other processes whose lease expired, returning them oldest first"""
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.connection.execute(
+                "SELECT * FROM jobs WHERE status IN (?, ?) AND lease_until < ? AND owner != ? ORDER BY created",
+                (JOB_QUEUED, JOB_PROCESSING, now, owner),
+            ).fetchall()
+            self.connection.executemany(
+                "UPDATE jobs SET owner = ?, lease_until = ?, status = ? WHERE id = ?",
+                [(owner, now + JOB_LEASE_SECONDS, JOB_QUEUED, row["id"]) for row in rows],
+            )
+            self.connection.execute("COMMIT")
+        except BaseException:
+            self.connection.execute("ROLLBACK")
+            raise
+        return [dict(row) for row in rows]
+
+    @synchronized
+    def listing_version(self, user_oid: str) -> int:
+        """Returns a number that changes whenever the files uploaded by a user change"""
+        row = self.connection.execute("SELECT version FROM listing_versions WHERE user_oid = ?", (user_oid,)).fetchone()
+        return row["version"] if row is not None else 0
+
+    @synchronized
+    def change_listing_version(self, user_oid: str):
+        self.connection.execute(
+            "INSERT INTO listing_versions (user_oid, version) VALUES (?, 1) "
+            "ON CONFLICT (user_oid) DO UPDATE SET version = version + 1",
+            (user_oid,),
+        )
+
+    @synchronized
+    def lock_file(self, user_oid: str, filename: str, owner: str) -> bool:
+        """Locks a file for an owner, unless another owner holds an unexpired lease on it, and returns whether it did"""
+        now = time.time()
+        cursor = self.connection.execute(
+            "INSERT INTO file_locks (user_oid, filename, owner, lease_until) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (user_oid, filename) DO UPDATE SET owner = excluded.owner, lease_until = excluded.lease_until "
+            "WHERE lease_until < ?",
+            (user_oid, filename, owner, now + JOB_LEASE_SECONDS, now),
+        )
+        return cursor.rowcount == 1
+
+    @synchronized
+    def renew_file_lock(self, user_oid: str, filename: str, owner: str):
+        self.connection.execute(
+            "UPDATE file_locks SET lease_until = ? WHERE user_oid = ? AND filename = ? AND owner = ?",
+            (time.time() + JOB_LEASE_SECONDS, user_oid, filename, owner),
+        )
+
+    @synchronized
+    def unlock_file(self, user_oid: str, filename: str, owner: str):
+        self.connection.execute(
+            "DELETE FROM file_locks WHERE user_oid = ? AND filename = ? AND owner = ?", (user_oid, filename, owner)
+        )
+
+    @synchronized
+    def stored_bytes(self, user_oid: str) -> int:
+        """Returns the total size of the files uploaded by a user through the app"""
+        row = self.connection.execute("SELECT SUM(size) FROM user_files WHERE user_oid = ?", (user_oid,)).fetchone()
+        return row[0] or 0
+
+    @synchronized
+    def set_file_size(self, user_oid: str, filename: str, size: int):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO user_files (user_oid, filename, size) VALUES (?, ?, ?)", (user_oid, filename, size)
+        )
+
+    @synchronized
+    def remove_file_size(self, user_oid: str, filename: str):
+        self.connection.execute("DELETE FROM user_files WHERE user_oid = ? AND filename = ?", (user_oid, filename))
+
+    @synchronized
+    def purge(self, max_age: float = FINISHED_JOB_RETENTION_SECONDS):
+        self.connection.execute(
+            "DELETE FROM jobs WHERE status IN (?, ?) AND updated < ?",
+            (JOB_SUCCEEDED, JOB_FAILED, time.time() - max_age),
+        )
+
+    @synchronized
+    def close(self):
+        self.connection.close()
+
+    async def run(self, method: Callable[..., T], *args: Any) -> T:
+        """Runs a method of the store in a thread, so that waiting for the database doesn't block the event loop"""
+        return await asyncio.get_running_loop().run_in_executor(None, method, *args)
+
+
+class IndexedFileHashes(MutableMapping[Tuple[str, str], str]):
+    """
+    Durable mapping of (user oid, filename) to the SHA-256 of the content indexed for that file,
+    stored with the jobs of an UploadJobStore, so that every process of the app skips re-uploads of the same content.
+    Like the methods of the store, its methods block while SQLite waits for other processes.
+    """
+
+    def __init__(self, store: UploadJobStore):
+        self.lock = store.lock
+        self.connection = store.connection
+
+    @synchronized
+    def __getitem__(self, key: Tuple[str, str]) -> str:
+        row = self.connection.execute(
+            "SELECT content_hash FROM indexed_files WHERE user_oid = ? AND filename = ?", key
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row["content_hash"]
+
+    @synchronized
+    def __setitem__(self, key: Tuple[str, str], content_hash: str):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO indexed_files (user_oid, filename, content_hash, updated) VALUES (?, ?, ?, ?)",
+            (*key, content_hash, time.time()),
+        )
+
+    @synchronized
+    def __delitem__(self, key: Tuple[str, str]):
+        if self.connection.execute("DELETE FROM indexed_files WHERE user_oid = ? AND filename = ?", key).rowcount == 0:
+            raise KeyError(key)
+
+    @synchronized
+    def __iter__(self) -> Iterator[Tuple[str, str]]:
+        rows = self.connection.execute("SELECT user_oid, filename FROM indexed_files").fetchall()
+        return iter([(row["user_oid"], row["filename"]) for row in rows])
+
+    @synchronized
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM indexed_files").fetchone()[0]
+
+
+class SharedFileLocks:
+    """
+    Locks on the files of users, held by one task of one process at a time, for the shared_lock of an
+    UploadUserFileStrategy. Locks are recorded in an UploadJobStore, so they are shared by every process of the app,
+    and are leased like jobs, so that the locks of a process that stopped expire.
+    """
+
+    def __init__(self, store: UploadJobStore, poll_interval: float = FILE_LOCK_POLL_SECONDS):
+        self.store = store
+        self.poll_interval = poll_interval
+
+    @asynccontextmanager
+    async def lock(self, user_oid: str, filename: str) -> AsyncIterator[None]:
+        # Each lock gets its own owner, so that tasks of the same process don't share locks either
+        owner = uuid.uuid4().hex
+        while not await self.store.run(self.store.lock_file, user_oid, filename, owner):
+            await asyncio.sleep(self.poll_interval)
+        renewal = asyncio.create_task(self.renew(user_oid, filename, owner))
+        try:
+            yield
+        finally:
+            renewal.cancel()
+            await asyncio.gather(renewal, return_exceptions=True)
+            await self.store.run(self.store.unlock_file, user_oid, filename, owner)
+
+    async def renew(self, user_oid: str, filename: str, owner: str):
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                await self.store.run(self.store.renew_file_lock, user_oid, filename, owner)
+            except sqlite3.Error:
+                logger.exception("Unable to renew the lock of '%s', uploaded by %s", filename, user_oid)
+
+
+class UploadQueue:
+    """
+    Ingests the files uploaded by users in the background, with up to max_concurrency files at once,
+    so that uploads return as soon as the file is stored instead of waiting for it to be parsed, embedded and indexed.
+    Jobs are recorded in an UploadJobStore, so their status can be polled, and jobs left unfinished by a process
+    that stopped are resumed by the next process, from the copy of the file in the data lake storage account.
+    Queued files are ingested from the local copy made while they were uploaded, if any, and downloaded again otherwise.
+    """
+
+    def __init__(
+        self,
+        ingester: UploadUserFileStrategy,
+        file_system_client: FileSystemClient,
+        store: UploadJobStore,
+        max_concurrency: int = 2,
+        max_jobs_per_user: int = 5,
+        max_bytes_per_user: Optional[int] = None,
+    ):
+        self.ingester = ingester
+        self.file_system_client = file_system_client
+        self.store = store
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_jobs_per_user = max_jobs_per_user
+        self.max_bytes_per_user = max_bytes_per_user
+        # Identifies this process as the owner of the jobs it leases
+        self.owner = uuid.uuid4().hex
+        self.local_paths: Dict[str, str] = {}
+        self.pending: Set[str] = set()
+        self.queue: Optional[asyncio.Queue] = None
+        self.tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        # Created here, so that the queue is bound to the event loop that runs the workers
+        self.queue = asyncio.Queue()
+        await self.recover()
+        self.tasks = [asyncio.create_task(self.work()) for _ in range(self.max_concurrency)]
+        self.tasks.append(asyncio.create_task(self.maintain()))
+
+    async def stop(self):
+        """Stops processing jobs. Unfinished jobs keep their status, and are resumed once their lease expires"""
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        # Jobs that weren't processed are downloaded again by the process that resumes them
+        for local_path in self.local_paths.values():
+            remove_local_copy(local_path)
+        self.local_paths.clear()
+        self.store.close()
+
+    async def enqueue(
+        self,
+        user_oid: str,
+        filename: str,
+        path: str,
+        url: Optional[str],
+        local_path: Optional[str],
+        content_hash: Optional[str] = None,
+        size: Optional[int] = None,
+    ) -> str:
+        """
+        Queues the ingestion of a file uploaded to path in the data lake storage account, returning the job id.
+        The queue takes ownership of the local copy of the file at local_path, if any, and removes it once processed.
+        If the same content is already queued for this user and filename, returns the id of that job instead.
+        The size of the file, if given, counts towards the max_bytes_per_user of the user until the file is removed.
+        """
+        if self.queue is None:
+            raise ValueError("The upload queue must be started before queueing files")
+        if size is not None:
+            await self.store.run(self.store.set_file_size, user_oid, filename, size)
+        if content_hash is not None and (
+            job := await self.store.run(self.store.find_unfinished, user_oid, filename, content_hash)
+        ):
+            logger.info("'%s', uploaded by %s, is already queued as job %s", filename, user_oid, job["id"])
+            if local_path is not None:
+                remove_local_copy(local_path)
+            return job["id"]
+        job_id = uuid.uuid4().hex
+        await self.store.run(self.store.add, job_id, user_oid, filename, path, url, self.owner, content_hash)
+        if local_path is not None:
+            self.local_paths[job_id] = local_path
+        self.pending.add(job_id)
+        self.queue.put_nowait(job_id)
+        return job_id
+
+    async def has_capacity(self, user_oid: str) -> bool:
+        """Returns whether a user can queue another file, according to max_jobs_per_user"""
+        return await self.store.run(self.store.count_unfinished, user_oid) < self.max_jobs_per_user
+
+    async def remaining_bytes(self, user_oid: str) -> Optional[int]:
+        """Returns how many more bytes a user can upload according to max_bytes_per_user, or None without a quota"""
+        if self.max_bytes_per_user is None:
+            return None
+        return max(0, self.max_bytes_per_user - await self.store.run(self.store.stored_bytes, user_oid))
+
+    async def remove(self, user_oid: str, filename: str):
+        """Cancels the unfinished jobs of a file, and removes its content from the index"""
+        await self.store.run(self.store.fail_unfinished, user_oid, filename, "The file was deleted")
+        await self.store.run(self.store.remove_file_size, user_oid, filename)
+        await self.ingester.remove_file(filename, user_oid)
+
+    async def status(self, job_id: str, user_oid: str) -> Optional[Dict[str, Any]]:
+        """Returns the status of a job, or None if there is no such job for this user"""
+        job = await self.store.run(self.store.get, job_id)
+        if job is None or job["user_oid"] != user_oid:
+            return None
+        return {
+            "id": job["id"],
+            "filename": job["filename"],
+            "status": job["status"],
+            "error": job["error"],
+            "created": job["created"],
+            "updated": job["updated"],
+        }
+
+    async def join(self):
+        """Waits until all the queued jobs are processed"""
+        if self.queue is not None:
+            await self.queue.join()
+
+    async def recover(self):
+        if self.queue is None:
+            return
+        for job in await self.store.run(self.store.claim_abandoned, self.owner):
+            if job["id"] not in self.pending:
+                logger.info("Resuming the ingestion of '%s', uploaded by %s", job["filename"], job["user_oid"])
+                self.pending.add(job["id"])
+                self.queue.put_nowait(job["id"])
+
+    async def maintain(self):
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            try:
+                await self.store.run(self.store.renew, self.owner)
+                await self.recover()
+                await self.store.run(self.store.purge)
+            except sqlite3.Error:
+                logger.exception("Unable to update the upload jobs")
+
+    async def work(self):
+        assert self.queue is not None
+        while True:
+            job_id = await self.queue.get()
+            try:
+                await self.process(job_id)
+            except Exception:
+                logger.exception("Unable to process upload job %s", job_id)
+            finally:
+                self.pending.discard(job_id)
+                self.queue.task_done()
+
+    async def process(self, job_id: str):
+        job = await self.store.run(self.store.get, job_id)
+        local_path = self.local_paths.pop(job_id, None)
+        try:
+            if job is None or job["status"] not in (JOB_QUEUED, JOB_PROCESSING) or job["owner"] != self.owner:
+                return
+            await self.ingest(job_id, job, local_path)
+        finally:
+            if local_path is not None:
+                remove_local_copy(local_path)
+
+    async def ingest(self, job_id: str, job: Dict[str, Any], local_path: Optional[str]):
+        await self.store.run(self.store.set_status, job_id, JOB_PROCESSING)
+        file: Optional[File] = None
+        try:
+            stream: BinaryIO
+            if local_path is not None and os.path.basename(local_path) == job["filename"]:
+                stream = MappedFile(local_path)
+            else:
+                stream = io.BytesIO(await self.download(job["path"]))
+                stream.name = job["filename"]
+            file = File(content=stream, acls={"oids": [job["user_oid"]]}, url=job["url"])
+            await self.ingester.add_file(file)
+        except Exception as error:
+            logger.exception("Unable to ingest '%s', uploaded by %s", job["filename"], job["user_oid"])
+            await self.store.run(self.store.set_status, job_id, JOB_FAILED, str(error))
+        else:
+            # The job was cancelled while it ran if the file was deleted meanwhile
+            current = await self.store.run(self.store.get, job_id)
+            if current is not None and current["status"] == JOB_PROCESSING:
+                await self.store.run(self.store.set_status, job_id, JOB_SUCCEEDED)
+        finally:
+            if file:
+                file.close()
+
+    async def download(self, path: str) -> bytes:
+        async with self.file_system_client.get_file_client(path) as file_client:
+            downloader = await file_client.download_file()
+            return await downloader.readall()
+
+
+def remove_local_copy(local_path: str):
+    """Removes the local copy of an uploaded file, with the temporary directory it was written to"""
+    try:
+        os.remove(local_path)
+    except OSError:
+        logger.warning("Unable to remove the local copy %s", local_path)
+        return
+    try:
+        os.rmdir(os.path.dirname(local_path))
+    except OSError:
+        # The directory isn't empty, so it isn't only used for this file
+        pass
@@ -1,6 +1,16 @@
 const BACKEND_URI = "";
 
-import { ChatAppResponse, ChatAppResponseOrError, ChatAppRequest, Config, SimpleAPIResponse, HistoryListApiResponse, HistoryApiResponse } from "./models";
+import {
+    ChatAppResponse,
+    ChatAppResponseOrError,
+    ChatAppRequest,
+    Config,
+    SimpleAPIResponse,
+    HistoryListApiResponse,
+    HistoryApiResponse,
+    UploadFileResponse,
+    UploadStatusResponse
+} from "./models";
 import { useLogin, getToken, isUsingAppServicesLogin } from "../authConfig";
 
 export async function getHeaders(idToken: string | undefined): Promise<Record<string, string>> {
@@ -82,7 +92,7 @@ export function getCitationFilePath(citation: string): string {
     return `${BACKEND_URI}/content/${citation}`;
 }
 
-export async function uploadFileApi(request: FormData, idToken: string): Promise<SimpleAPIResponse> {
+export async function uploadFileApi(request: FormData, idToken: string): Promise<UploadFileResponse> {
     const response = await fetch("/upload", {
         method: "POST",
         headers: await getHeaders(idToken),
@@ -93,10 +103,44 @@ export async function uploadFileApi(request: FormData, idToken: string): Promise
         throw new Error(`Uploading files failed: ${response.statusText}`);
     }
 
-    const dataResponse: SimpleAPIResponse = await response.json();
+    const dataResponse: UploadFileResponse = await response.json();
     return dataResponse;
 }
 
+export async function getUploadStatusApi(jobId: string, idToken: string): Promise<UploadStatusResponse> {
+    const response = await fetch(`/upload/status/${encodeURIComponent(jobId)}`, {
+        method: "GET",
+        headers: await getHeaders(idToken)
+    });
+
+    if (!response.ok) {
+        throw new Error(`Getting upload status failed: ${response.statusText}`);
+    }
+
+    const dataResponse: UploadStatusResponse = await response.json();
+    return dataResponse;
+}
+
+// Uploaded files are ingested in the background, so poll their status until they are searchable or failed.
+// Polls back off up to maxIntervalMs, and after maxWaitMs the last status is returned even if the file is still queued or processing
+export async function waitForUploadApi(
+    jobId: string,
+    idToken: string,
+    intervalMs: number = 2000,
+    maxIntervalMs: number = 30000,
+    maxWaitMs: number = 5 * 60 * 1000
+): Promise<UploadStatusResponse> {
+    const deadline = Date.now() + maxWaitMs;
+    while (true) {
+        const status = await getUploadStatusApi(jobId, idToken);
+        if (status.status === "succeeded" || status.status === "failed" || Date.now() + intervalMs > deadline) {
+            return status;
+        }
+        await new Promise(resolve => setTimeout(resolve, intervalMs));
+        intervalMs = Math.min(intervalMs * 2, maxIntervalMs);
+    }
+}
+
 export async function deleteUploadedFileApi(filename: string, idToken: string): Promise<SimpleAPIResponse> {
     const headers = await getHeaders(idToken);
     const response = await fetch("/delete_uploaded", {
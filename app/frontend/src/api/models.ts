@@ -98,6 +98,22 @@ export type SimpleAPIResponse = {
     message?: string;
 };
 
+export type UploadFileResponse = SimpleAPIResponse & {
+    job_id?: string;
+    status?: UploadStatus;
+};
+
+export type UploadStatus = "queued" | "processing" | "succeeded" | "failed";
+
+export type UploadStatusResponse = {
+    id: string;
+    filename: string;
+    status: UploadStatus;
+    error: string | null;
+    created: number;
+    updated: number;
+};
+
 export interface SpeechConfig {
     speechUrls: (string | null)[];
     setSpeechUrls: (urls: (string | null)[]) => void;
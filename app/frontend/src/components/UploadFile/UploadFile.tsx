@@ -5,7 +5,7 @@ import { Add24Regular, Delete24Regular } from "@fluentui/react-icons";
 import { useMsal } from "@azure/msal-react";
 import { useTranslation } from "react-i18next";
 
-import { SimpleAPIResponse, uploadFileApi, deleteUploadedFileApi, listUploadedFilesApi } from "../../api";
+import { SimpleAPIResponse, UploadFileResponse, uploadFileApi, deleteUploadedFileApi, listUploadedFilesApi, waitForUploadApi } from "../../api";
 import { useLogin, getToken } from "../../authConfig";
 import styles from "./UploadFile.module.css";
 
@@ -22,6 +22,7 @@ export const UploadFile: React.FC<Props> = ({ className, disabled }: Props) => {
     const [deletionStatus, setDeletionStatus] = useState<{ [filename: string]: "pending" | "error" | "success" }>({});
     const [uploadedFile, setUploadedFile] = useState<SimpleAPIResponse>();
     const [uploadedFileError, setUploadedFileError] = useState<string>();
+    const [uploadedFileProcessing, setUploadedFileProcessing] = useState<boolean>(false);
     const [uploadedFiles, setUploadedFiles] = useState<string[]>([]);
     const { t } = useTranslation();
 
@@ -90,14 +91,25 @@ export const UploadFile: React.FC<Props> = ({ className, disabled }: Props) => {
             if (!idToken) {
                 throw new Error("No authentication token available");
             }
-            const response: SimpleAPIResponse = await uploadFileApi(formData, idToken);
+            const response: UploadFileResponse = await uploadFileApi(formData, idToken);
+            // The file is ingested in the background, so wait until it is searchable, or stop waiting if it takes too long
+            let processing = false;
+            if (response.job_id) {
+                const status = await waitForUploadApi(response.job_id, idToken);
+                if (status.status === "failed") {
+                    throw new Error(`Ingesting ${status.filename} failed: ${status.error}`);
+                }
+                processing = status.status !== "succeeded";
+            }
             setUploadedFile(response);
+            setUploadedFileProcessing(processing);
             setIsUploading(false);
             setUploadedFileError(undefined);
             listUploadedFiles(idToken);
         } catch (error) {
             console.error(error);
             setIsUploading(false);
+            setUploadedFileProcessing(false);
             setUploadedFileError(t("upload.uploadedFileError"));
         }
     };
@@ -133,7 +145,8 @@ export const UploadFile: React.FC<Props> = ({ className, disabled }: Props) => {
                         {/* Show a loading message while files are being uploaded */}
                         {isUploading && <Text>{t("upload.uploadingFiles")}</Text>}
                         {!isUploading && uploadedFileError && <Text>{uploadedFileError}</Text>}
-                        {!isUploading && uploadedFile && <Text>{uploadedFile.message}</Text>}
+                        {!isUploading && uploadedFile && !uploadedFileProcessing && <Text>{uploadedFile.message}</Text>}
+                        {!isUploading && uploadedFile && uploadedFileProcessing && <Text>{t("upload.uploadedFileProcessing")}</Text>}
 
                         {/* Display the list of already uploaded */}
                         <h3>{t("upload.uploadedFilesLabel")}</h3>
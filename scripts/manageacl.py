@@ -1,13 +1,17 @@
 import argparse
 import asyncio
+import csv
 import json
 import logging
 import os
-from typing import Any, Union
+import sys
+import time
+from typing import Any, AsyncGenerator, Dict, List, Optional, Union
 from urllib.parse import urljoin
 
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
+from azure.core.exceptions import HttpResponseError
 from azure.identity.aio import AzureDeveloperCliCredential
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.aio import SearchIndexClient
@@ -18,8 +22,20 @@ from azure.search.documents.indexes.models import (
 
 from load_azd_env import load_azd_env
 
+# The indexing writer is shared with the ingestion code in the backend
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app", "backend"))
+from prepdocslib.indexingwriter import IndexingWriter  # noqa: E402
+
 logger = logging.getLogger("scripts")
 
+# Documents are retrieved in pages of this size, in id order, so that any number of them can be processed
+SEARCH_PAGE_SIZE = 1000
+# Azure AI Search doesn't skip more than this many results, which limits paging without a sortable id
+MAX_SEARCH_SKIP = 100000
+# Bulk updates log their progress every time this many documents are retrieved
+PROGRESS_INTERVAL = 10000
+BULK_ACL_ACTIONS = ("add", "remove", "remove_all")
+
 
 class ManageAcl:
     """
@@ -35,6 +51,8 @@ class ManageAcl:
         acl_type: str,
         acl: str,
         credentials: Union[AsyncTokenCredential, AzureKeyCredential],
+        acl_file: Optional[str] = None,
+        max_concurrency: int = 4,
     ):
         """
         Initializes the command
@@ -55,6 +73,11 @@ class ManageAcl:
             The actual value of the acl, if the acl action is add or remove
         credentials
             Credentials for the azure search service
+        acl_file
+            Path of a CSV file of (url, acl) rows, to add or remove acls for many documents at once.
+            Rows without an acl use the acl parameter. With remove_all, only the url is used.
+        max_concurrency
+            Number of storage URLs retrieved, and of update requests sent, at the same time in bulk mode
         """
         self.service_name = service_name
         self.index_name = index_name
@@ -63,6 +86,8 @@ class ManageAcl:
         self.acl_action = acl_action
         self.acl_type = acl_type
         self.acl = acl
+        self.acl_file = acl_file
+        self.max_concurrency = max_concurrency
 
     async def run(self):
         endpoint = f"https://{self.service_name}.search.windows.net"
@@ -73,7 +98,9 @@ class ManageAcl:
         async with SearchClient(
             endpoint=endpoint, index_name=self.index_name, credential=self.credentials
         ) as search_client:
-            if self.acl_action == "view":
+            if self.acl_file is not None:
+                await self.update_acls_in_bulk(search_client)
+            elif self.acl_action == "view":
                 await self.view_acl(search_client)
             elif self.acl_action == "remove":
                 await self.remove_acl(search_client)
@@ -87,65 +114,203 @@ class ManageAcl:
                 raise Exception(f"Unknown action {self.acl_action}")
 
     async def view_acl(self, search_client: SearchClient):
-        for document in await self.get_documents(search_client):
+        async for document in self.get_documents(search_client, self.url):
             # Assumes the acls are consistent across all sections of the document
             print(json.dumps(document[self.acl_type]))
             return
 
     async def remove_acl(self, search_client: SearchClient):
-        documents_to_merge = []
-        for document in await self.get_documents(search_client):
-            new_acls = document[self.acl_type]
-            if any(acl_value == self.acl for acl_value in new_acls):
-                new_acls = [acl_value for acl_value in document[self.acl_type] if acl_value != self.acl]
-                documents_to_merge.append({"id": document["id"], self.acl_type: new_acls})
-            else:
-                logger.info("Search document %s does not have %s acl %s", document["id"], self.acl_type, self.acl)
+        merged = 0
+        async with self.create_writer(search_client) as writer:
+            async for document in self.get_documents(search_client, self.url):
+                new_acls = document[self.acl_type]
+                if any(acl_value == self.acl for acl_value in new_acls):
+                    new_acls = [acl_value for acl_value in document[self.acl_type] if acl_value != self.acl]
+                    await writer.merge_documents([{"id": document["id"], self.acl_type: new_acls}])
+                    merged += 1
+                else:
+                    logger.info("Search document %s does not have %s acl %s", document["id"], self.acl_type, self.acl)
 
-        if len(documents_to_merge) > 0:
-            logger.info("Removing acl %s from %d search documents", self.acl, len(documents_to_merge))
-            await search_client.merge_documents(documents=documents_to_merge)
-        else:
-            logger.info("Not updating any search documents")
+            if merged > 0:
+                logger.info("Removing acl %s from %d search documents", self.acl, merged)
+            else:
+                logger.info("Not updating any search documents")
+        self.log_updated(writer, merged)
 
     async def remove_all_acls(self, search_client: SearchClient):
-        documents_to_merge = []
-        for document in await self.get_documents(search_client):
-            if len(document[self.acl_type]) > 0:
-                documents_to_merge.append({"id": document["id"], self.acl_type: []})
-            else:
-                logger.info("Search document %s already has no %s acls", document["id"], self.acl_type)
+        merged = 0
+        async with self.create_writer(search_client) as writer:
+            async for document in self.get_documents(search_client, self.url):
+                if len(document[self.acl_type]) > 0:
+                    await writer.merge_documents([{"id": document["id"], self.acl_type: []}])
+                    merged += 1
+                else:
+                    logger.info("Search document %s already has no %s acls", document["id"], self.acl_type)
 
-        if len(documents_to_merge) > 0:
-            logger.info("Removing all %s acls from %d search documents", self.acl_type, len(documents_to_merge))
-            await search_client.merge_documents(documents=documents_to_merge)
-        else:
-            logger.info("Not updating any search documents")
+            if merged > 0:
+                logger.info("Removing all %s acls from %d search documents", self.acl_type, merged)
+            else:
+                logger.info("Not updating any search documents")
+        self.log_updated(writer, merged)
 
     async def add_acl(self, search_client: SearchClient):
-        documents_to_merge = []
-        for document in await self.get_documents(search_client):
-            new_acls = document[self.acl_type]
-            if not any(acl_value == self.acl for acl_value in new_acls):
-                new_acls.append(self.acl)
-                documents_to_merge.append({"id": document["id"], self.acl_type: new_acls})
+        merged = 0
+        async with self.create_writer(search_client) as writer:
+            async for document in self.get_documents(search_client, self.url):
+                new_acls = document[self.acl_type]
+                if not any(acl_value == self.acl for acl_value in new_acls):
+                    new_acls.append(self.acl)
+                    await writer.merge_documents([{"id": document["id"], self.acl_type: new_acls}])
+                    merged += 1
+                else:
+                    logger.info("Search document %s already has %s acl %s", document["id"], self.acl_type, self.acl)
+
+            if merged > 0:
+                logger.info("Adding acl %s to %d search documents", self.acl, merged)
             else:
-                logger.info("Search document %s already has %s acl %s", document["id"], self.acl_type, self.acl)
+                logger.info("Not updating any search documents")
+        self.log_updated(writer, merged)
 
-        if len(documents_to_merge) > 0:
-            logger.info("Adding acl %s to %d search documents", self.acl, len(documents_to_merge))
-            await search_client.merge_documents(documents=documents_to_merge)
+    def read_acl_file(self) -> Dict[str, List[str]]:
+        """Reads the (url, acl) rows of the acl file, grouping the acls of each url in the order of the file"""
+        acls_by_url: Dict[str, List[str]] = {}
+        assert self.acl_file is not None
+        with open(self.acl_file, newline="", encoding="utf-8") as file:
+            for row in csv.reader(file):
+                if not row or not row[0].strip() or row[0].startswith("#"):
+                    continue
+                url = row[0].strip()
+                acl = row[1].strip() if len(row) > 1 and row[1].strip() else self.acl
+                acls = acls_by_url.setdefault(url, [])
+                if acl and acl not in acls:
+                    acls.append(acl)
+                elif not acl and self.acl_action != "remove_all":
+                    raise ValueError(f"No {self.acl_type} acl to {self.acl_action} for {url}")
+        return acls_by_url
+
+    def updated_acls(self, current_acls: List[str], acls: List[str]) -> Optional[List[str]]:
+        """Returns the acls of a document after the bulk action, or None if they don't change"""
+        if self.acl_action == "add":
+            new_acls = current_acls + [acl for acl in acls if acl not in current_acls]
+        elif self.acl_action == "remove":
+            new_acls = [acl for acl in current_acls if acl not in acls]
+        elif self.acl_action == "remove_all":
+            new_acls = []
         else:
-            logger.info("Not updating any search documents")
+            raise Exception(f"Action {self.acl_action} can't be used with an acl file")
+        return new_acls if new_acls != current_acls else None
 
-    async def get_documents(self, search_client: SearchClient):
-        filter = f"storageUrl eq '{self.url}'"
-        documents = await search_client.search("", filter=filter, select=["id", self.acl_type])
-        found_documents = []
-        async for document in documents:
-            found_documents.append(document)
-        logger.info("Found %d search documents with storageUrl %s", len(found_documents), self.url)
-        return found_documents
+    async def update_acls_in_bulk(self, search_client: SearchClient):
+        """
+        Applies the acl action to the documents of every url of the acl file. Documents are streamed a page at a time,
+        with max_concurrency urls retrieved at once, and the changes are merged in batches by an IndexingWriter
+        """
+        acls_by_url = self.read_acl_file()
+        logger.info("Updating %s acls of the documents of %d storage URLs", self.acl_type, len(acls_by_url))
+        start = time.monotonic()
+        retrieved = 0
+        merged = 0
+        urls = iter(acls_by_url.items())
+
+        async def update_urls(writer: IndexingWriter):
+            nonlocal retrieved, merged
+            # The workers share the iterator, so each url is only retrieved by one of them
+            for url, acls in urls:
+                async for document in self.get_documents(search_client, url):
+                    retrieved += 1
+                    if retrieved % PROGRESS_INTERVAL == 0:
+                        elapsed = time.monotonic() - start
+                        logger.info(
+                            "Retrieved %d search documents, updated %d (%.0f documents per second)",
+                            retrieved,
+                            writer.succeeded,
+                            retrieved / elapsed,
+                        )
+                    new_acls = self.updated_acls(document[self.acl_type], acls)
+                    if new_acls is not None:
+                        await writer.merge_documents([{"id": document["id"], self.acl_type: new_acls}])
+                        merged += 1
+
+        async with self.create_writer(search_client) as writer:
+            await asyncio.gather(*(update_urls(writer) for _ in range(self.max_concurrency)))
+        elapsed = time.monotonic() - start
+        print(
+            f"Retrieved {retrieved} search documents of {len(acls_by_url)} storage URLs and updated {writer.succeeded} "
+            f"of the {merged} that needed it in {elapsed:.1f} seconds "
+            f"({retrieved / elapsed if elapsed else 0:.0f} documents per second)"
+        )
+
+    def create_writer(self, search_client: SearchClient) -> IndexingWriter:
+        def on_error(document: Dict[str, Any], error_message: str):
+            logger.error("Failed to update search document %s: %s", document["id"], error_message)
+
+        return IndexingWriter(search_client, max_concurrency=self.max_concurrency, on_error=on_error)
+
+    def log_updated(self, writer: IndexingWriter, merged: int):
+        if merged > 0:
+            logger.info("Updated %d search documents", writer.succeeded)
+
+    async def merge_documents(self, search_client: SearchClient, documents: List[Dict[str, Any]]):
+        async with self.create_writer(search_client) as writer:
+            await writer.merge_documents(documents)
+        logger.info("Updated %d search documents", writer.succeeded)
+
+    async def get_documents(self, search_client: SearchClient, url: str) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        Streams the ids and acls of the documents with a storage URL, retrieving them a page at a time in id order
+        """
+        # Replace ' with '' to escape the single quote for the filter
+        filter = "storageUrl eq '{}'".format(url.replace("'", "''"))
+        select = ["id", self.acl_type]
+        found = 0
+        last_id: Optional[str] = None
+        while True:
+            page_filter = filter
+            if last_id is not None:
+                page_filter = "({}) and id gt '{}'".format(filter, str(last_id).replace("'", "''"))
+            try:
+                results = await search_client.search(
+                    "", filter=page_filter, select=select, order_by=["id asc"], top=SEARCH_PAGE_SIZE
+                )
+                page = [document async for document in results]
+            except HttpResponseError as error:
+                if last_id is not None:
+                    raise
+                # Indexes created by older versions don't have a sortable and filterable id field
+                logger.info("Can't page through search index by id (%s), paging by position instead", error.message)
+                async for document in self.get_documents_by_position(search_client, url, filter, select):
+                    found += 1
+                    yield document
+                break
+            for document in page:
+                found += 1
+                yield document
+            if len(page) < SEARCH_PAGE_SIZE:
+                break
+            last_id = page[-1]["id"]
+        logger.info("Found %d search documents with storageUrl %s", found, url)
+
+    async def get_documents_by_position(
+        self, search_client: SearchClient, url: str, filter: str, select: List[str]
+    ) -> AsyncGenerator[Dict[str, Any], None]:
+        """
+        Streams the documents with a storage URL a page at a time with skip, for indexes whose ids can't be sorted.
+        Fails before skipping more results than the service allows, instead of missing documents.
+        """
+        skip = 0
+        while True:
+            if skip >= MAX_SEARCH_SKIP:
+                raise Exception(
+                    f"More than {MAX_SEARCH_SKIP} search documents have storageUrl {url}, which can only be retrieved "
+                    "from an index with a sortable and filterable id field"
+                )
+            results = await search_client.search("", filter=filter, select=select, skip=skip, top=SEARCH_PAGE_SIZE)
+            page = [document async for document in results]
+            for document in page:
+                yield document
+            if len(page) < SEARCH_PAGE_SIZE:
+                break
+            skip += len(page)
 
     async def enable_acls(self, endpoint: str):
         async with SearchIndexClient(endpoint=endpoint, credential=self.credentials) as search_index_client:
@@ -197,7 +362,7 @@ class ManageAcl:
 
         if len(documents_to_merge) > 0:
             logger.info("Updating storage URL for %d search documents", len(documents_to_merge))
-            await search_client.merge_documents(documents=documents_to_merge)
+            await self.merge_documents(search_client, documents_to_merge)
         elif len(found_documents) == 0:
             logger.info("No documents found with empty storageUrl value")
         else:
@@ -225,6 +390,8 @@ async def main(args: Any):
         acl_type=args.acl_type,
         acl=args.acl,
         credentials=search_credential,
+        acl_file=args.acl_file,
+        max_concurrency=args.concurrency,
     )
     await command.run()
 
@@ -248,6 +415,18 @@ if __name__ == "__main__":
     )
     parser.add_argument("--acl", required=False, default=None, help="Optional. Value of ACL to add or remove.")
     parser.add_argument("--url", required=False, help="Optional. Storage URL of document to update ACLs for")
+    parser.add_argument(
+        "--acl-file",
+        required=False,
+        help="Optional. CSV file of storage URL and ACL rows, to add or remove ACLs for many documents at once",
+    )
+    parser.add_argument(
+        "--concurrency",
+        required=False,
+        type=int,
+        default=4,
+        help="Optional. Number of storage URLs retrieved, and of update requests sent, at the same time with --acl-file",
+    )
     parser.add_argument(
         "--tenant-id", required=False, help="Optional. Use this to define the Azure directory where to authenticate)"
     )
@@ -263,4 +442,8 @@ if __name__ == "__main__":
         print("Must specify either --acl-type or --acl-action enable_acls or --acl-action update_storage_urls")
         exit(1)
 
+    if args.acl_file and args.acl_action not in BULK_ACL_ACTIONS:
+        print(f"--acl-file can only be used with --acl-action {', '.join(BULK_ACL_ACTIONS)}")
+        exit(1)
+
     asyncio.run(main(args))
@@ -294,9 +294,10 @@ auth_public_envs = [
 
 
 @pytest.fixture(params=envs, ids=["client0", "client1"])
-def mock_env(monkeypatch, request):
+def mock_env(monkeypatch, request, tmp_path):
     with mock.patch.dict(os.environ, clear=True):
         monkeypatch.setenv("AZURE_STORAGE_ACCOUNT", "test-storage-account")
+        monkeypatch.setenv("USER_UPLOAD_QUEUE_PATH", str(tmp_path / "user_upload_jobs.sqlite"))
         monkeypatch.setenv("AZURE_STORAGE_CONTAINER", "test-storage-container")
         monkeypatch.setenv("AZURE_STORAGE_RESOURCE_GROUP", "test-storage-rg")
         monkeypatch.setenv("AZURE_SUBSCRIPTION_ID", "test-storage-subid")
@@ -368,6 +369,7 @@ async def auth_client(
     mock_list_groups_success,
     mock_acs_search_filter,
     request,
+    tmp_path,
 ):
     monkeypatch.setenv("AZURE_STORAGE_ACCOUNT", "test-storage-account")
     monkeypatch.setenv("AZURE_STORAGE_CONTAINER", "test-storage-container")
@@ -375,6 +377,7 @@ async def auth_client(
     monkeypatch.setenv("AZURE_SEARCH_SERVICE", "test-search-service")
     monkeypatch.setenv("AZURE_OPENAI_CHATGPT_MODEL", "gpt-35-turbo")
     monkeypatch.setenv("USE_USER_UPLOAD", "true")
+    monkeypatch.setenv("USER_UPLOAD_QUEUE_PATH", str(tmp_path / "user_upload_jobs.sqlite"))
     monkeypatch.setenv("AZURE_USERSTORAGE_ACCOUNT", "test-userstorage-account")
     monkeypatch.setenv("AZURE_USERSTORAGE_CONTAINER", "test-userstorage-container")
     monkeypatch.setenv("USE_LOCAL_PDF_PARSER", "true")
@@ -407,6 +410,7 @@ async def auth_public_documents_client(
     mock_list_groups_success,
     mock_acs_search_filter,
     request,
+    tmp_path,
 ):
     monkeypatch.setenv("AZURE_STORAGE_ACCOUNT", "test-storage-account")
     monkeypatch.setenv("AZURE_STORAGE_CONTAINER", "test-storage-container")
@@ -414,6 +418,7 @@ async def auth_public_documents_client(
     monkeypatch.setenv("AZURE_SEARCH_SERVICE", "test-search-service")
     monkeypatch.setenv("AZURE_OPENAI_CHATGPT_MODEL", "gpt-35-turbo")
     monkeypatch.setenv("USE_USER_UPLOAD", "true")
+    monkeypatch.setenv("USER_UPLOAD_QUEUE_PATH", str(tmp_path / "user_upload_jobs.sqlite"))
     monkeypatch.setenv("AZURE_USERSTORAGE_ACCOUNT", "test-userstorage-account")
     monkeypatch.setenv("AZURE_USERSTORAGE_CONTAINER", "test-userstorage-container")
     monkeypatch.setenv("USE_LOCAL_PDF_PARSER", "true")
@@ -738,5 +743,8 @@ def mock_data_lake_service_client(monkeypatch):
     monkeypatch.setattr(azure.storage.filedatalake.StorageStreamDownloader, "__init__", mock_init)
     monkeypatch.setattr(azure.storage.filedatalake.StorageStreamDownloader, "readinto", mock_readinto)
 
+    async def mock_readinto_aio(self, stream: IO[bytes]):
+        return mock_readinto(self, stream)
+
     monkeypatch.setattr(azure.storage.filedatalake.aio.StorageStreamDownloader, "__init__", mock_init)
-    monkeypatch.setattr(azure.storage.filedatalake.aio.StorageStreamDownloader, "readinto", mock_readinto)
+    monkeypatch.setattr(azure.storage.filedatalake.aio.StorageStreamDownloader, "readinto", mock_readinto_aio)
@@ -173,6 +173,18 @@ class MockResponse:
             raise Exception(f"HTTP status {self.status}")
 
 
+class MockIndexingResult:
+    def __init__(self, key: str, succeeded: bool = True, status_code: int = 201, error_message: Optional[str] = None):
+        self.key = key
+        self.succeeded = succeeded
+        self.status_code = status_code
+        self.error_message = error_message
+
+
+def mock_indexing_results(documents):
+    return [MockIndexingResult(document["id"]) for document in documents]
+
+
 class MockEmbeddingsClient:
     def __init__(self, create_embedding_response: openai.types.CreateEmbeddingResponse):
         self.create_embedding_response = create_embedding_response
@@ -181,9 +193,36 @@ class MockEmbeddingsClient:
         return self.create_embedding_response
 
 
+class MockRawResponse:
+    def __init__(self, parsed, headers=None):
+        self.parsed = parsed
+        self.headers = headers or {}
+
+    def parse(self):
+        return self.parsed
+
+
+class MockEmbeddingsWithRawResponse:
+    def __init__(self, embeddings_client):
+        self.embeddings_client = embeddings_client
+
+    async def create(self, *args, **kwargs) -> MockRawResponse:
+        return MockRawResponse(
+            await self.embeddings_client.create(*args, **kwargs), getattr(self.embeddings_client, "headers", None)
+        )
+
+
+class MockEmbeddings:
+    """Exposes a test double of the embeddings API like the OpenAI client does, with and without the raw response"""
+
+    def __init__(self, embeddings_client):
+        self.create = embeddings_client.create
+        self.with_raw_response = MockEmbeddingsWithRawResponse(embeddings_client)
+
+
 class MockClient:
     def __init__(self, embeddings_client):
-        self.embeddings = embeddings_client
+        self.embeddings = MockEmbeddings(embeddings_client)
 
 
 def mock_computervision_response():
@@ -8,9 +8,10 @@ import app
 
 
 @pytest.fixture
-def minimal_env(monkeypatch):
+def minimal_env(monkeypatch, tmp_path):
     with mock.patch.dict(os.environ, clear=True):
         monkeypatch.setenv("AZURE_STORAGE_ACCOUNT", "test-storage-account")
+        monkeypatch.setenv("USER_UPLOAD_QUEUE_PATH", str(tmp_path / "user_upload_jobs.sqlite"))
         monkeypatch.setenv("AZURE_STORAGE_CONTAINER", "test-storage-container")
         monkeypatch.setenv("AZURE_SEARCH_INDEX", "test-search-index")
         monkeypatch.setenv("AZURE_SEARCH_SERVICE", "test-search-service")
@@ -63,7 +64,7 @@ async def test_app_user_upload_processors(monkeypatch, minimal_env):
     async with quart_app.test_app():
         ingester = quart_app.config[app.CONFIG_INGESTER]
         assert ingester is not None
-        assert len(ingester.file_processors.keys()) == 6
+        assert len(ingester.file_processors.keys()) == 7
 
 
 @pytest.mark.asyncio
@@ -77,7 +78,7 @@ async def test_app_user_upload_processors_docint(monkeypatch, minimal_env):
     async with quart_app.test_app():
         ingester = quart_app.config[app.CONFIG_INGESTER]
         assert ingester is not None
-        assert len(ingester.file_processors.keys()) == 15
+        assert len(ingester.file_processors.keys()) == 16
 
 
 @pytest.mark.asyncio
@@ -87,13 +88,15 @@ async def test_app_user_upload_processors_docint_localpdf(monkeypatch, minimal_e
     monkeypatch.setenv("USE_USER_UPLOAD", "true")
     monkeypatch.setenv("AZURE_DOCUMENTINTELLIGENCE_SERVICE", "test-docint-service")
     monkeypatch.setenv("USE_LOCAL_PDF_PARSER", "true")
+    monkeypatch.setenv("LOCAL_PDF_PARSER_BACKEND", "pymupdf")
 
     quart_app = app.create_app()
     async with quart_app.test_app():
         ingester = quart_app.config[app.CONFIG_INGESTER]
         assert ingester is not None
-        assert len(ingester.file_processors.keys()) == 15
+        assert len(ingester.file_processors.keys()) == 16
         assert ingester.file_processors[".pdf"] is not ingester.file_processors[".pptx"]
+        assert ingester.file_processors[".pdf"].parser.backend == "pymupdf"
 
 
 @pytest.mark.asyncio
@@ -103,13 +106,17 @@ async def test_app_user_upload_processors_docint_localhtml(monkeypatch, minimal_
     monkeypatch.setenv("USE_USER_UPLOAD", "true")
     monkeypatch.setenv("AZURE_DOCUMENTINTELLIGENCE_SERVICE", "test-docint-service")
     monkeypatch.setenv("USE_LOCAL_HTML_PARSER", "true")
+    monkeypatch.setenv("LOCAL_HTML_PARSER_ENGINE", "fast")
+    monkeypatch.setenv("LOCAL_HTML_PARSER_SPLIT_ON_HEADINGS", "true")
 
     quart_app = app.create_app()
     async with quart_app.test_app():
         ingester = quart_app.config[app.CONFIG_INGESTER]
         assert ingester is not None
-        assert len(ingester.file_processors.keys()) == 15
+        assert len(ingester.file_processors.keys()) == 16
         assert ingester.file_processors[".html"] is not ingester.file_processors[".pptx"]
+        assert ingester.file_processors[".html"].parser.engine == "fast"
+        assert ingester.file_processors[".html"].parser.split_on_headings
 
 
 @pytest.mark.asyncio
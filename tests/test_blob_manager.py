@@ -1,9 +1,12 @@
+import hashlib
 import os
 import sys
 from tempfile import NamedTemporaryFile
 
 import azure.storage.blob.aio
+import pymupdf
 import pytest
+from azure.storage.blob import UserDelegationKey
 
 from prepdocslib.blobmanager import BlobManager
 from prepdocslib.listfilestrategy import File
@@ -196,6 +199,71 @@ async def test_upload_blob_no_image(monkeypatch, mock_env, caplog):
             assert "skipping image upload" in caplog.text
 
 
+@pytest.mark.asyncio
+@pytest.mark.skipif(sys.version_info.minor < 10, reason="requires Python 3.10 or higher")
+async def test_upload_pdf_blob_images(monkeypatch, mock_env, tmp_path):
+    monkeypatch.setattr("prepdocslib.blobmanager.PAGES_PER_RENDER_BATCH", 2)
+    blob_manager = BlobManager(
+        endpoint=f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+        credential=MockAzureCredential(),
+        container=os.environ["AZURE_STORAGE_CONTAINER"],
+        account=os.environ["AZURE_STORAGE_ACCOUNT"],
+        resourceGroup=os.environ["AZURE_STORAGE_RESOURCE_GROUP"],
+        subscriptionId=os.environ["AZURE_SUBSCRIPTION_ID"],
+        store_page_images=True,
+        max_render_workers=2,
+    )
+
+    pdf_path = tmp_path / "manual.pdf"
+    with pymupdf.open() as doc:
+        for i in range(5):
+            doc.new_page().insert_text((72, 72), f"Page {i + 1}")
+        doc.save(pdf_path)
+
+    async def mock_exists(*args, **kwargs):
+        return True
+
+    uploaded = {}
+
+    async def mock_upload_blob(self, name, data, *args, **kwargs):
+        uploaded[name] = data if isinstance(data, bytes) else None
+        return azure.storage.blob.aio.BlobClient.from_blob_url(
+            f"https://test.blob.core.windows.net/test/{name}", credential=MockAzureCredential()
+        )
+
+    delegation_key_requests = []
+
+    async def mock_get_user_delegation_key(self, start, expiry, **kwargs):
+        delegation_key_requests.append(expiry)
+        key = UserDelegationKey()
+        key.signed_oid = key.signed_tid = key.signed_service = key.signed_version = "test"
+        key.signed_start = key.signed_expiry = "2024-01-01T00:00:00Z"
+        key.value = "dGVzdA=="
+        return key
+
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.exists", mock_exists)
+    monkeypatch.setattr("azure.storage.blob.aio.ContainerClient.upload_blob", mock_upload_blob)
+    monkeypatch.setattr(
+        "azure.storage.blob.aio.BlobServiceClient.get_user_delegation_key", mock_get_user_delegation_key
+    )
+
+    with open(pdf_path, "rb") as content:
+        file = File(content)
+        sas_uris = await blob_manager.upload_blob(file)
+    assert sas_uris is not None
+    assert [uri.split("?")[0] for uri in sas_uris] == [
+        f"https://test.blob.core.windows.net/test/manual-{i}.png" for i in range(1, 6)
+    ]
+    for i in range(1, 6):
+        assert uploaded[f"manual-{i}.png"].startswith(b"\x89PNG")
+    assert file.page_image_hashes == [hashlib.sha256(uploaded[f"manual-{i}.png"]).hexdigest() for i in range(1, 6)]
+
+    # The user delegation key is reused for the next document
+    with open(pdf_path, "rb") as content:
+        await blob_manager.upload_blob(File(content))
+    assert len(delegation_key_requests) == 1
+
+
 @pytest.mark.asyncio
 @pytest.mark.skipif(sys.version_info.minor < 10, reason="requires Python 3.10 or higher")
 async def test_dont_remove_if_no_container(monkeypatch, mock_env, blob_manager):
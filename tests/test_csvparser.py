@@ -2,7 +2,10 @@ import io
 
 import pytest
 
-from prepdocslib.csvparser import CsvParser  # Adjust import to the correct module
+from prepdocslib.csvparser import (  # Adjust import to the correct module
+    ROW_SEPARATOR,
+    CsvParser,
+)
 
 
 @pytest.mark.asyncio
@@ -39,7 +42,7 @@ async def test_csvparser_multiple_rows():
     assert pages[0].text == "value1,value2,value3"
 
     assert pages[1].page_num == 1
-    assert pages[1].offset == len(pages[0].text) + 1  # Length of the first row plus a newline
+    assert pages[1].offset == len(pages[0].text) + len(ROW_SEPARATOR)  # Length of the first row plus a separator
     assert pages[1].text == "value4,value5,value6"
 
 
@@ -55,3 +58,30 @@ async def test_csvparser_empty_file():
 
     # Assertions
     assert len(pages) == 0  # No rows should be parsed from an empty file
+
+
+@pytest.mark.asyncio
+async def test_csvparser_rows_per_page():
+    file = io.BytesIO('col1,col2\nvalue1,value2\n"multi\nline",value4\nvalue5,value6\nvalue7,\u00e9t\u00e9\n'.encode())
+    file.name = "test.csv"
+    csvparser = CsvParser(max_rows_per_page=2)
+
+    pages = [page async for page in csvparser.parse(file)]
+
+    # Quoted values can span several lines, and the file is left open for the caller
+    assert [page.text for page in pages] == [
+        f"value1,value2{ROW_SEPARATOR}multi\nline,value4",
+        f"value5,value6{ROW_SEPARATOR}value7,\u00e9t\u00e9",
+    ]
+    assert [page.page_num for page in pages] == [0, 1]
+    assert pages[1].offset == len(pages[0].text) + len(ROW_SEPARATOR)
+    assert not file.closed
+
+    file.seek(0)
+    csvparser = CsvParser(max_rows_per_page=100, max_page_length=25)
+    pages = [page async for page in csvparser.parse(file)]
+    assert [page.text for page in pages] == [
+        "value1,value2",
+        "multi\nline,value4",
+        f"value5,value6{ROW_SEPARATOR}value7,\u00e9t\u00e9",
+    ]
@@ -0,0 +1,49 @@
+import time
+
+from prepdocslib.embeddingcache import EmbeddingCache
+
+
+def test_embedding_cache_key():
+    key = EmbeddingCache.key("text-embedding-3-large", 3072, "hello")
+    assert key == EmbeddingCache.key("text-embedding-3-large", 3072, "hello")
+    assert key != EmbeddingCache.key("text-embedding-3-large", 1536, "hello")
+    assert key != EmbeddingCache.key("text-embedding-3-small", 3072, "hello")
+    assert key != EmbeddingCache.key("text-embedding-3-large", 3072, "hello!")
+
+
+def test_embedding_cache_roundtrip(tmp_path):
+    path = str(tmp_path / "cache" / "embeddings.sqlite")
+    cache = EmbeddingCache(path)
+    cache.set_many({"a": [0.5, -0.25], "b": [1.0, 2.0]})
+    assert cache.get_many(["a", "c", "a"]) == {"a": [0.5, -0.25]}
+    assert cache.hits == 2
+    assert cache.misses == 1
+    assert round(cache.hit_rate(), 2) == 0.67
+    cache.close()
+
+    # The cache persists across runs
+    cache = EmbeddingCache(path)
+    assert cache.get_many(["b"]) == {"b": [1.0, 2.0]}
+    assert cache.count() == 2
+    cache.close()
+
+
+def test_embedding_cache_evict(tmp_path, monkeypatch):
+    cache = EmbeddingCache(str(tmp_path / "embeddings.sqlite"))
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now - 10 * 24 * 60 * 60)
+    cache.set_many({"old": [1.0]})
+    monkeypatch.setattr(time, "time", lambda: now)
+    cache.set_many({"a": [1.0], "b": [2.0], "c": [3.0]})
+    monkeypatch.setattr(time, "time", lambda: now + 1)
+    cache.get_many(["a"])
+
+    assert cache.evict(max_age_days=5) == 1
+    assert cache.count() == 3
+
+    monkeypatch.setattr(time, "time", lambda: now + 2)
+    cache.get_many(["c"])
+    assert cache.evict(max_entries=2) == 1
+    assert set(cache.get_many(["a", "b", "c"]).keys()) == {"a", "c"}
+    cache.vacuum()
+    cache.close()
@@ -0,0 +1,31 @@
+import time
+
+from prepdocslib.figuredescriptioncache import FigureDescriptionCache
+
+
+def test_figure_description_cache_roundtrip(tmp_path):
+    path = str(tmp_path / "cache" / "figures.sqlite")
+    cache = FigureDescriptionCache(path)
+    cache.set_many({"a": "A pie chart", "b": "A logo"})
+    assert cache.get_many(["a", "c", "a"]) == {"a": "A pie chart"}
+    assert cache.hit_rate() == 0.5
+    cache.close()
+
+    # The cache persists across runs
+    cache = FigureDescriptionCache(path)
+    assert cache.get_many(["b"]) == {"b": "A logo"}
+    cache.close()
+
+
+def test_figure_description_cache_max_entries(monkeypatch):
+    cache = FigureDescriptionCache(max_entries=2)
+    now = time.time()
+    for i, image_hash in enumerate(["a", "b", "c"]):
+        monkeypatch.setattr(time, "time", lambda i=i: now + i)
+        if image_hash == "c":
+            # Using a description makes it the most recently used one
+            cache.get_many(["a"])
+        cache.set_many({image_hash: f"Figure {image_hash}"})
+    assert cache.count() == 2
+    assert cache.get_many(["a", "b", "c"]) == {"a": "Figure a", "c": "Figure c"}
+    cache.close()
@@ -2,6 +2,7 @@ import io
 
 import pytest
 
+from prepdocslib import htmlparser
 from prepdocslib.htmlparser import LocalHTMLParser
 
 
@@ -43,8 +44,7 @@ async def test_htmlparser_remove_hyphens():
 
 @pytest.mark.asyncio
 async def test_htmlparser_full():
-    file = io.StringIO(
-        """
+    file = io.StringIO("""
         <html>
             <head>
                 <title>Test title</title>
@@ -62,8 +62,7 @@ async def test_htmlparser_full():
                 </p>
             </body>
         </html>
-        """
-    )
+        """)
     file.name = "test.json"
     htmlparser = LocalHTMLParser()
     pages = [page async for page in htmlparser.parse(file)]
@@ -74,3 +73,73 @@ async def test_htmlparser_full():
         pages[0].text
         == "Test title\nTest header\n Test paragraph one\n Test paragraph two\n Test paragraph three\n -- Test hyphens --"
     )
+
+
+@pytest.mark.asyncio
+async def test_htmlparser_fast_engine_matches_beautifulsoup():
+    html = """
+        <!DOCTYPE html>
+        <html>
+            <head>
+                <title>Test title</title>
+                <style>p { color: red; }</style>
+                <script>var html = "<p>Not text</p>";</script>
+            </head>
+            <body>
+                <!-- Test comment -->
+                <h1>Test header</h1>
+                <p>
+                Test paragraph one &amp; two<br>
+                Test paragraph three<br><br><br>
+                </p>
+                <p>
+                ---------- Test hyphens ----------
+                </p>
+            </body>
+        </html>
+        """
+    file = io.StringIO(html)
+    file.name = "test.html"
+    expected = [page async for page in LocalHTMLParser().parse(file)]
+    file = io.BytesIO(html.encode())
+    file.name = "test.html"
+    pages = [page async for page in LocalHTMLParser(engine="fast").parse(file)]
+    assert len(pages) == 1
+    assert pages[0].page_num == 0
+    assert pages[0].offset == 0
+    assert pages[0].text == expected[0].text
+    assert "Not text" not in pages[0].text
+
+
+@pytest.mark.asyncio
+async def test_htmlparser_split_on_headings(monkeypatch):
+    # Read in small chunks, to split tags and characters across reads
+    monkeypatch.setattr(htmlparser, "READ_SIZE", 5)
+    file = io.BytesIO("""
+        <html><body>
+            <p>Introduction é</p>
+            <h1>First heading</h1>
+            <p>First section</p>
+            <h2>Second heading</h2>
+            <script>var x = "<h2>Not a heading</h2>";</script>
+            <p>Second section</p>
+            <h2></h2>
+        </body></html>
+        """.encode())
+    file.name = "test.html"
+    htmlparser_fast = LocalHTMLParser(engine="fast", split_on_headings=True)
+    pages = [page async for page in htmlparser_fast.parse(file)]
+    assert [page.text for page in pages] == [
+        "Introduction é",
+        "First heading\nFirst section",
+        "Second heading\nSecond section",
+    ]
+    assert [page.page_num for page in pages] == [0, 1, 2]
+    assert [page.offset for page in pages] == [0, 15, 43]
+
+
+def test_htmlparser_split_on_headings_requires_fast_engine():
+    with pytest.raises(ValueError):
+        LocalHTMLParser(split_on_headings=True)
+    with pytest.raises(ValueError):
+        LocalHTMLParser(engine="lxml")
@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents.aio import SearchClient
+
+from prepdocslib.indexingwriter import IndexingError, IndexingWriter
+
+from .mocks import MockAzureCredential, MockIndexingResult, mock_indexing_results
+
+
+@pytest.fixture
+def search_client():
+    return SearchClient(endpoint="https://test.search.windows.net", index_name="test", credential=MockAzureCredential())
+
+
+@pytest.mark.asyncio
+async def test_indexingwriter_batches_by_count_and_size(monkeypatch, search_client):
+    batches = []
+
+    async def mock_merge_or_upload_documents(self, documents):
+        batches.append([document["id"] for document in documents])
+        return mock_indexing_results(documents)
+
+    monkeypatch.setattr(SearchClient, "merge_or_upload_documents", mock_merge_or_upload_documents)
+
+    async with IndexingWriter(search_client, max_batch_documents=3) as writer:
+        await writer.merge_or_upload_documents([{"id": str(i)} for i in range(7)])
+    assert batches == [["0", "1", "2"], ["3", "4", "5"], ["6"]]
+    assert writer.succeeded == 7
+
+    # Each document with a 3072-dimension vector is about 40 KB once serialized
+    batches.clear()
+    documents = [{"id": str(i), "embedding": [0.123456789] * 3072} for i in range(10)]
+    async with IndexingWriter(search_client, max_batch_bytes=100 * 1024) as writer:
+        await writer.merge_or_upload_documents(documents)
+    assert batches == [["0", "1"], ["2", "3"], ["4", "5"], ["6", "7"], ["8", "9"]]
+
+
+@pytest.mark.asyncio
+async def test_indexingwriter_sends_batches_concurrently(monkeypatch, search_client):
+    in_flight = 0
+    max_in_flight = 0
+
+    async def mock_delete_documents(self, documents):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return mock_indexing_results(documents)
+
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    async with IndexingWriter(search_client, max_batch_documents=1, max_concurrency=3) as writer:
+        await writer.delete_documents([{"id": str(i)} for i in range(10)])
+    assert writer.succeeded == 10
+    assert max_in_flight == 3
+
+
+@pytest.mark.asyncio
+async def test_indexingwriter_retries_failed_documents(monkeypatch, search_client):
+    requests = []
+
+    async def mock_merge_documents(self, documents):
+        requests.append([document["id"] for document in documents])
+        if len(requests) == 1:
+            raise HttpResponseError(message="Service unavailable", response=MockHttpResponse(503))
+        # The service fails one document as unavailable, and reports it in a 207 response
+        results = []
+        for document in documents:
+            unavailable = len(requests) == 2 and document["id"] == "b"
+            results.append(
+                MockIndexingResult(document["id"], succeeded=not unavailable, status_code=503 if unavailable else 200)
+            )
+        return results
+
+    monkeypatch.setattr(SearchClient, "merge_documents", mock_merge_documents)
+
+    async with IndexingWriter(search_client, retry_delay=0) as writer:
+        await writer.merge_documents([{"id": "a"}, {"id": "b"}, {"id": "c"}])
+    assert requests == [["a", "b", "c"], ["a", "b", "c"], ["b"]]
+    assert writer.succeeded == 3
+
+
+@pytest.mark.asyncio
+async def test_indexingwriter_reports_failed_documents(monkeypatch, search_client):
+    requests = []
+
+    async def mock_merge_or_upload_documents(self, documents):
+        requests.append(documents)
+        # Documents that are invalid, like a document with an unknown field, are not retried
+        return [
+            MockIndexingResult(document["id"], succeeded=False, status_code=400, error_message="Invalid document")
+            for document in documents
+        ]
+
+    monkeypatch.setattr(SearchClient, "merge_or_upload_documents", mock_merge_or_upload_documents)
+
+    with pytest.raises(IndexingError, match="Failed to index 2 documents, for example a: Invalid document"):
+        async with IndexingWriter(search_client, retry_delay=0) as writer:
+            await writer.merge_or_upload_documents([{"id": "a"}, {"id": "b"}])
+    assert len(requests) == 1
+
+    errors = []
+    async with IndexingWriter(search_client, on_error=lambda document, error: errors.append(document["id"])) as writer:
+        await writer.merge_or_upload_documents([{"id": "a"}, {"id": "b"}])
+    assert errors == ["a", "b"]
+
+
+class MockHttpResponse:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+        self.reason = "Service Unavailable"
+        self.headers = {}
+
+    def text(self):
+        return ""
@@ -1,8 +1,9 @@
 import io
+import json
 
 import pytest
 
-from prepdocslib.jsonparser import JsonParser
+from prepdocslib.jsonparser import JsonLinesParser, JsonParser, iter_json_array
 
 
 @pytest.mark.asyncio
@@ -30,3 +31,45 @@ async def test_jsonparser_array_multiple_obj():
     assert pages[1].page_num == 1
     assert pages[1].offset == 19
     assert pages[1].text == '{"test2": "test"}'
+
+
+@pytest.mark.asyncio
+async def test_jsonparser_array_binary_file():
+    file = io.BytesIO('\ufeff \n[{"test1": "t\u00e9st"}, 1.5, [2, 3], "last"]\n'.encode())
+    file.name = "test.json"
+    jsonparser = JsonParser()
+    pages = [page async for page in jsonparser.parse(file)]
+    assert [page.text for page in pages] == ['{"test1": "t\\u00e9st"}', "1.5", "[2, 3]", '"last"']
+    assert [page.offset for page in pages] == [1, 24, 28, 35]
+
+
+def test_iter_json_array_reads_incrementally():
+    data = [{"id": i, "values": [i * 1.25, None, True], "text": "\u00e9t\u00e9 \U0001f600"} for i in range(50)]
+    file = io.BytesIO(json.dumps(data, ensure_ascii=False).encode())
+    reads = []
+    read = file.read
+
+    def read_chunk(size=-1):
+        reads.append(size)
+        return read(size)
+
+    file.read = read_chunk
+    # Elements and characters cut by the end of a chunk are completed by the next chunks
+    assert list(iter_json_array(file, read_size=7)) == data
+    assert all(0 < size < 100 for size in reads)
+
+    with pytest.raises(ValueError, match="Expected a JSON array"):
+        list(iter_json_array(io.StringIO('{"test": "test"}')))
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO("[1, 2")))
+
+
+@pytest.mark.asyncio
+async def test_jsonlinesparser():
+    file = io.BytesIO(b'{"test1": "test"}\n\n[1,2]\n{"test2":   "test"}')
+    file.name = "test.jsonl"
+    jsonlinesparser = JsonLinesParser()
+    pages = [page async for page in jsonlinesparser.parse(file)]
+    assert [page.text for page in pages] == ['{"test1": "test"}', "[1, 2]", '{"test2": "test"}']
+    assert [page.page_num for page in pages] == [0, 1, 2]
+    assert [page.offset for page in pages] == [0, 18, 25]
@@ -1,17 +1,21 @@
+import asyncio
 import hashlib
 import io
 import os
 import tempfile
 
 import pytest
+from azure.storage.filedatalake import PathProperties
+from azure.storage.filedatalake.aio import DataLakeServiceClient
 
+from prepdocslib.ingestionmanifest import IngestionManifest, ManifestEntry
 from prepdocslib.listfilestrategy import (
     ADLSGen2ListFileStrategy,
     File,
     LocalListFileStrategy,
 )
 
-from .mocks import MockAzureCredential
+from .mocks import MockAsyncPageIterator, MockAzureCredential
 
 
 def test_file_filename():
@@ -131,6 +135,78 @@ def test_locallistfilestrategy_checkmd5():
         assert local_list_strategy.check_md5(pdf_file.name) is False
 
 
+@pytest.mark.asyncio
+async def test_locallistfilestrategy_manifest(tmp_path):
+    data_dir = tmp_path / "data"
+    data_dir.mkdir()
+    for filename in ["a.txt", "b.txt", "c.txt"]:
+        (data_dir / filename).write_text(f"content of {filename}")
+    manifest = IngestionManifest(str(tmp_path / "manifest.sqlite"))
+
+    async def ingest():
+        strategy = LocalListFileStrategy(path_pattern=f"{data_dir}/*", manifest=manifest)
+        ingested = []
+        async for file in strategy.list():
+            ingested.append(file.filename())
+            strategy.mark_ingested(file, [f"{file.filename()}-0", f"{file.filename()}-1"])
+            file.close()
+        removed = [path async for path in strategy.list_removed_paths()]
+        for path in removed:
+            strategy.mark_removed(path)
+        return sorted(ingested), removed
+
+    assert await ingest() == (["a.txt", "b.txt", "c.txt"], [])
+    assert not any(path.endswith(".md5") for path in os.listdir(data_dir)), "No .md5 files should be written"
+    entry = manifest.get(str(data_dir / "a.txt"))
+    assert entry is not None
+    assert entry.content_hash == hashlib.sha256(b"content of a.txt").hexdigest()
+    assert entry.document_ids == ["a.txt-0", "a.txt-1"]
+    assert entry.chunk_count == 2
+    assert manifest.stats() == {"files": 3, "chunks": 6}
+
+    # Nothing changed, so nothing is ingested again
+    assert await ingest() == ([], [])
+
+    # Touching a file without changing it doesn't re-ingest it
+    os.utime(data_dir / "b.txt", ns=(0, 0))
+    assert await ingest() == ([], [])
+    entry = manifest.get(str(data_dir / "b.txt"))
+    assert entry is not None and entry.mtime_ns == 0
+
+    # Changed and removed files are detected
+    (data_dir / "a.txt").write_text("new content of a.txt")
+    os.remove(data_dir / "c.txt")
+    strategy = LocalListFileStrategy(path_pattern=f"{data_dir}/*", manifest=manifest)
+    diff = await strategy.diff()
+    assert diff.added == []
+    assert diff.changed == [str(data_dir / "a.txt")]
+    assert diff.unchanged == [str(data_dir / "b.txt")]
+    assert diff.removed == [str(data_dir / "c.txt")]
+    assert diff.has_changes()
+    assert await ingest() == (["a.txt"], [str(data_dir / "c.txt")])
+    assert manifest.paths() == [str(data_dir / "a.txt"), str(data_dir / "b.txt")]
+    assert not (await LocalListFileStrategy(path_pattern=f"{data_dir}/*", manifest=manifest).diff()).has_changes()
+
+
+@pytest.mark.asyncio
+async def test_locallistfilestrategy_manifest_removed_scope(tmp_path):
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data2").mkdir()
+    manifest = IngestionManifest(str(tmp_path / "manifest.sqlite"))
+    for path in [tmp_path / "data" / "gone.txt", tmp_path / "data2" / "gone.txt"]:
+        manifest.record(ManifestEntry(str(path), 1, 1, "hash", [], 0))
+
+    # Only missing files that the pattern could have listed are reported as removed
+    strategy = LocalListFileStrategy(path_pattern=f"{tmp_path}/data/*.txt", manifest=manifest)
+    assert strategy.base_path() == str(tmp_path / "data")
+    assert [path async for path in strategy.list_removed_paths()] == [str(tmp_path / "data" / "gone.txt")]
+    strategy = LocalListFileStrategy(path_pattern=str(tmp_path / "data2" / "gone.txt"), manifest=manifest)
+    assert [path async for path in strategy.list_removed_paths()] == [str(tmp_path / "data2" / "gone.txt")]
+
+    strategy.mark_removed()
+    assert manifest.paths() == []
+
+
 @pytest.mark.asyncio
 async def test_read_adls_gen2_files(monkeypatch, mock_data_lake_service_client):
     adlsgen2_list_strategy = ADLSGen2ListFileStrategy(
@@ -145,3 +221,125 @@ async def test_read_adls_gen2_files(monkeypatch, mock_data_lake_service_client):
     assert files[1].acls == {"oids": ["B-USER-ID"], "groups": ["B-GROUP-ID"]}
     assert files[2].filename() == "c.txt"
     assert files[2].acls == {"oids": ["C-USER-ID"], "groups": ["C-GROUP-ID"]}
+
+
+class LocalDataLakeFileClient:
+    def __init__(self, filesystem: "LocalDataLakeFileSystemClient", path: str):
+        self.filesystem = filesystem
+        self.path = path
+        self.url = f"https://test.dfs.core.windows.net/{path}"
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def download_file(self):
+        return self
+
+    async def readinto(self, stream):
+        self.filesystem.downloads_started += 1
+        self.filesystem.in_flight += 1
+        self.filesystem.max_in_flight = max(self.filesystem.max_in_flight, self.filesystem.in_flight)
+        await asyncio.sleep(0.01)
+        self.filesystem.in_flight -= 1
+        content = self.filesystem.files[self.path]
+        if content is None:
+            raise ValueError("The file is unavailable")
+        stream.write(content)
+
+    async def get_access_control(self, upn):
+        return {"acl": f"user::rwx,user:{self.path.split('/')[0]}-USER-ID:r-x,group:G-ID:---"}
+
+
+class LocalDataLakeFileSystemClient:
+    """Stands in for a data lake file system, with files kept in memory"""
+
+    def __init__(self, files):
+        self.files = files
+        self.downloads_started = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def get_paths(self, path, recursive):
+        return MockAsyncPageIterator(
+            [
+                PathProperties(name=name, content_length=len(content or b""), is_directory=False)
+                for name, content in self.files.items()
+            ]
+        )
+
+    def get_file_client(self, path):
+        return LocalDataLakeFileClient(self, path)
+
+
+@pytest.fixture
+def local_data_lake(monkeypatch, mock_data_lake_service_client):
+    filesystem = LocalDataLakeFileSystemClient({})
+    monkeypatch.setattr(DataLakeServiceClient, "get_file_system_client", lambda self, name: filesystem)
+    return filesystem
+
+
+@pytest.mark.asyncio
+async def test_read_adls_gen2_files_prefetch(local_data_lake):
+    local_data_lake.files.update({f"folder{i}/same.txt": f"content {i}".encode() for i in range(6)})
+    local_data_lake.files["folder6/broken.txt"] = None
+    strategy = ADLSGen2ListFileStrategy(
+        data_lake_storage_account="a",
+        data_lake_filesystem="a",
+        data_lake_path="a",
+        credential=MockAzureCredential(),
+        max_prefetch=3,
+    )
+
+    files = [file async for file in strategy.list()]
+    # Files are downloaded 3 at a time, and the file that could not be downloaded is skipped
+    assert local_data_lake.max_in_flight == 3
+    assert [file.content.read() for file in files] == [f"content {i}".encode() for i in range(6)]
+    assert [file.acls for file in files] == [{"oids": [f"folder{i}-USER-ID"], "groups": []} for i in range(6)]
+    assert [file.url for file in files] == [f"https://test.dfs.core.windows.net/folder{i}/same.txt" for i in range(6)]
+
+    # Files with the same name don't overwrite each other, and are deleted once closed
+    assert all(file.filename() == "same.txt" for file in files)
+    temp_paths = [file.content.name for file in files]
+    assert len(set(temp_paths)) == 6
+    for file in files:
+        file.close()
+    assert not any(os.path.exists(os.path.dirname(temp_path)) for temp_path in temp_paths)
+    assert strategy.bytes_on_disk == 0
+
+
+@pytest.mark.asyncio
+async def test_read_adls_gen2_files_prefetch_disk_limit(local_data_lake):
+    local_data_lake.files.update({f"{name}.txt": b"0123456789" for name in "abc"})
+    strategy = ADLSGen2ListFileStrategy(
+        data_lake_storage_account="a",
+        data_lake_filesystem="a",
+        data_lake_path="a",
+        credential=MockAzureCredential(),
+        max_prefetch=3,
+        max_prefetch_bytes=15,
+    )
+
+    downloads_started_when_yielded = []
+    async for file in strategy.list():
+        downloads_started_when_yielded.append(local_data_lake.downloads_started)
+        file.close()
+    # Only one file fits on disk at a time, so the next file is only downloaded once the previous one is closed
+    assert downloads_started_when_yielded == [1, 2, 3]
+
+    # Files downloaded ahead that the caller never gets are deleted as well
+    strategy.max_prefetch_bytes = 1000
+    files = strategy.list()
+    file = await files.__anext__()
+    assert strategy.bytes_on_disk == 30
+    await files.aclose()
+    file.close()
+    assert strategy.bytes_on_disk == 0
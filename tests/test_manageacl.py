@@ -1,6 +1,7 @@
 import logging
 
 import pytest
+from azure.core.exceptions import HttpResponseError
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.aio import SearchIndexClient
 from azure.search.documents.indexes.models import (
@@ -9,7 +10,8 @@ from azure.search.documents.indexes.models import (
     SimpleField,
 )
 
-from .mocks import MockAzureCredential
+from .mocks import MockAzureCredential, mock_indexing_results
+from scripts import manageacl
 from scripts.manageacl import ManageAcl
 
 
@@ -69,6 +71,7 @@ async def test_remove_acl(monkeypatch, capsys):
     async def mock_merge_documents(self, *args, **kwargs):
         for document in kwargs.get("documents"):
             merged_documents.append(document)
+        return mock_indexing_results(kwargs.get("documents"))
 
     monkeypatch.setattr(SearchClient, "search", mock_search)
     monkeypatch.setattr(SearchClient, "merge_documents", mock_merge_documents)
@@ -103,6 +106,7 @@ async def test_remove_all_acl(monkeypatch, capsys):
     async def mock_merge_documents(self, *args, **kwargs):
         for document in kwargs.get("documents"):
             merged_documents.append(document)
+        return mock_indexing_results(kwargs.get("documents"))
 
     monkeypatch.setattr(SearchClient, "search", mock_search)
     monkeypatch.setattr(SearchClient, "merge_documents", mock_merge_documents)
@@ -132,6 +136,7 @@ async def test_add_acl(monkeypatch, caplog):
     async def mock_merge_documents(self, *args, **kwargs):
         for document in kwargs.get("documents"):
             merged_documents.append(document)
+        return mock_indexing_results(kwargs.get("documents"))
 
     monkeypatch.setattr(SearchClient, "search", mock_search)
     monkeypatch.setattr(SearchClient, "merge_documents", mock_merge_documents)
@@ -171,6 +176,119 @@ async def test_add_acl(monkeypatch, caplog):
         assert "Adding acl OID_ADD to 2 search documents" in caplog.text
 
 
+class MockIndex:
+    """Search documents filtered by storage URL and paged in id order, like the search service does"""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.filters = []
+        self.merged = []
+
+    async def search(self, search_text, filter=None, select=None, order_by=None, top=None):
+        self.filters.append(filter)
+        url = filter.split("'")[1]
+        results = sorted(
+            [
+                {"id": document["id"], "oids": list(document["oids"])}
+                for document in self.documents
+                if document["url"] == url
+            ],
+            key=lambda document: document["id"],
+        )
+        if " and id gt '" in filter:
+            last_id = filter.split(" and id gt '")[1].rstrip("'")
+            results = [document for document in results if document["id"] > last_id]
+        return AsyncSearchResultsIterator(list(reversed(results[:top])))
+
+    async def merge_documents(self, documents):
+        self.merged.extend(documents)
+        for merged in documents:
+            next(document for document in self.documents if document["id"] == merged["id"]).update(merged)
+        return mock_indexing_results(documents)
+
+
+@pytest.mark.asyncio
+async def test_acls_in_bulk(monkeypatch, tmp_path, capsys):
+    monkeypatch.setattr(manageacl, "SEARCH_PAGE_SIZE", 2)
+    index = MockIndex(
+        [{"id": f"a{i}", "url": "https://test/a.txt", "oids": ["OID_1"]} for i in range(5)]
+        + [{"id": "b0", "url": "https://test/b.txt", "oids": ["OID_1", "OID_2"]}]
+        + [{"id": "c0", "url": "https://test/c.txt", "oids": []}]
+    )
+    monkeypatch.setattr(SearchClient, "search", lambda self, *args, **kwargs: index.search(*args, **kwargs))
+    monkeypatch.setattr(SearchClient, "merge_documents", lambda self, documents: index.merge_documents(documents))
+    acl_file = tmp_path / "acls.csv"
+    acl_file.write_text("https://test/a.txt,OID_2\nhttps://test/a.txt,OID_3\n\nhttps://test/b.txt\n")
+
+    command = ManageAcl(
+        service_name="SERVICE",
+        index_name="INDEX",
+        url="",
+        acl_action="add",
+        acl_type="oids",
+        acl="OID_2",
+        credentials=MockAzureCredential(),
+        acl_file=str(acl_file),
+        max_concurrency=2,
+    )
+    await command.run()
+    assert sorted(index.merged, key=lambda document: document["id"]) == [
+        {"id": f"a{i}", "oids": ["OID_1", "OID_2", "OID_3"]} for i in range(5)
+    ]
+    # Each storage URL is retrieved a page at a time
+    assert index.filters.count("storageUrl eq 'https://test/a.txt'") == 1
+    assert "(storageUrl eq 'https://test/a.txt') and id gt 'a3'" in index.filters
+    assert "Retrieved 6 search documents of 2 storage URLs and updated 5 of the 5" in capsys.readouterr().out
+
+    index.merged.clear()
+    acl_file.write_text("https://test/a.txt,OID_3\nhttps://test/b.txt,OID_2\nhttps://test/c.txt,OID_2\n")
+    command.acl_action = "remove"
+    await command.run()
+    assert sorted(index.merged, key=lambda document: document["id"]) == [
+        {"id": f"a{i}", "oids": ["OID_1", "OID_2"]} for i in range(5)
+    ] + [{"id": "b0", "oids": ["OID_1"]}]
+
+    acl_file.write_text("https://test/c.txt\n")
+    command.acl = None
+    with pytest.raises(ValueError):
+        await command.run()
+
+
+@pytest.mark.asyncio
+async def test_get_documents_without_sortable_ids(monkeypatch):
+    monkeypatch.setattr(manageacl, "SEARCH_PAGE_SIZE", 2)
+    documents_in_index = [{"id": str(i), "oids": []} for i in range(5)]
+    skips = []
+
+    async def mock_search(self, *args, **kwargs):
+        if kwargs.get("order_by"):
+            raise HttpResponseError(message="Field 'id' is not sortable")
+        skip, top = kwargs["skip"], kwargs["top"]
+        skips.append(skip)
+        # The iterator yields the results in reverse
+        return AsyncSearchResultsIterator(documents_in_index[skip : skip + top][::-1])
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    command = ManageAcl(
+        service_name="SERVICE",
+        index_name="INDEX",
+        url="https://test/a's.txt",
+        acl_action="view",
+        acl_type="oids",
+        acl="",
+        credentials=MockAzureCredential(),
+    )
+    async with SearchClient(endpoint="https://test", index_name="INDEX", credential=MockAzureCredential()) as client:
+        documents = [document async for document in command.get_documents(client, command.url)]
+        assert [document["id"] for document in documents] == ["0", "1", "2", "3", "4"]
+        assert skips == [0, 2, 4]
+
+        # Documents past the skip limit of the service can't be retrieved without sortable ids
+        monkeypatch.setattr(manageacl, "MAX_SEARCH_SKIP", 4)
+        with pytest.raises(Exception, match="More than 4 search documents"):
+            _ = [document async for document in command.get_documents(client, command.url)]
+
+
 @pytest.mark.asyncio
 async def test_update_storage_urls(monkeypatch, caplog):
     async def mock_search(self, *args, **kwargs):
@@ -188,6 +306,7 @@ async def test_update_storage_urls(monkeypatch, caplog):
     async def mock_merge_documents(self, *args, **kwargs):
         for document in kwargs.get("documents"):
             merged_documents.append(document)
+        return mock_indexing_results(kwargs.get("documents"))
 
     monkeypatch.setattr(SearchClient, "search", mock_search)
     monkeypatch.setattr(SearchClient, "merge_documents", mock_merge_documents)
@@ -0,0 +1,93 @@
+import csv
+import hashlib
+import io
+
+import pytest
+
+from prepdocslib.listfilestrategy import LocalListFileStrategy
+from prepdocslib.mappedfile import MappedFile
+from prepdocslib.pdfparser import LocalPdfParser
+
+
+def test_mappedfile_read(tmp_path):
+    path = tmp_path / "test.csv"
+    path.write_bytes(b'a,b\nc,"d\ne"\nf,g')
+    with MappedFile(str(path)) as file:
+        assert file.name == str(path)
+        assert file.readline() == b"a,b\n"
+        assert file.read(3) == b'c,"'
+        assert list(file) == [b"d\n", b'e"\n', b"f,g"]
+        assert file.read() == b""
+        file.seek(2)
+        buffer = bytearray(4)
+        assert file.readinto(buffer) == 4
+        assert buffer == b"b\nc,"
+        assert file.seek(-3, io.SEEK_END) == 12
+        assert file.read() == b"f,g"
+        assert bytes(file.getbuffer()) == path.read_bytes()
+        file.seek(0)
+        text = io.TextIOWrapper(file, encoding="utf-8", newline="")
+        assert list(csv.reader(text)) == [["a", "b"], ["c", "d\ne"], ["f", "g"]]
+        text.detach()
+    assert file.closed
+    with pytest.raises(ValueError):
+        file.read()
+    with pytest.raises(ValueError):
+        with file:
+            pass
+
+
+def test_mappedfile_empty(tmp_path):
+    path = tmp_path / "empty.txt"
+    path.write_bytes(b"")
+    with MappedFile(str(path)) as file:
+        assert file.read() == b""
+        assert file.readline() == b""
+        assert bytes(file.getbuffer()) == b""
+        assert file.sha256() == hashlib.sha256(b"").hexdigest()
+
+
+def test_mappedfile_sha256_while_reading(tmp_path):
+    data = bytes(range(256)) * 1000
+    path = tmp_path / "data.bin"
+    path.write_bytes(data)
+    with MappedFile(str(path)) as file:
+        # Bytes read in order are hashed as they are read, even after seeking back and reading again
+        file.read(1000)
+        file.seek(500)
+        file.read(10000)
+        file.seek(50000)
+        file.read(10)
+        assert file.hashed == 10500
+        assert file.sha256() == hashlib.sha256(data).hexdigest()
+    with MappedFile(str(path)) as file:
+        while file.read(4096):
+            pass
+        assert file.hashed == len(data)
+        assert file.sha256() == hashlib.sha256(data).hexdigest()
+
+
+@pytest.mark.asyncio
+async def test_local_list_file_strategy_maps_files(tmp_path):
+    (tmp_path / "a.txt").write_bytes(b"hello")
+    list_strategy = LocalListFileStrategy(path_pattern=str(tmp_path / "*"))
+    files = [file async for file in list_strategy.list()]
+    assert len(files) == 1
+    assert isinstance(files[0].content, MappedFile)
+    assert files[0].content.read() == b"hello"
+    files[0].close()
+    assert files[0].content.closed
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", LocalPdfParser.BACKENDS)
+async def test_local_pdf_parser_mapped_file(tmp_path, backend):
+    pymupdf = pytest.importorskip("pymupdf")
+    path = tmp_path / "test.pdf"
+    with pymupdf.open() as doc:
+        for i in range(3):
+            doc.new_page().insert_text((72, 72), f"Page {i + 1}")
+        doc.save(path)
+    with MappedFile(str(path)) as file:
+        pages = [page async for page in LocalPdfParser(backend=backend).parse(file)]
+    assert [page.text.strip() for page in pages] == ["Page 1", "Page 2", "Page 3"]
@@ -0,0 +1,52 @@
+import time
+
+from prepdocslib.parsecache import ParseCache
+
+
+def test_parse_cache_key():
+    key = ParseCache.key("abc", "prebuilt-layout", "")
+    assert key == ParseCache.key("abc", "prebuilt-layout", "")
+    assert key != ParseCache.key("abd", "prebuilt-layout", "")
+    assert key != ParseCache.key("abc", "prebuilt-read", "")
+    assert key != ParseCache.key("abc", "prebuilt-layout", "figures")
+    assert key != ParseCache.key("abc", "prebuilt-layout", "", "1-100")
+
+
+def test_parse_cache_roundtrip(tmp_path):
+    path = str(tmp_path / "cache" / "results.sqlite")
+    cache = ParseCache(path)
+    cache.set("a", {"content": "Hello", "pages": [{"pageNumber": 1}]})
+    assert cache.get("a") == {"content": "Hello", "pages": [{"pageNumber": 1}]}
+    assert cache.get("b") is None
+    assert cache.hit_rate() == 0.5
+    cache.close()
+
+    # The cache persists across runs, unless it's refreshed
+    cache = ParseCache(path)
+    assert cache.get("a") is not None
+    cache.close()
+    cache = ParseCache(path, refresh=True)
+    assert cache.get("a") is None
+    cache.set("a", {"content": "Hello again"})
+    cache.close()
+    cache = ParseCache(path)
+    assert cache.get("a") == {"content": "Hello again"}
+    cache.close()
+
+
+def test_parse_cache_evict(tmp_path, monkeypatch):
+    cache = ParseCache(str(tmp_path / "results.sqlite"))
+    now = time.time()
+    for i, key in enumerate(["a", "b", "c"]):
+        monkeypatch.setattr(time, "time", lambda: now + i)
+        cache.set(key, {"content": key * 1000})
+    monkeypatch.setattr(time, "time", lambda: now + 10)
+    cache.get("a")
+    entry_size = cache.size() // 3
+
+    assert cache.evict(max_bytes=entry_size * 2) == 1
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+    assert cache.evict(max_bytes=entry_size * 2) == 0
+    cache.close()
@@ -1,10 +1,12 @@
+import asyncio
 import io
 import json
 import logging
 import math
 import pathlib
-from unittest.mock import AsyncMock, MagicMock, Mock
+from unittest.mock import MagicMock, Mock
 
+import aiohttp
 import pymupdf
 import pytest
 from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
@@ -21,10 +23,16 @@ from azure.ai.documentintelligence.models import (
 from azure.core.exceptions import HttpResponseError
 from PIL import Image, ImageChops
 
+from prepdocslib.figuredescriptioncache import FigureDescriptionCache
 from prepdocslib.mediadescriber import ContentUnderstandingDescriber
-from prepdocslib.pdfparser import DocumentAnalysisParser
+from prepdocslib.parsecache import ParseCache
+from prepdocslib.pdfparser import (
+    DocumentAnalysisParser,
+    LocalPdfParser,
+    crop_images_from_pdf,
+)
 
-from .mocks import MockAzureCredential
+from .mocks import MockAzureCredential, MockResponse
 
 TEST_DATA_DIR = pathlib.Path(__file__).parent / "test-data"
 
@@ -39,6 +47,29 @@ def assert_image_equal(image1, image2):
     assert rms < 90
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("backend", ["pypdf", "pymupdf"])
+async def test_local_pdf_parser(backend):
+    doc = pymupdf.open()
+    for page_number in range(1, 41):
+        doc.new_page().insert_text((72, 72), f"Text of page {page_number}")
+    content = io.BytesIO(doc.tobytes())
+    content.name = "test.pdf"
+
+    # The 40 pages are extracted in ranges by 2 worker processes, and yielded in order
+    parser = LocalPdfParser(backend=backend, max_workers=2)
+    pages = [page async for page in parser.parse(content)]
+
+    assert [page.page_num for page in pages] == list(range(40))
+    assert [page.text.strip() for page in pages] == [f"Text of page {page_number}" for page_number in range(1, 41)]
+    assert pages[1].offset == len(pages[0].text)
+
+
+def test_local_pdf_parser_unknown_backend():
+    with pytest.raises(ValueError, match="Unknown local PDF parser backend 'pdfminer'"):
+        LocalPdfParser(backend="pdfminer")
+
+
 def test_crop_image_from_pdf_page():
     doc = pymupdf.open(TEST_DATA_DIR / "Financial Market Analysis Report 2023.pdf", filetype="pdf")
     page_number = 2
@@ -105,21 +136,40 @@ def test_table_to_html_with_spans():
     assert result_html == expected_html
 
 
-@pytest.mark.asyncio
-async def test_figure_to_html_without_bounding_regions():
-    doc = MagicMock()
-    figure = DocumentFigure(id="1", caption=None, bounding_regions=None)
-    cu_describer = MagicMock()
+def test_page_text():
+    content = "Before. Table A part 1. Middle. Table A part 2. Figure over table. After."
 
-    result_html = await DocumentAnalysisParser.figure_to_html(doc, figure, cu_describer)
-    expected_html = "<figure><figcaption></figcaption></figure>"
+    def span(text):
+        return DocumentSpan(offset=content.index(text), length=len(text))
 
-    assert result_html == expected_html
+    table_a = [span("Table A part 1."), span("Table A part 2.")]
+    table_b = [span("Figure over table.")]
+    figure = [span("over")]
+    objects = [(table_a, lambda: "<A>"), (table_b, lambda: "<B>"), (figure, lambda: "<F>")]
 
+    # The HTML of an object is inserted once, and later objects win where spans overlap
+    page_text = DocumentAnalysisParser.page_text(content, DocumentSpan(offset=0, length=len(content)), objects)
+    assert page_text == "Before. <A> Middle.  <B><F> After."
 
-@pytest.mark.asyncio
-async def test_figure_to_html_with_bounding_regions(monkeypatch, caplog):
-    doc = MagicMock()
+    # Only the part of the content within the page is used
+    page_text = DocumentAnalysisParser.page_text(content, span("part 1. Middle. Table"), objects)
+    assert page_text == "<A> Middle. "
+
+
+def test_figure_html():
+    figure = DocumentFigure(id="1", caption=DocumentCaption(content="Figure 1"))
+    assert DocumentAnalysisParser.figure_html(figure, None) == "<figure><figcaption>Figure 1</figcaption></figure>"
+    assert (
+        DocumentAnalysisParser.figure_html(figure, "Described Image")
+        == "<figure><figcaption>Figure 1<br>Described Image</figcaption></figure>"
+    )
+    figure_without_caption = DocumentFigure(id="2", caption=None)
+    assert (
+        DocumentAnalysisParser.figure_html(figure_without_caption, None) == "<figure><figcaption></figcaption></figure>"
+    )
+
+
+def test_figure_page_and_bounding_box(caplog):
     figure = DocumentFigure(
         id="1",
         caption=DocumentCaption(content="Figure 1"),
@@ -128,27 +178,15 @@ async def test_figure_to_html_with_bounding_regions(monkeypatch, caplog):
             BoundingRegion(page_number=2, polygon=[1.4703, 2.8371, 5.5409, 2.8415, 5.5381, 6.6022, 1.4681, 6.5978]),
         ],
     )
-    cu_describer = AsyncMock()
-
-    async def mock_describe_image(image_bytes):
-        assert image_bytes == b"image_bytes"
-        return "Described Image"
-
-    monkeypatch.setattr(cu_describer, "describe_image", mock_describe_image)
-
-    def mock_crop_image_from_pdf_page(doc, page_number, bounding_box) -> bytes:
+    with caplog.at_level(logging.WARNING):
+        page_number, bounding_box = DocumentAnalysisParser.figure_page_and_bounding_box(figure)
         assert page_number == 0
         assert bounding_box == (1.4703, 2.8371, 5.5381, 6.6022)
-        return b"image_bytes"
-
-    monkeypatch.setattr(DocumentAnalysisParser, "crop_image_from_pdf_page", mock_crop_image_from_pdf_page)
-
-    with caplog.at_level(logging.WARNING):
-        result_html = await DocumentAnalysisParser.figure_to_html(doc, figure, cu_describer)
-        expected_html = "<figure><figcaption>Figure 1<br>Described Image</figcaption></figure>"
-        assert result_html == expected_html
         assert "Figure 1 has more than one bounding region, using the first one" in caplog.text
 
+    with pytest.raises(ValueError):
+        DocumentAnalysisParser.figure_page_and_bounding_box(DocumentFigure(id="2", bounding_regions=None))
+
 
 @pytest.mark.asyncio
 async def test_parse_simple(monkeypatch):
@@ -312,6 +350,249 @@ async def test_parse_doc_with_figures(monkeypatch):
     )
 
 
+@pytest.mark.asyncio
+async def test_describe_figures(monkeypatch):
+    def figure(id, polygon):
+        return DocumentFigure(
+            id=id,
+            caption=DocumentCaption(content=f"Figure {id}"),
+            bounding_regions=[BoundingRegion(page_number=1, polygon=polygon)] if polygon else None,
+        )
+
+    pie_chart = [0.4295, 1.3072, 1.7071, 1.3076, 1.7067, 2.6088, 0.4291, 2.6085]
+    title = [0.5, 0.5, 3.0, 0.5, 3.0, 1.0, 0.5, 1.0]
+    figures = [figure("1", pie_chart), figure("2", title), figure("3", None), figure("4", pie_chart)]
+
+    described_images = []
+
+    async def mock_describe_image(self, image_bytes):
+        described_images.append(image_bytes)
+        return f"Description {len(described_images)}"
+
+    monkeypatch.setattr(ContentUnderstandingDescriber, "describe_image", mock_describe_image)
+
+    parser = DocumentAnalysisParser(
+        endpoint="https://example.com", credential=MockAzureCredential(), max_figure_concurrency=2
+    )
+    cu_describer = ContentUnderstandingDescriber("https://example.com", MockAzureCredential())
+    with open(TEST_DATA_DIR / "Simple Figure.pdf", "rb") as f:
+        content_bytes = f.read()
+
+    figure_htmls = await parser.describe_figures(content_bytes, figures, cu_describer)
+
+    # The same figure appearing twice is only described once, and figures without regions are not described
+    assert len(described_images) == 2
+    assert figure_htmls[0] == "<figure><figcaption>Figure 1<br>Description 1</figcaption></figure>"
+    assert figure_htmls[1] == "<figure><figcaption>Figure 2<br>Description 2</figcaption></figure>"
+    assert figure_htmls[2] == "<figure><figcaption>Figure 3</figcaption></figure>"
+    assert figure_htmls[3] == "<figure><figcaption>Figure 4<br>Description 1</figcaption></figure>"
+
+    # Figures that were already described, in this document or another one, are not described again
+    assert await parser.describe_figures(content_bytes, figures, cu_describer) == figure_htmls
+    assert len(described_images) == 2
+
+
+@pytest.mark.asyncio
+async def test_describe_figures_cached_across_runs(monkeypatch, tmp_path):
+    figures = [
+        DocumentFigure(
+            id="1",
+            caption=DocumentCaption(content="Figure 1"),
+            bounding_regions=[
+                BoundingRegion(page_number=1, polygon=[0.4295, 1.3072, 1.7071, 1.3076, 1.7067, 2.6088, 0.4291, 2.6085])
+            ],
+        )
+    ]
+    described_images = []
+
+    async def mock_describe_image(self, image_bytes):
+        described_images.append(image_bytes)
+        return "Pie chart"
+
+    monkeypatch.setattr(ContentUnderstandingDescriber, "describe_image", mock_describe_image)
+
+    def create_parser(cache):
+        return DocumentAnalysisParser(
+            endpoint="https://example.com", credential=MockAzureCredential(), figure_description_cache=cache
+        )
+
+    # Figures can be cropped from the path of the PDF, so that its bytes aren't sent to the worker processes
+    pdf_path = str(TEST_DATA_DIR / "Simple Figure.pdf")
+    cache_path = str(tmp_path / "figures.sqlite")
+    cache = FigureDescriptionCache(cache_path)
+    cu_describer = ContentUnderstandingDescriber("https://example.com", MockAzureCredential())
+    figure_htmls = await create_parser(cache).describe_figures(pdf_path, figures, cu_describer)
+    assert figure_htmls == ["<figure><figcaption>Figure 1<br>Pie chart</figcaption></figure>"]
+    assert len(described_images) == 1
+    cache.close()
+
+    # The next run uses the descriptions of the previous one
+    cache = FigureDescriptionCache(cache_path)
+    with open(pdf_path, "rb") as f:
+        content_bytes = f.read()
+    assert await create_parser(cache).describe_figures(content_bytes, figures, cu_describer) == figure_htmls
+    assert len(described_images) == 1
+    assert cache.hit_rate() == 1.0
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_describe_figures_with_content_understanding(monkeypatch):
+    # The real describer is used, with only the HTTP requests mocked, so that figures are described concurrently
+    def figure(id, polygon):
+        return DocumentFigure(
+            id=id,
+            caption=DocumentCaption(content=f"Figure {id}"),
+            bounding_regions=[BoundingRegion(page_number=1, polygon=polygon)],
+        )
+
+    pie_chart = [0.4295, 1.3072, 1.7071, 1.3076, 1.7067, 2.6088, 0.4291, 2.6085]
+    title = [0.5, 0.5, 3.0, 0.5, 3.0, 1.0, 0.5, 1.0]
+    figures = [figure("1", pie_chart), figure("2", title)]
+
+    analyzed_images = []
+    polls = {}
+
+    def mock_post(self, url, data, **kwargs):
+        analyzed_images.append(data)
+        return MockResponse(
+            status=200, headers={"Operation-Location": f"https://example.com/results/{len(analyzed_images)}"}
+        )
+
+    def mock_get(self, url, **kwargs):
+        # Every image is still running on the first poll, so that all of them are being polled at the same time
+        polls[url] = polls.get(url, 0) + 1
+        if polls[url] == 1:
+            return MockResponse(status=200, text=json.dumps({"status": "Running"}))
+        result = {"contents": [{"fields": {"Description": {"valueString": f"Image {url.rsplit('/', 1)[1]}"}}}]}
+        return MockResponse(status=200, text=json.dumps({"status": "Succeeded", "result": result}))
+
+    monkeypatch.setattr(aiohttp.ClientSession, "post", mock_post)
+    monkeypatch.setattr(aiohttp.ClientSession, "get", mock_get)
+
+    parser = DocumentAnalysisParser(endpoint="https://example.com", credential=MockAzureCredential())
+    cu_describer = ContentUnderstandingDescriber("https://example.com", MockAzureCredential())
+    with open(TEST_DATA_DIR / "Simple Figure.pdf", "rb") as f:
+        content_bytes = f.read()
+
+    figure_htmls = await parser.describe_figures(content_bytes, figures, cu_describer)
+
+    assert len(analyzed_images) == 2
+    images = crop_images_from_pdf(
+        content_bytes, [DocumentAnalysisParser.figure_page_and_bounding_box(figure) for figure in figures]
+    )
+    assert figure_htmls == [
+        f"<figure><figcaption>Figure {index + 1}<br>Image {analyzed_images.index(image) + 1}</figcaption></figure>"
+        for index, image in enumerate(images)
+    ]
+
+
+@pytest.mark.asyncio
+async def test_parse_in_page_ranges(monkeypatch):
+    doc = pymupdf.open()
+    for page_number in range(1, 6):
+        doc.new_page().insert_text((72, 72), f"Text of page {page_number}")
+    content = io.BytesIO(doc.tobytes())
+    content.name = "large.pdf"
+
+    in_flight = 0
+    max_in_flight = 0
+    analyzed_page_counts = []
+
+    async def mock_begin_analyze_document(self, model_id, analyze_request, **kwargs):
+        # Analyzes the uploaded PDF like the service would, with page numbers relative to that PDF
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        texts = []
+        with pymupdf.open(stream=analyze_request.read()) as shard:
+            for page in shard:
+                texts.append(page.get_text().strip() + "\n<!-- PageBreak -->\n")
+        analyzed_page_counts.append(len(texts))
+        pages = []
+        offset = 0
+        for page_number, text in enumerate(texts, start=1):
+            pages.append(DocumentPage(page_number=page_number, spans=[DocumentSpan(offset=offset, length=len(text))]))
+            offset += len(text)
+        result = AnalyzeResult(content="".join(texts), pages=pages)
+
+        async def mock_result():
+            nonlocal in_flight
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            return result
+
+        return MagicMock(result=mock_result)
+
+    monkeypatch.setattr(DocumentIntelligenceClient, "begin_analyze_document", mock_begin_analyze_document)
+
+    parser = DocumentAnalysisParser(
+        endpoint="https://example.com",
+        credential=MockAzureCredential(),
+        use_content_understanding=False,
+        pages_per_shard=2,
+        max_concurrency=2,
+    )
+    pages = [page async for page in parser.parse(content)]
+
+    assert sorted(analyzed_page_counts) == [1, 2, 2]
+    assert max_in_flight == 2
+    assert [page.page_num for page in pages] == [0, 1, 2, 3, 4]
+    assert [page.text for page in pages] == [f"Text of page {page_number}" for page_number in range(1, 6)]
+    assert [page.offset for page in pages] == [0, 14, 28, 42, 56]
+
+
+@pytest.mark.asyncio
+async def test_parse_with_cache(monkeypatch, tmp_path):
+    analyzed = []
+
+    async def mock_begin_analyze_document(self, model_id, analyze_request, **kwargs):
+        analyzed.append(analyze_request.read())
+        result = AnalyzeResult(
+            content="Page one",
+            pages=[DocumentPage(page_number=1, spans=[DocumentSpan(offset=0, length=8)])],
+        )
+
+        async def mock_result():
+            return result
+
+        return MagicMock(result=mock_result)
+
+    monkeypatch.setattr(DocumentIntelligenceClient, "begin_analyze_document", mock_begin_analyze_document)
+
+    def make_content(data):
+        content = io.BytesIO(data)
+        content.name = "test.docx"
+        return content
+
+    parse_cache = ParseCache(str(tmp_path / "results.sqlite"))
+    parser = DocumentAnalysisParser(
+        endpoint="https://example.com",
+        credential=MockAzureCredential(),
+        use_content_understanding=False,
+        parse_cache=parse_cache,
+    )
+    pages = [page async for page in parser.parse(make_content(b"version 1"))]
+    assert [page.text for page in pages] == ["Page one"]
+    assert analyzed == [b"version 1"]
+
+    # Parsing the same bytes again uses the cached result
+    pages = [page async for page in parser.parse(make_content(b"version 1"))]
+    assert [page.text for page in pages] == ["Page one"]
+    assert analyzed == [b"version 1"]
+
+    pages = [page async for page in parser.parse(make_content(b"version 2"))]
+    assert analyzed == [b"version 1", b"version 2"]
+    assert parse_cache.hits == 1
+    assert parse_cache.misses == 2
+
+    # A different model doesn't share cached results
+    parser.model_id = "prebuilt-read"
+    pages = [page async for page in parser.parse(make_content(b"version 1"))]
+    assert len(analyzed) == 3
+    parse_cache.close()
+
+
 @pytest.mark.asyncio
 async def test_parse_unsupportedformat(monkeypatch, caplog):
     mock_poller = MagicMock()
@@ -1,5 +1,8 @@
+import asyncio
+import json
 import logging
 
+import aiohttp
 import openai
 import openai.types
 import pytest
@@ -7,8 +10,10 @@ import tenacity
 from httpx import Request, Response
 from openai.types.create_embedding_response import Usage
 
+from prepdocslib.embeddingcache import EmbeddingCache
 from prepdocslib.embeddings import (
     AzureOpenAIEmbeddingService,
+    ImageEmbeddings,
     OpenAIEmbeddingService,
 )
 
@@ -16,6 +21,8 @@ from .mocks import (
     MOCK_EMBEDDING_DIMENSIONS,
     MOCK_EMBEDDING_MODEL_NAME,
     MockAzureCredential,
+    MockClient,
+    MockResponse,
 )
 
 
@@ -27,11 +34,6 @@ class MockEmbeddingsClient:
         return self.create_embedding_response
 
 
-class MockClient:
-    def __init__(self, embeddings_client):
-        self.embeddings = embeddings_client
-
-
 @pytest.mark.asyncio
 async def test_compute_embedding_success(monkeypatch):
     async def mock_create_client(*args, **kwargs):
@@ -216,3 +218,248 @@ async def test_compute_embedding_autherror(monkeypatch, capsys):
         )
         monkeypatch.setattr(embeddings, "create_client", create_auth_error_limit_client)
         await embeddings.create_embeddings(texts=["foo"])
+
+
+class DelayedMockEmbeddingsClient:
+    """Returns one embedding per input, answering later batches faster than earlier ones"""
+
+    def __init__(self):
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def create(self, *args, **kwargs) -> openai.types.CreateEmbeddingResponse:
+        inputs = kwargs["input"] if isinstance(kwargs["input"], list) else [kwargs["input"]]
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.05 / self.calls)
+        self.in_flight -= 1
+        return openai.types.CreateEmbeddingResponse(
+            object="list",
+            data=[
+                openai.types.Embedding(embedding=[float(text)], index=index, object="embedding")
+                for index, text in enumerate(inputs)
+            ],
+            model=MOCK_EMBEDDING_MODEL_NAME,
+            usage=Usage(prompt_tokens=8, total_tokens=8),
+        )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("disable_batch", [False, True])
+async def test_compute_embedding_concurrent_keeps_order(monkeypatch, disable_batch):
+    embeddings_client = DelayedMockEmbeddingsClient()
+    created_clients = []
+
+    async def mock_create_client(*args, **kwargs):
+        created_clients.append(True)
+        return MockClient(embeddings_client=embeddings_client)
+
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name=MOCK_EMBEDDING_MODEL_NAME,
+        open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        credential=MockAzureCredential(),
+        disable_batch=disable_batch,
+        max_concurrency=3,
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    monkeypatch.setattr(embeddings, "calculate_token_length", lambda text: 1)
+
+    texts = [str(i) for i in range(40)]
+    assert await embeddings.create_embeddings(texts=texts) == [[float(i)] for i in range(40)]
+    assert await embeddings.create_embeddings(texts=texts[:2]) == [[0.0], [1.0]]
+    assert len(created_clients) == 1, "The client should be created once and reused"
+    assert embeddings_client.max_in_flight == 3
+
+
+class LimitedBatchMockEmbeddingsClient(DelayedMockEmbeddingsClient):
+    """Rejects batches with more inputs than the deployment accepts, like the service does"""
+
+    def __init__(self, max_inputs: int):
+        super().__init__()
+        self.max_inputs = max_inputs
+        self.batch_sizes: list[int] = []
+
+    async def create(self, *args, **kwargs) -> openai.types.CreateEmbeddingResponse:
+        if isinstance(kwargs["input"], list) and len(kwargs["input"]) > self.max_inputs:
+            raise openai.BadRequestError(message="Too many inputs", response=fake_response(400), body=None)
+        self.batch_sizes.append(len(kwargs["input"]))
+        return await super().create(*args, **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_batch_size_discovery(monkeypatch, caplog):
+    embeddings_client = LimitedBatchMockEmbeddingsClient(max_inputs=5)
+
+    async def mock_create_client(*args, **kwargs):
+        return MockClient(embeddings_client=embeddings_client)
+
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name=MOCK_EMBEDDING_MODEL_NAME,
+        open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        credential=MockAzureCredential(),
+        batch_max_size=64,
+        batch_token_limit=100000,
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    monkeypatch.setattr(embeddings, "calculate_token_length", lambda text: 1)
+
+    texts = [str(i) for i in range(50)]
+    with caplog.at_level(logging.WARNING):
+        assert await embeddings.create_embeddings(texts=texts) == [[float(i)] for i in range(50)]
+    assert embeddings.batch_max_size == 3
+    assert "reducing max batch size from 64 to 25" in caplog.text
+    assert max(embeddings_client.batch_sizes) <= 5
+
+    # The discovered limit is used for later calls without being rejected again
+    embeddings_client.batch_sizes.clear()
+    assert await embeddings.create_embeddings(texts=texts[:8]) == [[float(i)] for i in range(8)]
+    assert embeddings_client.batch_sizes == [3, 3, 2]
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_batch_other_bad_request(monkeypatch):
+    embeddings_client = LimitedBatchMockEmbeddingsClient(max_inputs=100)
+
+    async def mock_create(*args, **kwargs):
+        embeddings_client.batch_sizes.append(len(kwargs["input"]))
+        raise openai.BadRequestError(
+            message="The input was filtered", response=fake_response(400), body={"code": "content_filter"}
+        )
+
+    monkeypatch.setattr(embeddings_client, "create", mock_create)
+
+    async def mock_create_client(*args, **kwargs):
+        return MockClient(embeddings_client=embeddings_client)
+
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name=MOCK_EMBEDDING_MODEL_NAME,
+        open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        credential=MockAzureCredential(),
+        batch_max_size=64,
+        batch_token_limit=100000,
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    monkeypatch.setattr(embeddings, "calculate_token_length", lambda text: 1)
+
+    # Errors that aren't about the size of the batch are raised as is, without retrying smaller batches
+    with pytest.raises(openai.BadRequestError, match="The input was filtered"):
+        await embeddings.create_embeddings(texts=[str(i) for i in range(10)])
+    assert embeddings_client.batch_sizes == [10]
+    assert embeddings.batch_max_size == 64
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_batch_custom_model(monkeypatch):
+    embeddings_client = LimitedBatchMockEmbeddingsClient(max_inputs=100)
+
+    async def mock_create_client(*args, **kwargs):
+        return MockClient(embeddings_client=embeddings_client)
+
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name="my-local-embedding-model",
+        open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        credential=MockAzureCredential(),
+    )
+    assert not embeddings.supports_batch()
+
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name="my-local-embedding-model",
+        open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        credential=MockAzureCredential(),
+        batch_max_size=10,
+    )
+    assert embeddings.supports_batch()
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    monkeypatch.setattr(embeddings, "calculate_token_length", lambda text: 1)
+    assert await embeddings.create_embeddings(texts=[str(i) for i in range(25)]) == [[float(i)] for i in range(25)]
+    assert embeddings_client.batch_sizes == [10, 10, 5]
+
+
+@pytest.mark.asyncio
+async def test_image_embeddings_concurrent_with_retries(monkeypatch, tmp_path):
+    requested_urls = []
+    in_flight = 0
+    max_in_flight = 0
+
+    def mock_post(self, *args, **kwargs):
+        url = kwargs["json"]["url"]
+        requested_urls.append(url)
+
+        class DelayedResponse(MockResponse):
+            async def __aenter__(self):
+                nonlocal in_flight, max_in_flight
+                in_flight += 1
+                max_in_flight = max(max_in_flight, in_flight)
+                await asyncio.sleep(0.01)
+                in_flight -= 1
+                return self
+
+        # The first request for page 2 is throttled, and the service asks us to retry right away
+        if url == "https://test/page-2.png" and requested_urls.count(url) == 1:
+            return DelayedResponse(status=429, headers={"retry-after-ms": "10"})
+        return DelayedResponse(status=200, text=json.dumps({"vector": [float(url[-5])]}))
+
+    async def mock_token_provider():
+        return "token"
+
+    monkeypatch.setattr(aiohttp.ClientSession, "post", mock_post)
+    embedding_cache = EmbeddingCache(str(tmp_path / "embeddings.sqlite"))
+    image_embeddings = ImageEmbeddings(
+        endpoint="https://vision.test",
+        token_provider=mock_token_provider,
+        max_concurrency=2,
+        embedding_cache=embedding_cache,
+    )
+
+    urls = [f"https://test/page-{i}.png" for i in range(1, 6)]
+    hashes = [f"hash-{i}" for i in range(1, 6)]
+    assert await image_embeddings.create_embeddings(urls, image_hashes=hashes) == [[1.0], [2.0], [3.0], [4.0], [5.0]]
+    assert requested_urls.count("https://test/page-2.png") == 2
+    assert max_in_flight == 2
+
+    # Unchanged page images are found in the cache, so only the changed page is vectorized again
+    requested_urls.clear()
+    hashes[2] = "changed"
+    assert await image_embeddings.create_embeddings(urls, image_hashes=hashes) == [[1.0], [2.0], [3.0], [4.0], [5.0]]
+    assert requested_urls == ["https://test/page-3.png"]
+
+
+@pytest.mark.asyncio
+async def test_image_embeddings_client_error(monkeypatch):
+    requests = []
+
+    def mock_post(self, *args, **kwargs):
+        requests.append(kwargs)
+        return MockResponse(status=400, text="Invalid image URL")
+
+    async def mock_token_provider():
+        return "token"
+
+    monkeypatch.setattr(aiohttp.ClientSession, "post", mock_post)
+    image_embeddings = ImageEmbeddings(endpoint="https://vision.test", token_provider=mock_token_provider)
+    with pytest.raises(ValueError, match="Invalid image URL"):
+        await image_embeddings.create_embeddings(["https://test/page-1.png"])
+    assert len(requests) == 1, "Client errors should not be retried"
+
+
+@pytest.mark.asyncio
+async def test_compute_embedding_reads_rate_limit_headers(monkeypatch):
+    embeddings_client = DelayedMockEmbeddingsClient()
+    embeddings_client.headers = {"x-ratelimit-remaining-tokens": "1000"}
+
+    async def mock_create_client(*args, **kwargs):
+        return MockClient(embeddings_client=embeddings_client)
+
+    embeddings = OpenAIEmbeddingService(
+        open_ai_model_name=MOCK_EMBEDDING_MODEL_NAME,
+        open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        credential=MockAzureCredential(),
+        disable_batch=False,
+    )
+    monkeypatch.setattr(embeddings, "create_client", mock_create_client)
+    received_headers = []
+    monkeypatch.setattr(embeddings.rate_limiter, "on_success", received_headers.append)
+    assert await embeddings.create_embeddings(texts=["1"]) == [[1.0]]
+    assert received_headers == [{"x-ratelimit-remaining-tokens": "1000"}]
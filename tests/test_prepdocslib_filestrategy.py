@@ -1,3 +1,5 @@
+import asyncio
+import io
 import os
 
 import pytest
@@ -5,15 +7,19 @@ from azure.search.documents.aio import SearchClient
 
 from prepdocslib.blobmanager import BlobManager
 from prepdocslib.fileprocessor import FileProcessor
-from prepdocslib.filestrategy import FileStrategy
+from prepdocslib.filestrategy import FileStrategy, UploadUserFileStrategy
+from prepdocslib.ingestionmanifest import IngestionManifest
 from prepdocslib.listfilestrategy import (
     ADLSGen2ListFileStrategy,
+    File,
+    LocalListFileStrategy,
 )
 from prepdocslib.strategy import SearchInfo
 from prepdocslib.textparser import TextParser
 from prepdocslib.textsplitter import SimpleTextSplitter
+from prepdocslib.uploadqueue import IndexedFileHashes, SharedFileLocks, UploadJobStore
 
-from .mocks import MockAzureCredential
+from .mocks import MockAsyncPageIterator, MockAzureCredential, mock_indexing_results
 
 
 @pytest.mark.asyncio
@@ -50,12 +56,17 @@ async def test_file_strategy_adls2(monkeypatch, mock_env, mock_data_lake_service
         index_name="test",
     )
 
+    async def mock_search(self, *args, **kwargs):
+        return MockAsyncPageIterator([])
+
     uploaded_to_search = []
 
     async def mock_upload_documents(self, documents):
         uploaded_to_search.extend(documents)
+        return mock_indexing_results(documents)
 
-    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    monkeypatch.setattr(SearchClient, "merge_or_upload_documents", mock_upload_documents)
 
     file_strategy = FileStrategy(
         list_file_strategy=adlsgen2_list_strategy,
@@ -71,7 +82,7 @@ async def test_file_strategy_adls2(monkeypatch, mock_env, mock_data_lake_service
     assert len(uploaded_to_search) == 3
     assert uploaded_to_search == [
         {
-            "id": "file-a_txt-612E7478747B276F696473273A205B27412D555345522D4944275D2C202767726F757073273A205B27412D47524F55502D4944275D7D-page-0",
+            "id": "file-a_txt-612E7478747B276F696473273A205B27412D555345522D4944275D2C202767726F757073273A205B27412D47524F55502D4944275D7D-f5c9fced6b8a1769b02d87c5ef6d4fe7",
             "content": "texttext",
             "category": None,
             "groups": ["A-GROUP-ID"],
@@ -81,7 +92,7 @@ async def test_file_strategy_adls2(monkeypatch, mock_env, mock_data_lake_service
             "storageUrl": "https://test.blob.core.windows.net/a.txt",
         },
         {
-            "id": "file-b_txt-622E7478747B276F696473273A205B27422D555345522D4944275D2C202767726F757073273A205B27422D47524F55502D4944275D7D-page-0",
+            "id": "file-b_txt-622E7478747B276F696473273A205B27422D555345522D4944275D2C202767726F757073273A205B27422D47524F55502D4944275D7D-6dda65bd6770bd0481bafeaf6b16bb0b",
             "content": "texttext",
             "category": None,
             "groups": ["B-GROUP-ID"],
@@ -91,7 +102,7 @@ async def test_file_strategy_adls2(monkeypatch, mock_env, mock_data_lake_service
             "storageUrl": "https://test.blob.core.windows.net/b.txt",
         },
         {
-            "id": "file-c_txt-632E7478747B276F696473273A205B27432D555345522D4944275D2C202767726F757073273A205B27432D47524F55502D4944275D7D-page-0",
+            "id": "file-c_txt-632E7478747B276F696473273A205B27432D555345522D4944275D2C202767726F757073273A205B27432D47524F55502D4944275D7D-2287c85d28f97abfcf7b0aaef7c5e69e",
             "content": "texttext",
             "category": None,
             "groups": ["C-GROUP-ID"],
@@ -101,3 +112,182 @@ async def test_file_strategy_adls2(monkeypatch, mock_env, mock_data_lake_service
             "storageUrl": "https://test.blob.core.windows.net/c.txt",
         },
     ]
+
+
+@pytest.mark.asyncio
+async def test_file_strategy_local_manifest(monkeypatch, tmp_path):
+    (tmp_path / "a.txt").write_text("text a")
+    (tmp_path / "b.txt").write_text("text b")
+    manifest = IngestionManifest(str(tmp_path / "manifest" / "manifest.sqlite"))
+
+    async def mock_upload_blob(self, file):
+        return None
+
+    removed_blobs = []
+
+    async def mock_remove_blob(self, path=None):
+        removed_blobs.append(path)
+
+    monkeypatch.setattr(BlobManager, "upload_blob", mock_upload_blob)
+    monkeypatch.setattr(BlobManager, "remove_blob", mock_remove_blob)
+
+    async def mock_search(self, *args, **kwargs):
+        return MockAsyncPageIterator([])
+
+    uploaded_to_search = []
+
+    async def mock_upload_documents(self, documents):
+        uploaded_to_search.extend(documents)
+        return mock_indexing_results(documents)
+
+    removed_from_search = []
+
+    async def mock_delete_documents(self, documents):
+        removed_from_search.extend(document["id"] for document in documents)
+        return mock_indexing_results(documents)
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    monkeypatch.setattr(SearchClient, "merge_or_upload_documents", mock_upload_documents)
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    def create_file_strategy(path_pattern=f"{tmp_path}/*.txt"):
+        return FileStrategy(
+            list_file_strategy=LocalListFileStrategy(path_pattern=path_pattern, manifest=manifest),
+            blob_manager=BlobManager(
+                endpoint="https://test.blob.core.windows.net",
+                credential=MockAzureCredential(),
+                container="test",
+                account="test",
+                resourceGroup="test",
+                subscriptionId="test",
+            ),
+            search_info=SearchInfo(
+                endpoint="https://testsearchclient.blob.core.windows.net",
+                credential=MockAzureCredential(),
+                index_name="test",
+            ),
+            file_processors={".txt": FileProcessor(TextParser(), SimpleTextSplitter())},
+        )
+
+    await create_file_strategy().run()
+    assert sorted(document["sourcefile"] for document in uploaded_to_search) == ["a.txt", "b.txt"]
+    entry = manifest.get(str(tmp_path / "a.txt"))
+    assert entry is not None
+    assert entry.chunk_count == 1
+    assert entry.document_ids == [
+        document["id"] for document in uploaded_to_search if document["sourcefile"] == "a.txt"
+    ]
+
+    b_ids = manifest.get(str(tmp_path / "b.txt")).document_ids
+
+    uploaded_to_search.clear()
+    os.remove(tmp_path / "b.txt")
+    await create_file_strategy().run()
+    assert uploaded_to_search == []
+    # The documents recorded for the removed file are deleted by id
+    assert removed_from_search == b_ids
+    assert removed_blobs == [str(tmp_path / "b.txt")]
+    assert manifest.paths() == [str(tmp_path / "a.txt")]
+
+    # Files with the same name in different directories share their blobs, and can share document ids
+    for directory in ("x", "y"):
+        (tmp_path / "same" / directory).mkdir(parents=True)
+        (tmp_path / "same" / directory / "c.txt").write_text("same text")
+    await create_file_strategy(f"{tmp_path}/same/*").run()
+    x_path, y_path = str(tmp_path / "same" / "x" / "c.txt"), str(tmp_path / "same" / "y" / "c.txt")
+    assert manifest.get(x_path).document_ids == manifest.get(y_path).document_ids
+    removed_from_search.clear()
+    removed_blobs.clear()
+    os.remove(x_path)
+    await create_file_strategy(f"{tmp_path}/same/*").run()
+    # Removing one of them keeps the documents and blobs of the other one
+    assert removed_from_search == []
+    assert removed_blobs == []
+    assert y_path in manifest.paths() and x_path not in manifest.paths()
+    y_ids = manifest.get(y_path).document_ids
+    os.remove(y_path)
+    await create_file_strategy(f"{tmp_path}/same/*").run()
+    assert removed_from_search == y_ids
+    assert removed_blobs == [y_path]
+
+
+@pytest.mark.asyncio
+async def test_upload_user_file_strategy_single_flight_and_dedup(monkeypatch, tmp_path):
+    index = {}
+
+    async def mock_search(self, *args, **kwargs):
+        return MockAsyncPageIterator([dict(document) for document in index.values()])
+
+    async def mock_upload_documents(self, documents):
+        index.update({document["id"]: document for document in documents})
+        return mock_indexing_results(documents)
+
+    async def mock_delete_documents(self, documents):
+        for document in documents:
+            index.pop(document["id"], None)
+        return mock_indexing_results(documents)
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    monkeypatch.setattr(SearchClient, "merge_or_upload_documents", mock_upload_documents)
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    parsed = []
+
+    class CountingParser(TextParser):
+        async def parse(self, content):
+            parsed.append(content.name)
+            # Gives concurrent uploads of the same file the chance to overlap
+            await asyncio.sleep(0.01)
+            async for page in super().parse(content):
+                yield page
+
+    def create_strategy(**kwargs):
+        return UploadUserFileStrategy(
+            search_info=SearchInfo(
+                endpoint="https://testsearchclient.blob.core.windows.net",
+                credential=MockAzureCredential(),
+                index_name="test",
+            ),
+            file_processors={".txt": FileProcessor(CountingParser(), SimpleTextSplitter())},
+            **kwargs,
+        )
+
+    strategy = create_strategy()
+
+    def upload(content, oid="OID_X"):
+        stream = io.BytesIO(content)
+        stream.name = "a.txt"
+        return File(content=stream, acls={"oids": [oid]})
+
+    # Repeated uploads of the same file are ingested one at a time, and the same content is only parsed once
+    assert await asyncio.gather(*(strategy.add_file(upload(b"text a")) for _ in range(3))) == [True, False, False]
+    assert parsed == ["a.txt"]
+    assert strategy.file_locks == {}
+    assert await strategy.add_file(upload(b"text b")) is True
+    assert await strategy.add_file(upload(b"text b", oid="OID_Y")) is True
+    assert len(parsed) == 3
+    assert sorted(document["content"] for document in index.values()) == ["text b", "text b"]
+
+    # Content that is no longer in the index is ingested again
+    await strategy.remove_file("a.txt", "OID_X")
+    assert [document["oids"] for document in index.values()] == [["OID_Y"]]
+    assert ("OID_X", "a.txt") not in strategy.indexed_hashes
+    assert await strategy.add_file(upload(b"text b")) is True
+    index.clear()
+    assert await strategy.add_file(upload(b"text b")) is True
+    assert len(parsed) == 5
+
+    # Worker processes that share a job store also add the same file one at a time
+    path = str(tmp_path / "jobs.sqlite")
+    stores = [UploadJobStore(path), UploadJobStore(path)]
+    strategies = [
+        create_strategy(indexed_hashes=IndexedFileHashes(store), shared_lock=SharedFileLocks(store, 0.01).lock)
+        for store in stores
+    ]
+    assert sorted(await asyncio.gather(*(strategy.add_file(upload(b"text c")) for strategy in strategies))) == [
+        False,
+        True,
+    ]
+    assert len(parsed) == 6
+    for store in stores:
+        store.close()
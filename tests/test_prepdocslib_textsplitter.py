@@ -1,3 +1,4 @@
+import io
 import json
 import shutil
 from pathlib import Path
@@ -5,12 +6,14 @@ from pathlib import Path
 import pytest
 import tiktoken
 
+from prepdocslib.csvparser import ROW_SEPARATOR, CsvParser
 from prepdocslib.listfilestrategy import LocalListFileStrategy
 from prepdocslib.page import Page
 from prepdocslib.pdfparser import LocalPdfParser
 from prepdocslib.searchmanager import Section
 from prepdocslib.textsplitter import (
     ENCODING_MODEL,
+    RowTextSplitter,
     SentenceTextSplitter,
     SimpleTextSplitter,
 )
@@ -73,6 +76,43 @@ def test_simpletextsplitter_split_small_pages():
     assert split_pages[0].text == '{"test": "Not a large page"}'
 
 
+def test_rowtextsplitter_split_pages():
+    t = RowTextSplitter(max_section_length=25)
+    pages = [
+        Page(page_num=0, offset=0, text=ROW_SEPARATOR.join(["row 1,a", "row 2,b", "row 3,c"])),
+        Page(page_num=1, offset=24, text=ROW_SEPARATOR.join(["row 4,d", "", "row 5,e"])),
+    ]
+
+    split_pages = list(t.split_pages(pages))
+    # Sections only contain whole rows, and never go beyond the maximum length
+    assert [split_page.text for split_page in split_pages] == ["row 1,a\nrow 2,b\nrow 3,c", "row 4,d\nrow 5,e"]
+    assert [split_page.page_num for split_page in split_pages] == [0, 1]
+
+    # Rows that are too long on their own are split by tokens
+    t = RowTextSplitter(max_tokens_per_section=10)
+    long_row = ",".join(f"value {i}" for i in range(20))
+    split_pages = list(
+        t.split_pages([Page(page_num=0, offset=0, text=ROW_SEPARATOR.join(["short,row", long_row, "last,row"]))])
+    )
+    assert split_pages[0].text == "short,row"
+    assert split_pages[-1].text == "last,row"
+    assert len(split_pages) > 3
+    bpe = tiktoken.encoding_for_model(ENCODING_MODEL)
+    assert all(len(bpe.encode(split_page.text)) <= 10 for split_page in split_pages)
+
+
+@pytest.mark.asyncio
+async def test_rowtextsplitter_multiline_cells():
+    file = io.BytesIO(b'name,notes\nrow 1,"first line\nsecond line"\nrow 2,b\nrow 3,c\n')
+    file.name = "test.csv"
+    pages = [page async for page in CsvParser(max_rows_per_page=1000).parse(file)]
+
+    # A quoted cell with a newline is part of one row, so it never ends up split across sections
+    t = RowTextSplitter(max_section_length=30)
+    split_pages = list(t.split_pages(pages))
+    assert [split_page.text for split_page in split_pages] == ["row 1,first line\nsecond line", "row 2,b\nrow 3,c"]
+
+
 def test_sentencetextsplitter_split_pages():
     max_object_length = 10
     t = SimpleTextSplitter(max_object_length=max_object_length)
@@ -0,0 +1,70 @@
+import asyncio
+
+import pytest
+
+from prepdocslib.ratelimiter import AdaptiveRateLimiter, TokenBucket, parse_retry_after
+
+
+def test_parse_retry_after():
+    assert parse_retry_after(None) is None
+    assert parse_retry_after({}) is None
+    assert parse_retry_after({"retry-after": "3"}) == 3
+    assert parse_retry_after({"retry-after-ms": "1500", "retry-after": "2"}) == 1.5
+    assert parse_retry_after({"retry-after": "Wed, 21 Oct 2015 07:28:00 GMT"}) is None
+
+
+def test_token_bucket_delay():
+    bucket = TokenBucket(per_minute=600)
+    assert bucket.delay_for(600) == 0
+    bucket.consume(600)
+    # 600 per minute refills 10 per second
+    assert bucket.delay_for(10) == pytest.approx(1, abs=0.05)
+    # A request larger than the bucket only waits for a full bucket
+    assert bucket.delay_for(10000) == pytest.approx(60, abs=0.1)
+    bucket.sync(remaining=-5)
+    assert bucket.level < 0
+
+
+def test_aimd_concurrency():
+    limiter = AdaptiveRateLimiter(max_concurrency=8)
+    limiter.on_rate_limited()
+    assert limiter.concurrency == 4
+    limiter.on_rate_limited()
+    limiter.on_rate_limited()
+    limiter.on_rate_limited()
+    assert limiter.concurrency == 1
+    for _ in range(10):
+        limiter.on_success()
+    assert 4 < limiter.concurrency < 5
+    limiter.on_success({"x-ratelimit-remaining-tokens": "0"})
+    assert limiter.concurrency < 2.5
+    for _ in range(100):
+        limiter.on_success({"x-ratelimit-remaining-tokens": "1000"})
+    assert limiter.concurrency == 8
+
+
+def test_rate_limited_pauses_with_retry_after():
+    limiter = AdaptiveRateLimiter(max_concurrency=2, tokens_per_minute=1000)
+    limiter.on_rate_limited({"retry-after": "5", "x-ratelimit-remaining-tokens": "0"})
+    assert limiter.quota_delay(tokens=1) == pytest.approx(5, abs=0.1)
+    assert limiter.token_bucket is not None
+    assert limiter.token_bucket.level < 1
+
+
+@pytest.mark.asyncio
+async def test_limit_caps_in_flight_requests():
+    limiter = AdaptiveRateLimiter(max_concurrency=2)
+    in_flight = 0
+    max_in_flight = 0
+
+    async def request():
+        nonlocal in_flight, max_in_flight
+        async with limiter.limit():
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+
+    await asyncio.gather(*(request() for _ in range(10)))
+    assert max_in_flight == 2
+    assert limiter.in_flight == 0
@@ -4,6 +4,7 @@ import openai
 import openai.types
 import pytest
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.indexes.aio import SearchIndexClient
 from azure.search.documents.indexes.models import (
@@ -13,6 +14,7 @@ from azure.search.documents.indexes.models import (
 )
 from openai.types.create_embedding_response import Usage
 
+from prepdocslib.embeddingcache import EmbeddingCache
 from prepdocslib.embeddings import AzureOpenAIEmbeddingService
 from prepdocslib.listfilestrategy import File
 from prepdocslib.searchmanager import SearchManager, Section
@@ -24,6 +26,7 @@ from .mocks import (
     MOCK_EMBEDDING_MODEL_NAME,
     MockClient,
     MockEmbeddingsClient,
+    mock_indexing_results,
 )
 
 
@@ -172,17 +175,39 @@ async def test_create_index_acls(monkeypatch, search_info):
     assert len(indexes[0].fields) == 9
 
 
+class AsyncSearchResultsIterator:
+    def __init__(self, results):
+        self.results = results
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if len(self.results) == 0:
+            raise StopAsyncIteration
+        return self.results.pop()
+
+    async def get_count(self):
+        return len(self.results)
+
+
+async def mock_search_empty(self, *args, **kwargs):
+    return AsyncSearchResultsIterator([])
+
+
 @pytest.mark.asyncio
 async def test_update_content(monkeypatch, search_info):
     async def mock_upload_documents(self, documents):
         assert len(documents) == 1
-        assert documents[0]["id"] == "file-foo_pdf-666F6F2E706466-page-0"
+        assert documents[0]["id"].startswith("file-foo_pdf-666F6F2E706466-")
         assert documents[0]["content"] == "test content"
         assert documents[0]["category"] == "test"
         assert documents[0]["sourcepage"] == "foo.pdf#page=1"
         assert documents[0]["sourcefile"] == "foo.pdf"
+        return mock_indexing_results(documents)
 
-    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+    monkeypatch.setattr(SearchClient, "search", mock_search_empty)
+    monkeypatch.setattr(SearchClient, "merge_or_upload_documents", mock_upload_documents)
 
     manager = SearchManager(search_info)
 
@@ -210,8 +235,10 @@ async def test_update_content_many(monkeypatch, search_info):
 
     async def mock_upload_documents(self, documents):
         ids.extend([doc["id"] for doc in documents])
+        return mock_indexing_results(documents)
 
-    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+    monkeypatch.setattr(SearchClient, "search", mock_search_empty)
+    monkeypatch.setattr(SearchClient, "merge_or_upload_documents", mock_upload_documents)
 
     manager = SearchManager(search_info)
 
@@ -268,8 +295,10 @@ async def test_update_content_with_embeddings(monkeypatch, search_info):
 
     async def mock_upload_documents(self, documents):
         documents_uploaded.extend(documents)
+        return mock_indexing_results(documents)
 
-    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+    monkeypatch.setattr(SearchClient, "search", mock_search_empty)
+    monkeypatch.setattr(SearchClient, "merge_or_upload_documents", mock_upload_documents)
     embeddings = AzureOpenAIEmbeddingService(
         open_ai_service="x",
         open_ai_deployment="x",
@@ -310,20 +339,120 @@ async def test_update_content_with_embeddings(monkeypatch, search_info):
     ]
 
 
-class AsyncSearchResultsIterator:
-    def __init__(self, results):
-        self.results = results
+@pytest.mark.asyncio
+async def test_update_content_with_embedding_cache(monkeypatch, search_info, tmp_path):
+    embedded_texts = []
 
-    def __aiter__(self):
-        return self
+    async def mock_create_embeddings(self, texts):
+        embedded_texts.extend(texts)
+        return [[float(len(text)), 0.5, -0.25] for text in texts]
 
-    async def __anext__(self):
-        if len(self.results) == 0:
-            raise StopAsyncIteration
-        return self.results.pop()
+    documents_uploaded = []
 
-    async def get_count(self):
-        return len(self.results)
+    async def mock_upload_documents(self, documents):
+        documents_uploaded.extend(documents)
+        return mock_indexing_results(documents)
+
+    monkeypatch.setattr(SearchClient, "search", mock_search_empty)
+    monkeypatch.setattr(SearchClient, "merge_or_upload_documents", mock_upload_documents)
+    monkeypatch.setattr(AzureOpenAIEmbeddingService, "create_embeddings", mock_create_embeddings)
+    embeddings = AzureOpenAIEmbeddingService(
+        open_ai_service="x",
+        open_ai_deployment="x",
+        open_ai_model_name=MOCK_EMBEDDING_MODEL_NAME,
+        open_ai_dimensions=MOCK_EMBEDDING_DIMENSIONS,
+        open_ai_api_version="test-api-version",
+        credential=AzureKeyCredential("test"),
+    )
+    embedding_cache = EmbeddingCache(str(tmp_path / "embeddings.sqlite"))
+    manager = SearchManager(search_info, embeddings=embeddings, embedding_cache=embedding_cache)
+
+    test_io = io.BytesIO(b"test content")
+    test_io.name = "test/foo.pdf"
+    file = File(test_io)
+
+    def sections(texts):
+        return [Section(split_page=SplitPage(page_num=0, text=text), content=file) for text in texts]
+
+    await manager.update_content(sections(["first", "second", "first"]))
+    assert embedded_texts == ["first", "second"], "Identical sections should only be embedded once"
+    assert [document["embedding"] for document in documents_uploaded] == [
+        [5.0, 0.5, -0.25],
+        [6.0, 0.5, -0.25],
+        [5.0, 0.5, -0.25],
+    ]
+
+    # Re-ingesting an edited document only embeds the changed sections
+    embedded_texts.clear()
+    documents_uploaded.clear()
+    await manager.update_content(sections(["first", "changed"]))
+    assert embedded_texts == ["changed"]
+    assert [document["embedding"] for document in documents_uploaded] == [[5.0, 0.5, -0.25], [7.0, 0.5, -0.25]]
+    assert embedding_cache.hits == 1
+    assert embedding_cache.misses == 4
+
+
+@pytest.mark.asyncio
+async def test_update_content_diff(monkeypatch, search_info):
+    # A tiny in-memory index, keyed by document id
+    index = {
+        "file-foo_pdf-666F6F2E706466-page-0": {"id": "file-foo_pdf-666F6F2E706466-page-0", "sourcefile": "foo.pdf"},
+        "file-foo_pdf-666F6F2E706466ABCD-0": {"id": "file-foo_pdf-666F6F2E706466ABCD-0", "sourcefile": "foo.pdf"},
+    }
+    uploaded_ids = []
+    deleted_ids = []
+
+    async def mock_search(self, *args, **kwargs):
+        assert kwargs.get("filter") == "sourcefile eq 'foo.pdf'"
+        assert kwargs.get("select") == ["id"]
+        return AsyncSearchResultsIterator([{"id": document["id"]} for document in index.values()])
+
+    async def mock_merge_or_upload_documents(self, documents):
+        for document in documents:
+            index[document["id"]] = document
+            uploaded_ids.append(document["id"])
+        return mock_indexing_results(documents)
+        return mock_indexing_results(documents)
+
+    async def mock_delete_documents(self, documents):
+        for document in documents:
+            del index[document["id"]]
+            deleted_ids.append(document["id"])
+        return mock_indexing_results(documents)
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    monkeypatch.setattr(SearchClient, "merge_or_upload_documents", mock_merge_or_upload_documents)
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    manager = SearchManager(search_info)
+    test_io = io.BytesIO(b"test content")
+    test_io.name = "test/foo.pdf"
+    file = File(test_io)
+
+    def sections(texts):
+        return [Section(split_page=SplitPage(page_num=0, text=text), content=file) for text in texts]
+
+    first_ids = await manager.update_content(sections(["first", "second", "third", "third"]))
+    assert uploaded_ids == first_ids
+    assert len(set(first_ids)) == 4, "Repeated sections should get distinct ids"
+    # Sections indexed with positional ids are stale, but documents of another file with the same name are kept
+    assert deleted_ids == ["file-foo_pdf-666F6F2E706466-page-0"]
+    assert "file-foo_pdf-666F6F2E706466ABCD-0" in index
+
+    # Inserting a section at the start and dropping one only uploads and deletes those sections
+    uploaded_ids.clear()
+    deleted_ids.clear()
+    second_ids = await manager.update_content(sections(["inserted", "first", "third", "third"]))
+    assert second_ids[1:] == [first_ids[0], first_ids[2], first_ids[3]]
+    assert uploaded_ids == [second_ids[0]]
+    assert deleted_ids == [first_ids[1]]
+
+    # Re-ingesting an unchanged file doesn't touch the index
+    uploaded_ids.clear()
+    deleted_ids.clear()
+    assert await manager.update_content(sections(["inserted", "first", "third", "third"])) == second_ids
+    assert uploaded_ids == []
+    assert deleted_ids == []
 
 
 @pytest.mark.asyncio
@@ -354,7 +483,7 @@ async def test_remove_content(monkeypatch, search_info):
 
     async def mock_delete_documents(self, documents):
         deleted_documents.extend(documents)
-        return documents
+        return mock_indexing_results(documents)
 
     monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
 
@@ -362,7 +491,7 @@ async def test_remove_content(monkeypatch, search_info):
 
     await manager.remove_content("foo's bar.pdf")
 
-    assert len(searched_filters) == 2, "It should have searched twice (with no results on second try)"
+    assert len(searched_filters) == 1, "It should have searched once, as the first page wasn't full"
     assert searched_filters[0] == "sourcefile eq 'foo''s bar.pdf'"
     assert len(deleted_documents) == 1, "It should have deleted one document"
     assert deleted_documents[0]["id"] == "file-foo_pdf-666F6F2E706466-page-0"
@@ -382,7 +511,7 @@ async def test_remove_content_no_docs(monkeypatch, search_info):
 
     async def mock_delete_documents(self, documents):
         deleted_calls.append(documents)
-        return documents
+        return mock_indexing_results(documents)
 
     monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
 
@@ -439,14 +568,14 @@ async def test_remove_content_only_oid(monkeypatch, search_info):
 
     async def mock_delete_documents(self, documents):
         deleted_documents.extend(documents)
-        return documents
+        return mock_indexing_results(documents)
 
     monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
 
     manager = SearchManager(search_info)
     await manager.remove_content("foo.pdf", only_oid="A-USER-ID")
 
-    assert len(searched_filters) == 2, "It should have searched twice (with no results on second try)"
+    assert len(searched_filters) == 1, "It should have searched once, as the first page wasn't full"
     assert searched_filters[0] == "sourcefile eq 'foo.pdf'"
     assert len(deleted_documents) == 1, "It should have deleted one document"
     assert deleted_documents[0]["id"] == "file-foo_pdf-222"
@@ -480,7 +609,7 @@ async def test_remove_content_no_inf_loop(monkeypatch, search_info):
 
     async def mock_delete_documents(self, documents):
         deleted_documents.extend(documents)
-        return documents
+        return mock_indexing_results(documents)
 
     monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
 
@@ -490,3 +619,69 @@ async def test_remove_content_no_inf_loop(monkeypatch, search_info):
     assert len(searched_filters) == 1, "It should have searched once"
     assert searched_filters[0] == "sourcefile eq 'foo.pdf'"
     assert len(deleted_documents) == 0, "It should have deleted no documents"
+
+
+@pytest.mark.asyncio
+async def test_remove_content_pages_by_id(monkeypatch, search_info):
+    monkeypatch.setattr("prepdocslib.searchmanager.REMOVE_PAGE_SIZE", 2)
+    index = {f"doc-{i}": {"id": f"doc-{i}", "oids": ["A-USER-ID"] if i != 2 else ["B-USER-ID"]} for i in range(5)}
+    searches = []
+
+    async def mock_search(self, *args, **kwargs):
+        searches.append(kwargs)
+        documents = sorted(index.values(), key=lambda document: document["id"])
+        if "id gt 'doc-1'" in kwargs["filter"]:
+            documents = [document for document in documents if document["id"] > "doc-1"]
+        elif "id gt 'doc-3'" in kwargs["filter"]:
+            documents = [document for document in documents if document["id"] > "doc-3"]
+        return AsyncSearchResultsIterator(list(reversed(documents[: kwargs["top"]])))
+
+    deleted_ids = []
+
+    async def mock_delete_documents(self, documents):
+        deleted_ids.extend(document["id"] for document in documents)
+        return mock_indexing_results(documents)
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    manager = SearchManager(search_info)
+    await manager.remove_content("foo.pdf", only_oid="A-USER-ID")
+
+    assert [search["filter"] for search in searches] == [
+        "sourcefile eq 'foo.pdf'",
+        "(sourcefile eq 'foo.pdf') and id gt 'doc-1'",
+        "(sourcefile eq 'foo.pdf') and id gt 'doc-3'",
+    ]
+    assert all(search["select"] == ["id", "oids"] for search in searches)
+    assert all(search["order_by"] == ["id asc"] for search in searches)
+    assert sorted(deleted_ids) == ["doc-0", "doc-1", "doc-3", "doc-4"]
+
+
+@pytest.mark.asyncio
+async def test_remove_content_without_sortable_id(monkeypatch, search_info):
+    monkeypatch.setattr("prepdocslib.searchmanager.REMOVE_PAGE_SIZE", 2)
+    index = {f"doc-{i}": {"id": f"doc-{i}"} for i in range(3)}
+    searches = []
+
+    async def mock_search(self, *args, **kwargs):
+        searches.append(kwargs)
+        if "order_by" in kwargs:
+            raise HttpResponseError(message="The field 'id' is not sortable")
+        documents = sorted(index.values(), key=lambda document: document["id"])
+        return AsyncSearchResultsIterator(list(reversed(documents[kwargs["skip"] : kwargs["skip"] + kwargs["top"]])))
+
+    async def mock_delete_documents(self, documents):
+        for document in documents:
+            del index[document["id"]]
+        return mock_indexing_results(documents)
+
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+
+    manager = SearchManager(search_info)
+    await manager.remove_content()
+
+    assert index == {}
+    assert [search.get("skip") for search in searches] == [None, 0, 2]
+    assert all(search["select"] == ["id"] for search in searches)
@@ -0,0 +1,106 @@
+import hashlib
+import os
+
+import pytest
+
+from core import streamingupload
+from core.streamingupload import stream_multipart_upload
+
+BOUNDARY = b"boundary"
+
+
+def multipart_body(filename: str, content: bytes) -> bytes:
+    return (
+        b"--boundary\r\n"
+        b'Content-Disposition: form-data; name="other"\r\n\r\n'
+        b"value\r\n"
+        b"--boundary\r\n"
+        b'Content-Disposition: form-data; name="file"; filename="' + filename.encode() + b'"\r\n'
+        b"Content-Type: application/octet-stream\r\n\r\n" + content + b"\r\n--boundary--\r\n"
+    )
+
+
+async def chunks(body: bytes, size: int):
+    for start in range(0, len(body), size):
+        yield body[start : start + size]
+
+
+class RecordingFileClient:
+    def __init__(self, path):
+        self.path = path
+        self.url = f"https://test/{path}"
+        self.calls = []
+        self.data = b""
+
+    async def create_file(self, metadata=None):
+        self.calls.append(("create", metadata))
+
+    async def append_data(self, data, offset, length=None):
+        assert offset == len(self.data) and length == len(data)
+        self.calls.append(("append", offset, length))
+        self.data += data
+
+    async def flush_data(self, offset):
+        self.calls.append(("flush", offset))
+
+    async def delete_file(self):
+        self.calls.append(("delete",))
+
+
+@pytest.mark.asyncio
+async def test_stream_multipart_upload(monkeypatch):
+    monkeypatch.setattr(streamingupload, "UPLOAD_APPEND_SIZE", 100)
+    content = bytes(range(256)) * 2
+    clients = []
+
+    def get_file_client(path):
+        clients.append(RecordingFileClient(path))
+        return clients[-1]
+
+    upload = await stream_multipart_upload(
+        chunks(multipart_body("a.pdf", content), 7), BOUNDARY, "file", get_file_client, {"UploadedBy": "OID_X"}
+    )
+    try:
+        assert upload is not None
+        assert upload.filename == "a.pdf"
+        assert upload.url == "https://test/a.pdf"
+        assert upload.size == len(content)
+        assert upload.sha256 == hashlib.sha256(content).hexdigest()
+        assert os.path.basename(upload.local_path) == "a.pdf"
+        with open(upload.local_path, "rb") as file:
+            assert file.read() == content
+        [client] = clients
+        assert client.data == content
+        assert client.calls[0] == ("create", {"UploadedBy": "OID_X"})
+        assert client.calls[-1] == ("flush", len(content))
+        # Appends are buffered up to UPLOAD_APPEND_SIZE bytes, rather than sent for each chunk of the body
+        appends = [call for call in client.calls if call[0] == "append"]
+        assert all(length >= 100 for _, _, length in appends[:-1])
+        assert len(appends) < len(content) // 100 + 2
+    finally:
+        os.remove(upload.local_path)
+        os.rmdir(os.path.dirname(upload.local_path))
+
+
+@pytest.mark.asyncio
+async def test_stream_multipart_upload_without_file():
+    body = b'--boundary\r\nContent-Disposition: form-data; name="other"\r\n\r\nvalue\r\n--boundary--\r\n'
+    upload = await stream_multipart_upload(chunks(body, 10), BOUNDARY, "file", RecordingFileClient, {})
+    assert upload is None
+
+
+@pytest.mark.asyncio
+async def test_stream_multipart_upload_truncated(monkeypatch, tmp_path):
+    monkeypatch.setattr(streamingupload.tempfile, "tempdir", str(tmp_path))
+    clients = []
+
+    def get_file_client(path):
+        clients.append(RecordingFileClient(path))
+        return clients[-1]
+
+    body = multipart_body("a.txt", b"x" * 1000)[:-100]
+    with pytest.raises(ValueError):
+        await stream_multipart_upload(chunks(body, 64), BOUNDARY, "file", get_file_client, {})
+    # The partial file is deleted, in the storage account and locally
+    assert clients[0].calls[-1] == ("delete",)
+    assert list(tmp_path.iterdir()) == []
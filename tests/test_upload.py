@@ -13,9 +13,15 @@ from openai.types.create_embedding_response import (
 )
 from quart.datastructures import FileStorage
 
+import app
 from prepdocslib.embeddings import AzureOpenAIEmbeddingService
 
-from .mocks import MockClient, MockEmbeddingsClient
+from .mocks import (
+    MockAsyncPageIterator,
+    MockClient,
+    MockEmbeddingsClient,
+    mock_indexing_results,
+)
 
 
 # parameterize for directory existing or not
@@ -51,12 +57,23 @@ async def test_upload_file(auth_client, monkeypatch, mock_data_lake_service_clie
 
     monkeypatch.setattr(DataLakeDirectoryClient, "get_file_client", mock_directory_get_file_client)
 
-    async def mock_upload_file(self, *args, **kwargs):
-        assert kwargs.get("overwrite") is True
+    stored = {}
+
+    async def mock_create_file(self, *args, **kwargs):
         assert kwargs.get("metadata") == {"UploadedBy": "OID_X"}
-        return None
+        stored["data"] = b""
+
+    async def mock_append_data(self, data, offset, length=None, **kwargs):
+        assert offset == len(stored["data"])
+        stored["data"] += data
 
-    monkeypatch.setattr(DataLakeFileClient, "upload_data", mock_upload_file)
+    async def mock_flush_data(self, offset, **kwargs):
+        assert offset == len(stored["data"])
+        stored["flushed"] = offset
+
+    monkeypatch.setattr(DataLakeFileClient, "create_file", mock_create_file)
+    monkeypatch.setattr(DataLakeFileClient, "append_data", mock_append_data)
+    monkeypatch.setattr(DataLakeFileClient, "flush_data", mock_flush_data)
 
     async def mock_create_client(self, *args, **kwargs):
         # From https://platform.openai.com/docs/api-reference/embeddings/create
@@ -81,12 +98,17 @@ async def test_upload_file(auth_client, monkeypatch, mock_data_lake_service_clie
             )
         )
 
+    async def mock_search(self, *args, **kwargs):
+        return MockAsyncPageIterator([])
+
     documents_uploaded = []
 
     async def mock_upload_documents(self, documents):
         documents_uploaded.extend(documents)
+        return mock_indexing_results(documents)
 
-    monkeypatch.setattr(SearchClient, "upload_documents", mock_upload_documents)
+    monkeypatch.setattr(SearchClient, "search", mock_search)
+    monkeypatch.setattr(SearchClient, "merge_or_upload_documents", mock_upload_documents)
     monkeypatch.setattr(AzureOpenAIEmbeddingService, "create_client", mock_create_client)
 
     response = await auth_client.post(
@@ -94,11 +116,23 @@ async def test_upload_file(auth_client, monkeypatch, mock_data_lake_service_clie
         headers={"Authorization": "Bearer test"},
         files={"file": FileStorage(BytesIO(b"foo;bar"), filename="a.txt")},
     )
-    message = (await response.get_json())["message"]
-    assert message == "File uploaded successfully"
+    assert response.status_code == 202
+    response_json = await response.get_json()
+    assert response_json["status"] == "queued"
+    assert stored == {"data": b"foo;bar", "flushed": 7}
+    assert auth_client.config[app.CONFIG_UPLOAD_QUEUE].store.listing_version("OID_X") == 1
+    assert auth_client.config[app.CONFIG_UPLOAD_QUEUE].store.stored_bytes("OID_X") == 7
+    job_id = response_json["job_id"]
+
+    await auth_client.config[app.CONFIG_UPLOAD_QUEUE].join()
+    response = await auth_client.get(f"/upload/status/{job_id}", headers={"Authorization": "Bearer test"})
     assert response.status_code == 200
+    status = await response.get_json()
+    assert status["status"] == "succeeded"
+    assert status["filename"] == "a.txt"
+    assert status["error"] is None
     assert len(documents_uploaded) == 1
-    assert documents_uploaded[0]["id"] == "file-a_txt-612E7478747B276F696473273A205B274F49445F58275D7D-page-0"
+    assert documents_uploaded[0]["id"].startswith("file-a_txt-612E7478747B276F696473273A205B274F49445F58275D7D-")
     assert documents_uploaded[0]["sourcepage"] == "a.txt"
     assert documents_uploaded[0]["sourcefile"] == "a.txt"
     assert documents_uploaded[0]["embedding"] == [0.0023064255, -0.009327292, -0.0028842222]
@@ -114,6 +148,47 @@ async def test_list_uploaded(auth_client, monkeypatch, mock_data_lake_service_cl
     assert (await response.get_json()) == ["a.txt", "b.txt", "c.txt"]
 
 
+@pytest.mark.asyncio
+async def test_list_uploaded_cached_and_paged(auth_client, monkeypatch, mock_data_lake_service_client):
+    listings = []
+
+    def mock_get_paths(self, *args, **kwargs):
+        listings.append(kwargs)
+        paths = [azure.storage.filedatalake.PathProperties(name=f"OID_X/{name}") for name in ["c.txt", "a.txt"]]
+        paths.append(azure.storage.filedatalake.PathProperties(name="OID_X/sub", is_directory=True))
+        paths.append(azure.storage.filedatalake.PathProperties(name="OID_X/sub/b.txt"))
+        return MockAsyncPageIterator(paths)
+
+    monkeypatch.setattr(azure.storage.filedatalake.aio.FileSystemClient, "get_paths", mock_get_paths)
+
+    response = await auth_client.get("/list_uploaded", headers={"Authorization": "Bearer test"})
+    assert (await response.get_json()) == ["a.txt", "c.txt", "sub/b.txt"]
+    response = await auth_client.get("/list_uploaded?page_size=2", headers={"Authorization": "Bearer test"})
+    page = await response.get_json()
+    assert page["files"] == ["a.txt", "c.txt"]
+    # The listing is cached
+    assert listings == [{"path": "OID_X", "recursive": True}]
+    response = await auth_client.get(
+        f"/list_uploaded?page_size=2&continuation_token={page['continuation_token']}",
+        headers={"Authorization": "Bearer test"},
+    )
+    assert (await response.get_json()) == {"files": ["sub/b.txt"], "continuation_token": None}
+
+    response = await auth_client.get("/list_uploaded?recursive=false", headers={"Authorization": "Bearer test"})
+    assert listings[-1] == {"path": "OID_X", "recursive": False}
+    # Uploads and deletes invalidate the listing of their user
+    await auth_client.config[app.CONFIG_UPLOAD_LISTING_CACHE].invalidate("OID_X")
+    await auth_client.get("/list_uploaded", headers={"Authorization": "Bearer test"})
+    assert len(listings) == 3
+
+    response = await auth_client.get("/list_uploaded?page_size=0", headers={"Authorization": "Bearer test"})
+    assert response.status_code == 400
+    response = await auth_client.get(
+        "/list_uploaded?page_size=2&continuation_token=%25%25", headers={"Authorization": "Bearer test"}
+    )
+    assert response.status_code == 400
+
+
 @pytest.mark.asyncio
 async def test_list_uploaded_nopaths(auth_client, monkeypatch, mock_data_lake_service_client):
     class MockResponse:
@@ -219,15 +294,99 @@ async def test_delete_uploaded(auth_client, monkeypatch, mock_data_lake_service_
 
     async def mock_delete_documents(self, documents):
         deleted_documents.extend(documents)
-        return documents
+        return mock_indexing_results(documents)
 
     monkeypatch.setattr(SearchClient, "delete_documents", mock_delete_documents)
+    auth_client.config[app.CONFIG_UPLOAD_QUEUE].store.set_file_size("OID_X", "a's doc.txt", 7)
 
     response = await auth_client.post(
         "/delete_uploaded", headers={"Authorization": "Bearer test"}, json={"filename": "a's doc.txt"}
     )
     assert response.status_code == 200
-    assert len(searched_filters) == 2, "It should have searched twice (with no results on second try)"
+    assert auth_client.config[app.CONFIG_UPLOAD_QUEUE].store.listing_version("OID_X") == 1
+    # Deleted files no longer count towards the storage quota of the user
+    assert auth_client.config[app.CONFIG_UPLOAD_QUEUE].store.stored_bytes("OID_X") == 0
+    assert len(searched_filters) == 1, "It should have searched once, as the first page wasn't full"
     assert searched_filters[0] == "sourcefile eq 'a''s doc.txt'"
     assert len(deleted_documents) == 1, "It should have only deleted the document solely owned by OID_X"
     assert deleted_documents[0]["id"] == "file-a_txt-7465737420646F63756D656E742E706466"
+
+
+@pytest.mark.asyncio
+async def test_upload_file_missing(auth_client, monkeypatch, mock_data_lake_service_client):
+    async def mock_directory_call(self, *args, **kwargs):
+        return None
+
+    monkeypatch.setattr(DataLakeDirectoryClient, "get_directory_properties", mock_directory_call)
+    monkeypatch.setattr(DataLakeDirectoryClient, "set_access_control", mock_directory_call)
+
+    response = await auth_client.post(
+        "/upload",
+        headers={"Authorization": "Bearer test"},
+        form={"other": "value"},
+    )
+    assert response.status_code == 400
+    assert (await response.get_json())["message"] == "No file part in the request"
+
+
+@pytest.mark.asyncio
+async def test_upload_file_quotas(auth_client, monkeypatch, mock_data_lake_service_client):
+    async def mock_directory_call(self, *args, **kwargs):
+        return None
+
+    monkeypatch.setattr(DataLakeDirectoryClient, "get_directory_properties", mock_directory_call)
+    monkeypatch.setattr(DataLakeDirectoryClient, "set_access_control", mock_directory_call)
+
+    file_calls = []
+
+    async def mock_create_file(self, *args, **kwargs):
+        file_calls.append("create")
+
+    async def mock_delete_file(self, *args, **kwargs):
+        file_calls.append("delete")
+
+    monkeypatch.setattr(DataLakeFileClient, "create_file", mock_create_file)
+    monkeypatch.setattr(DataLakeFileClient, "delete_file", mock_delete_file)
+
+    # Files larger than the limit are rejected, and what was already stored is deleted
+    monkeypatch.setitem(auth_client.config, app.CONFIG_USER_UPLOAD_MAX_FILE_SIZE, 3)
+    response = await auth_client.post(
+        "/upload",
+        headers={"Authorization": "Bearer test"},
+        files={"file": FileStorage(BytesIO(b"foo;bar"), filename="a.txt")},
+    )
+    assert response.status_code == 413
+    assert file_calls == ["create", "delete"]
+
+    # Users can't upload more files while too many of their files are still being ingested
+    upload_queue = auth_client.config[app.CONFIG_UPLOAD_QUEUE]
+    monkeypatch.setattr(upload_queue, "max_jobs_per_user", 0)
+    response = await auth_client.post(
+        "/upload",
+        headers={"Authorization": "Bearer test"},
+        files={"file": FileStorage(BytesIO(b"foo;bar"), filename="a.txt")},
+    )
+    assert response.status_code == 429
+    assert file_calls == ["create", "delete"]
+
+    # Files that would take a user over their storage quota are rejected, as soon as the quota is used up
+    monkeypatch.setattr(upload_queue, "max_jobs_per_user", 5)
+    monkeypatch.setitem(auth_client.config, app.CONFIG_USER_UPLOAD_MAX_FILE_SIZE, 100)
+    monkeypatch.setattr(upload_queue, "max_bytes_per_user", 10)
+    upload_queue.store.set_file_size("OID_X", "b.txt", 5)
+    response = await auth_client.post(
+        "/upload",
+        headers={"Authorization": "Bearer test"},
+        files={"file": FileStorage(BytesIO(b"foo;bar"), filename="a.txt")},
+    )
+    assert response.status_code == 413
+    assert file_calls == ["create", "delete", "create", "delete"]
+    upload_queue.store.set_file_size("OID_X", "b.txt", 10)
+    response = await auth_client.post(
+        "/upload",
+        headers={"Authorization": "Bearer test"},
+        files={"file": FileStorage(BytesIO(b"foo;bar"), filename="a.txt")},
+    )
+    assert response.status_code == 413
+    assert (await response.get_json())["message"] == "The storage quota for uploaded files is used up"
+    assert file_calls == ["create", "delete", "create", "delete"]
@@ -0,0 +1,306 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from prepdocslib import uploadqueue
+from prepdocslib.uploadqueue import (
+    JOB_FAILED,
+    JOB_PROCESSING,
+    JOB_SUCCEEDED,
+    IndexedFileHashes,
+    SharedFileLocks,
+    UploadJobStore,
+    UploadQueue,
+)
+
+
+class RecordingIngester:
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.files = []
+
+    async def add_file(self, file):
+        if file.filename() == self.fail_on:
+            raise ValueError("Unable to parse the file")
+        self.files.append((file.filename(), file.content.read(), file.acls, file.url))
+
+
+class DownloadedFile:
+    def __init__(self, content):
+        self.content = content
+
+    async def readall(self):
+        return self.content
+
+
+class StoredFileClient:
+    def __init__(self, file_system, path):
+        self.file_system = file_system
+        self.path = path
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def download_file(self):
+        self.file_system.downloads.append(self.path)
+        return DownloadedFile(self.file_system.files[self.path])
+
+
+class StoredFileSystemClient:
+    def __init__(self, files):
+        self.files = files
+        self.downloads = []
+
+    def get_file_client(self, path):
+        return StoredFileClient(self, path)
+
+
+def local_copy(tmp_path, filename, content):
+    directory = tmp_path / f"upload-{filename}"
+    directory.mkdir()
+    path = directory / filename
+    path.write_bytes(content)
+    return str(path)
+
+
+@pytest.mark.asyncio
+async def test_upload_queue(tmp_path):
+    ingester = RecordingIngester(fail_on="bad.txt")
+    file_system = StoredFileSystemClient({"OID_X/remote.txt": b"remote content"})
+    queue = UploadQueue(ingester, file_system, UploadJobStore(str(tmp_path / "jobs.sqlite")), max_concurrency=2)
+    await queue.start()
+    try:
+        good_path = local_copy(tmp_path, "good.txt", b"good")
+        bad_path = local_copy(tmp_path, "bad.txt", b"bad")
+        good_id = await queue.enqueue("OID_X", "good.txt", "OID_X/good.txt", "https://test/good.txt", good_path)
+        bad_id = await queue.enqueue("OID_X", "bad.txt", "OID_X/bad.txt", "https://test/bad.txt", bad_path)
+        # Without a local copy, the file is downloaded when it is processed
+        remote_id = await queue.enqueue("OID_X", "remote.txt", "OID_X/remote.txt", "https://test/remote.txt", None)
+        await queue.join()
+
+        assert sorted(ingester.files) == [
+            ("good.txt", b"good", {"oids": ["OID_X"]}, "https://test/good.txt"),
+            ("remote.txt", b"remote content", {"oids": ["OID_X"]}, "https://test/remote.txt"),
+        ]
+        assert file_system.downloads == ["OID_X/remote.txt"]
+        # The local copies are removed once processed, with their directory
+        assert not os.path.exists(os.path.dirname(good_path))
+        assert not os.path.exists(os.path.dirname(bad_path))
+        assert queue.local_paths == {}
+        assert (await queue.status(good_id, "OID_X"))["status"] == JOB_SUCCEEDED
+        assert (await queue.status(remote_id, "OID_X"))["status"] == JOB_SUCCEEDED
+        bad_status = await queue.status(bad_id, "OID_X")
+        assert bad_status["status"] == JOB_FAILED
+        assert bad_status["error"] == "Unable to parse the file"
+        # Users can only see their own jobs
+        assert await queue.status(good_id, "OID_Y") is None
+        assert await queue.status("missing", "OID_X") is None
+    finally:
+        await queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_upload_queue_resumes_abandoned_jobs(tmp_path, monkeypatch):
+    path = str(tmp_path / "jobs.sqlite")
+    # A process stopped while processing a job, and another one is still processing its own job
+    store = UploadJobStore(path)
+    store.add("abandoned", "OID_X", "a.txt", "OID_X/a.txt", "https://test/a.txt", owner="stopped")
+    store.set_status("abandoned", JOB_PROCESSING)
+    store.add("running", "OID_X", "b.txt", "OID_X/b.txt", "https://test/b.txt", owner="running")
+    store.connection.execute("UPDATE jobs SET lease_until = ? WHERE id = 'abandoned'", (time.time() - 1,))
+    store.close()
+
+    ingester = RecordingIngester()
+    file_system = StoredFileSystemClient({"OID_X/a.txt": b"content of a"})
+    queue = UploadQueue(ingester, file_system, UploadJobStore(path))
+    await queue.start()
+    try:
+        await queue.join()
+        assert ingester.files == [("a.txt", b"content of a", {"oids": ["OID_X"]}, "https://test/a.txt")]
+        assert (await queue.status("abandoned", "OID_X"))["status"] == JOB_SUCCEEDED
+        assert (await queue.status("running", "OID_X"))["status"] == "queued"
+        assert queue.store.get("running")["owner"] == "running"
+    finally:
+        await queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_upload_queue_renews_leases(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploadqueue, "JOB_LEASE_SECONDS", 0.03)
+    started = asyncio.Event()
+    release = asyncio.Event()
+
+    class BlockingIngester:
+        async def add_file(self, file):
+            started.set()
+            await release.wait()
+
+    path = str(tmp_path / "jobs.sqlite")
+    queue = UploadQueue(BlockingIngester(), StoredFileSystemClient({}), UploadJobStore(path))
+    await queue.start()
+    other_ingester = RecordingIngester()
+    other_queue = UploadQueue(other_ingester, StoredFileSystemClient({}), UploadJobStore(path))
+    await other_queue.start()
+    try:
+        job_id = await queue.enqueue("OID_X", "a.txt", "OID_X/a.txt", None, local_copy(tmp_path, "a.txt", b"a"))
+        await started.wait()
+        # The lease is renewed while the job runs, so the other queue never takes it over
+        await asyncio.sleep(0.1)
+        assert other_ingester.files == []
+        assert queue.store.get(job_id)["owner"] == queue.owner
+        release.set()
+        await queue.join()
+        assert (await queue.status(job_id, "OID_X"))["status"] == JOB_SUCCEEDED
+    finally:
+        await queue.stop()
+        await other_queue.stop()
+
+
+@pytest.mark.asyncio
+async def test_upload_queue_coalesces_and_limits_jobs(tmp_path):
+    release = asyncio.Event()
+
+    class BlockingIngester(RecordingIngester):
+        async def add_file(self, file):
+            await release.wait()
+            await super().add_file(file)
+
+        async def remove_file(self, filename, oid):
+            self.removed = (filename, oid)
+
+    ingester = BlockingIngester()
+    # With one worker, the second file is still queued while the first one is ingested
+    queue = UploadQueue(
+        ingester,
+        StoredFileSystemClient({}),
+        UploadJobStore(str(tmp_path / "jobs.sqlite")),
+        max_concurrency=1,
+        max_jobs_per_user=2,
+    )
+    await queue.start()
+    try:
+        first_id = await queue.enqueue(
+            "OID_X", "a.txt", "OID_X/a.txt", None, local_copy(tmp_path, "a.txt", b"a"), "hash-a"
+        )
+        # Uploading the same content again while it is queued returns the same job, and drops the new copy
+        second_copy = local_copy(tmp_path, "a2.txt", b"a")
+        assert await queue.enqueue("OID_X", "a.txt", "OID_X/a.txt", None, second_copy, "hash-a") == first_id
+        assert not os.path.exists(second_copy)
+        assert await queue.has_capacity("OID_X")
+        other_id = await queue.enqueue(
+            "OID_X", "b.txt", "OID_X/b.txt", None, local_copy(tmp_path, "b.txt", b"b"), "hash-b"
+        )
+        assert not await queue.has_capacity("OID_X")
+        assert await queue.has_capacity("OID_Y")
+
+        # Deleting a file cancels its unfinished jobs
+        await queue.remove("OID_X", "b.txt")
+        assert ingester.removed == ("b.txt", "OID_X")
+        release.set()
+        await queue.join()
+        assert ingester.files == [("a.txt", b"a", {"oids": ["OID_X"]}, None)]
+        assert (await queue.status(first_id, "OID_X"))["status"] == JOB_SUCCEEDED
+        assert (await queue.status(other_id, "OID_X"))["status"] == JOB_FAILED
+        assert (await queue.status(other_id, "OID_X"))["error"] == "The file was deleted"
+        assert await queue.has_capacity("OID_X")
+    finally:
+        await queue.stop()
+
+
+def test_indexed_file_hashes(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    store = UploadJobStore(path)
+    hashes = IndexedFileHashes(store)
+    hashes[("OID_X", "a.txt")] = "hash-a"
+    hashes[("OID_X", "a.txt")] = "hash-b"
+    hashes[("OID_Y", "a.txt")] = "hash-c"
+    store.close()
+
+    store = UploadJobStore(path)
+    hashes = IndexedFileHashes(store)
+    assert dict(hashes) == {("OID_X", "a.txt"): "hash-b", ("OID_Y", "a.txt"): "hash-c"}
+    assert hashes.get(("OID_X", "b.txt")) is None
+    del hashes[("OID_X", "a.txt")]
+    assert hashes.pop(("OID_X", "a.txt"), None) is None
+    assert len(hashes) == 1
+    store.close()
+
+
+@pytest.mark.asyncio
+async def test_shared_file_locks(tmp_path, monkeypatch):
+    monkeypatch.setattr(uploadqueue, "JOB_LEASE_SECONDS", 0.03)
+    path = str(tmp_path / "jobs.sqlite")
+    # Each store stands for a worker process of the app
+    first_locks = SharedFileLocks(UploadJobStore(path), poll_interval=0.01)
+    second_locks = SharedFileLocks(UploadJobStore(path), poll_interval=0.01)
+    events = []
+
+    async def hold(locks, name, filename):
+        async with locks.lock("OID_X", filename):
+            events.append(f"{name} locked {filename}")
+            # Longer than the lease, which is renewed while the lock is held
+            await asyncio.sleep(0.1)
+            events.append(f"{name} unlocked {filename}")
+
+    first = asyncio.create_task(hold(first_locks, "first", "a.txt"))
+    await asyncio.sleep(0.01)
+    await asyncio.gather(hold(second_locks, "second", "a.txt"), hold(second_locks, "second", "b.txt"), first)
+    assert events.index("first unlocked a.txt") < events.index("second locked a.txt")
+    assert events.index("second locked b.txt") < events.index("first unlocked a.txt")
+
+    # The database is only used outside of the event loop thread
+    threads = set()
+    lock_file = second_locks.store.lock_file
+
+    def record_thread(*args):
+        threads.add(threading.current_thread())
+        return lock_file(*args)
+
+    monkeypatch.setattr(second_locks.store, "lock_file", record_thread)
+    async with second_locks.lock("OID_X", "c.txt"):
+        pass
+    assert threads and threading.current_thread() not in threads
+    monkeypatch.setattr(second_locks.store, "lock_file", lock_file)
+
+    # The lock of a process that stopped expires with its lease
+    assert first_locks.store.lock_file("OID_X", "a.txt", "stopped")
+    assert not second_locks.store.lock_file("OID_X", "a.txt", "other")
+    await asyncio.sleep(0.05)
+    async with second_locks.lock("OID_X", "a.txt"):
+        pass
+    first_locks.store.close()
+    second_locks.store.close()
+
+
+@pytest.mark.asyncio
+async def test_upload_queue_limits_stored_bytes(tmp_path):
+    class RemovingIngester(RecordingIngester):
+        async def remove_file(self, filename, oid):
+            pass
+
+    queue = UploadQueue(
+        RemovingIngester(),
+        StoredFileSystemClient({}),
+        UploadJobStore(str(tmp_path / "jobs.sqlite")),
+        max_bytes_per_user=10,
+    )
+    await queue.start()
+    try:
+        assert await queue.remaining_bytes("OID_X") == 10
+        await queue.enqueue("OID_X", "a.txt", "OID_X/a.txt", None, local_copy(tmp_path, "a.txt", b"aaaa"), size=4)
+        await queue.enqueue("OID_X", "b.txt", "OID_X/b.txt", None, local_copy(tmp_path, "b.txt", b"bbbbb"), size=5)
+        # Replacing a file only counts its new size
+        await queue.enqueue("OID_X", "a.txt", "OID_X/a.txt", None, local_copy(tmp_path, "a2.txt", b"aaaaa"), size=5)
+        assert await queue.remaining_bytes("OID_X") == 0
+        assert await queue.remaining_bytes("OID_Y") == 10
+        await queue.remove("OID_X", "b.txt")
+        assert await queue.remaining_bytes("OID_X") == 5
+        await queue.join()
+    finally:
+        await queue.stop()